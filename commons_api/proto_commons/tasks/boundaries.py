@@ -17,7 +17,8 @@ from boundaries.models import Definition, BoundarySet
 from commons_api.proto_commons.models import Shapefile
 from commons_api.wikidata.models import Country, Spatial
 
-__all__ = ['update_all_boundaries', 'update_boundaries_for_country']
+__all__ = ['get_commons_repos', 'import_boundaries_for_country', 'update_all_boundaries',
+           'update_boundaries_for_country']
 
 import logging
 from typing import Iterable
@@ -43,8 +44,8 @@ except AttributeError:  # GDAL 1.10
     coordinate_dimension = int_output(lgdal.OGR_G_GetCoordinateDimension, [c_void_p])
 
 
-@celery.shared_task
-def update_all_boundaries():
+def get_commons_repos():
+    """Yields the ID of each country with a Democratic Commons repository, along with the repository's full name"""
     for repo in get_github_repos_with_topics():  # type: github.Repository.Repository
         if 'commons-data' not in repo.topics:
             continue
@@ -62,11 +63,17 @@ def update_all_boundaries():
             logger.warning("Couldn't find Country with code %s for repo %s", iso_3166_1_code, repo.full_name)
             continue
 
-        update_boundaries_for_country.delay(country.id, repo.full_name)
+        yield country.id, repo.full_name
 
 
 @celery.shared_task
-def update_boundaries_for_country(country_id: str, repo_full_name: str=None):
+def update_all_boundaries():
+    for country_id, repo_full_name in get_commons_repos():
+        update_boundaries_for_country.delay(country_id, repo_full_name)
+
+
+def get_shapefile_urls(country_id: str, repo_full_name: str=None):
+    """Returns the URLs of the shapefiles in the boundaries index of a country's Democratic Commons repository"""
     country = Country.objects.get(id=country_id)
     g = github.Github()
     if repo_full_name:
@@ -89,15 +96,35 @@ def update_boundaries_for_country(country_id: str, repo_full_name: str=None):
 
     boundaries_index = response.json()
     directories = {entry['directory'] for entry in boundaries_index}
-    for directory in directories:
-        update_boundaries.delay(country_id, '{}{}/{}.shp'.format(boundaries_url, directory, directory))
+    return ['{}{}/{}.shp'.format(boundaries_url, directory, directory) for directory in sorted(directories)]
 
 
 @celery.shared_task
-def update_boundaries(country_id: str, shapefile_url: str):
+def update_boundaries_for_country(country_id: str, repo_full_name: str=None):
+    for shapefile_url in get_shapefile_urls(country_id, repo_full_name):
+        update_boundaries.delay(country_id, shapefile_url)
+
+
+def import_boundaries_for_country(country_id: str, repo_full_name: str=None):
+    """Imports each changed shapefile for a country in turn, in this process
+
+    Unlike :py:func:`update_boundaries_for_country`, this only returns once the boundaries have been imported, for
+    callers that need to know when that is (e.g. the bootstrap pipeline)."""
+    for shapefile_url in get_shapefile_urls(country_id, repo_full_name):
+        if shapefile_changed(country_id, shapefile_url):
+            import_shapefile(country_id, shapefile_url)
+
+
+def shapefile_changed(country_id: str, shapefile_url: str):
+    """Returns whether a shapefile's ETags differ from those it was last imported with"""
     shapefile, _ = Shapefile.objects.get_or_create(url=shapefile_url)
     _, etags = download_shapefile(country_id, shapefile_url, head=True)
-    if shapefile.etags != etags:
+    return shapefile.etags != etags
+
+
+@celery.shared_task
+def update_boundaries(country_id: str, shapefile_url: str):
+    if shapefile_changed(country_id, shapefile_url):
         import_shapefile.delay(country_id, shapefile_url)
 
 
@@ -1,5 +1,6 @@
 import os
 import re
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -84,7 +85,102 @@ STATIC_URL = '/static/'
 
 MEDIA_ROOT = os.environ.get('MEDIA_ROOT') or os.path.expanduser('~/media')
 
-WDQS_URL = 'https://query.wikidata.org/sparql'
+WDQS_URL = os.environ.get('WDQS_URL') or 'https://query.wikidata.org/sparql'
+# If set, all WDQS responses are saved here, for replaying with `manage.py replay_wdqs`
+WDQS_RECORD_DIR = os.environ.get('WDQS_RECORD_DIR')
+WDQS_USER_AGENT = os.environ.get('WDQS_USER_AGENT',
+                                 'commons-api (https://github.com/everypolitician/commons-api)')
+# Maximum number of keep-alive connections to WDQS held open by each process
+WDQS_POOL_SIZE = int(os.environ.get('WDQS_POOL_SIZE') or 10)
+# In seconds. WDQS itself gives up on queries after 60 seconds.
+WDQS_CONNECT_TIMEOUT = float(os.environ.get('WDQS_CONNECT_TIMEOUT') or 10)
+WDQS_READ_TIMEOUT = float(os.environ.get('WDQS_READ_TIMEOUT') or 70)
+# In bytes, for streamed query results
+WDQS_STREAM_CHUNK_SIZE = 64 * 1024
+
+# Limits shared by all processes querying WDQS; see commons_api.wikidata.governor
+WDQS_GOVERNOR_ENABLED = True
+WDQS_MAX_CONCURRENT_QUERIES = int(os.environ.get('WDQS_MAX_CONCURRENT_QUERIES') or 5)
+WDQS_MAX_QUERIES_PER_MINUTE = int(os.environ.get('WDQS_MAX_QUERIES_PER_MINUTE') or 60)
+# In seconds. How long to wait for a query slot before rescheduling the task instead.
+WDQS_GOVERNOR_MAX_WAIT = 30
+WDQS_GOVERNOR_POLL_INTERVAL = 1
+# The query rate is halved each time we're throttled, down to 1/WDQS_GOVERNOR_MAX_BACKOFF
+WDQS_GOVERNOR_MAX_BACKOFF = 16
+# In seconds, for when WDQS throttles us without saying how long for
+WDQS_DEFAULT_RETRY_AFTER = 60
+# How many times a task can be rescheduled because of throttling before it fails
+WDQS_THROTTLED_MAX_RETRIES = 50
+
+# For queries with long lists of VALUES; see commons_api.wikidata.utils.sharded_wikidata_query_bindings
+WDQS_SHARD_SIZE = 250
+# Number of concurrent queries made by a single task
+WDQS_QUERY_CONCURRENCY = int(os.environ.get('WDQS_QUERY_CONCURRENCY') or 3)
+# Number of concurrent queries made by tasks that make many small queries, e.g. refresh_all_labels
+WDQS_BATCH_CONCURRENCY = int(os.environ.get('WDQS_BATCH_CONCURRENCY') or WDQS_MAX_CONCURRENT_QUERIES)
+
+# Whether to keep per-template query statistics; see commons_api.wikidata.instrumentation
+WDQS_INSTRUMENTATION_ENABLED = True
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Results of rendered SPARQL queries, keyed on a hash of the query
+    'wdqs': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('WDQS_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'commons-api-wdqs-cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('WDQS_CACHE_MAX_ENTRIES') or 2000),
+        },
+    },
+}
+
+# How long, in seconds, to cache results for each query template. Results for templates not listed are never cached.
+WDQS_CACHE_TIMEOUTS = {
+    'wikidata/query/country_list.rq': 60 * 60 * 12,
+    'wikidata/query/legislature_terms_list.rq': 60 * 60 * 24,
+    'wikidata/query/labels.rq': 60 * 60 * 6,
+}
+
+# 'bulk' writes ingested data with batched ORM writes. 'staging' merges it through staging tables in PostgreSQL, which
+# is faster for the largest houses; see commons_api.wikidata.staging
+WIKIDATA_INGEST_MODE = os.environ.get('WIKIDATA_INGEST_MODE') or 'bulk'
+
+# Number of objects refreshed by each message queued by periodic queuing tasks; see
+# commons_api.wikidata.tasks.base.with_periodic_queuing_task
+WIKIDATA_QUEUING_BATCH_SIZE = int(os.environ.get('WIKIDATA_QUEUING_BATCH_SIZE') or 20)
+
+# In seconds; how long a refresh can be queued or running before another can be queued for the same object. See
+# commons_api.wikidata.coalescing
+REFRESH_LOCK_TIMEOUT = 60 * 60 * 6
+
+# In seconds; objects whose refreshes are expected to take at least this long are refreshed on WIKIDATA_HEAVY_QUEUE, so
+# that they don't hold up the rest. See commons_api.wikidata.costs
+WIKIDATA_HEAVY_TASK_DURATION = int(os.environ.get('WIKIDATA_HEAVY_TASK_DURATION') or 120)
+WIKIDATA_HEAVY_QUEUE = os.environ.get('WIKIDATA_HEAVY_QUEUE') or 'heavy'
+
+# Whether periodic refreshes first check which items have changed on Wikidata, skipping those that haven't. See
+# commons_api.wikidata.changes
+WIKIDATA_INCREMENTAL_REFRESH = not os.environ.get('WIKIDATA_FULL_REFRESH')
+# In days; how often members and districts are refreshed even if no changes are seen, as the check for those is heuristic
+WIKIDATA_REFRESH_MAX_AGE = int(os.environ.get('WIKIDATA_REFRESH_MAX_AGE') or 28)
+# In seconds; how far WDQS may lag behind Wikidata, allowed for when comparing modification times with refresh times
+WDQS_MAX_LAG = 60 * 60
+
+# Maximum number of tasks each stage of the bootstrap pipeline runs at once, by stage, defaulting to 1. See
+# commons_api.wikidata.tasks.pipeline
+PIPELINE_CONCURRENCY = {
+    'legislatures': int(os.environ.get('PIPELINE_CONCURRENCY') or 4),
+    'districts': int(os.environ.get('PIPELINE_CONCURRENCY') or 4),
+    'members': int(os.environ.get('PIPELINE_CONCURRENCY') or 4),
+    'labels': 2,
+}
+# In seconds; how long a bootstrap pipeline run can go without progress before it's treated as stalled
+PIPELINE_STALL_TIMEOUT = 60 * 60 * 2
+
+# In seconds; how often ingest tasks publish their progress. See commons_api.wikidata.progress
+INGEST_PROGRESS_INTERVAL = 2
 
 ENABLE_MODERATION = bool(os.environ.get('ENABLE_MODERATION'))
 
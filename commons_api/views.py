@@ -9,7 +9,8 @@ from django.views.generic import TemplateView
 
 from django_celery_results.models import TaskResult
 
-from commons_api.wikidata.models import WikidataItem
+from commons_api.wikidata.models import PipelineRun, WikidataItem
+from commons_api.wikidata.progress import PROGRESS
 
 
 class QueueStatusView(TemplateView):
@@ -44,11 +45,24 @@ class QueueStatusView(TemplateView):
             if issubclass(model, WikidataItem):
                 wikidata_links.update({item.id: item.link
                                        for item in model.objects.filter(id__in=wikidata_ids)})
+        progress = self.get_progress([result.get('id') or result.get('task_id') for result in data])
         for result in data:
             result['parsed_args'] = [wikidata_links.get(arg, arg)
                                      for arg in result['parsed_args']]
+            result['progress'] = progress.get(result.get('id') or result.get('task_id'))
         return data
 
+    def get_progress(self, task_ids):
+        """Returns the latest progress published by each of the given tasks that are still in progress"""
+        progress = {}
+        for task_id, result in TaskResult.objects.filter(task_id__in=task_ids, status=PROGRESS) \
+                                                 .values_list('task_id', 'result'):
+            try:
+                progress[task_id] = json.loads(result)
+            except (TypeError, ValueError):
+                continue
+        return progress
+
     def get_active_tasks(self):
         from commons_api import celery_app
         return self.parse_tasks(list(itertools.chain(*celery_app.control.inspect().active().values())))
@@ -58,5 +72,6 @@ class QueueStatusView(TemplateView):
         context.update({
             'active_tasks': self.get_active_tasks(),
             'taskresults': self.parse_tasks(TaskResult.objects.order_by('-pk')[:20]),
+            'pipeline_run': PipelineRun.objects.prefetch_related('stages').first(),
         })
         return context
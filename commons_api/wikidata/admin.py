@@ -47,6 +47,35 @@ class ElectoralDistrictAdmin(admin.ModelAdmin):
     list_filter = ('legislative_house',)
 
 
+class QueryTemplateStatsAdmin(admin.ModelAdmin):
+    list_display = ('template', 'queries', 'cache_hits', 'errors', 'timeouts', 'duration', 'max_duration', 'bytes',
+                    'last_queried')
+
+
+class RefreshLockAdmin(admin.ModelAdmin):
+    list_display = ('task', 'object_id', 'queued_at', 'started_at', 'expires', 'coalesced', 'rerun')
+    list_filter = ('task',)
+
+
+class RefreshCostAdmin(admin.ModelAdmin):
+    list_display = ('task', 'object_id', 'runs', 'duration', 'last_duration', 'max_duration', 'bindings', 'peak_memory',
+                    'last_run')
+    list_filter = ('task',)
+
+
+class PipelineStageInline(admin.TabularInline):
+    model = models.PipelineStage
+    fields = ('name', 'status', 'total', 'done', 'failed', 'skipped', 'started_at', 'finished_at')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+
+class PipelineRunAdmin(admin.ModelAdmin):
+    list_display = ('id', 'status', 'started_at', 'finished_at', 'last_activity')
+    inlines = [PipelineStageInline]
+
+
 admin.site.register(models.Country, CountryAdmin)
 admin.site.register(models.LegislativeHouse, LegislativeHouseAdmin)
 admin.site.register(models.AdministrativeArea, AdministrativeAreaAdmin)
@@ -56,4 +85,8 @@ admin.site.register(models.Person, PersonAdmin)
 admin.site.register(models.Term, TermAdmin)
 admin.site.register(models.ModerationItem, ModerationItemAdmin)
 admin.site.register(models.Organization, OrganizationAdmin)
-admin.site.register(models.ElectoralDistrict, ElectoralDistrictAdmin)
\ No newline at end of file
+admin.site.register(models.ElectoralDistrict, ElectoralDistrictAdmin)
+admin.site.register(models.QueryTemplateStats, QueryTemplateStatsAdmin)
+admin.site.register(models.RefreshLock, RefreshLockAdmin)
+admin.site.register(models.RefreshCost, RefreshCostAdmin)
+admin.site.register(models.PipelineRun, PipelineRunAdmin)
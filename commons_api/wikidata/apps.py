@@ -1,6 +1,5 @@
 from django import apps
 from django.db.models.signals import post_save
-from django.utils import timezone
 
 
 class CountryConfig(apps.AppConfig):
@@ -15,23 +14,26 @@ class CountryConfig(apps.AppConfig):
                           sender=models.LegislativeHouse)
 
     def refresh_legislatures_when_country_created(self, sender, instance, created, **kwargs):
-        from commons_api.wikidata.tasks import refresh_legislatures
+        from commons_api.wikidata import coalescing
+        from commons_api.wikidata.tasks import refresh_legislatures, pipeline
 
+        # The bootstrap pipeline will refresh it in a later stage
+        if created and pipeline.active_run() is not None:
+            return
         if created and not instance.refresh_legislatures_last_queued:
-            queued_at = timezone.now()
-            sender.objects.filter(id=instance.id).update(refresh_legislatures_last_queued=queued_at)
-            refresh_legislatures.delay(id=instance.id, queued_at=queued_at)
+            coalescing.enqueue(refresh_legislatures, instance.id)
 
     def refresh_when_legislature_created(self, sender, instance, created, **kwargs):
+        from commons_api.wikidata import coalescing
         from commons_api.wikidata.tasks import (
             refresh_members,
             refresh_districts,
+            pipeline,
         )
 
-        queued_at = timezone.now()
+        if created and pipeline.active_run() is not None:
+            return
         if created and not instance.refresh_members_last_queued:
-            sender.objects.filter(id=instance.id).update(refresh_members_last_queued=queued_at)
-            refresh_members.delay(id=instance.id, queued_at=queued_at)
+            coalescing.enqueue(refresh_members, instance.id)
         if created and not instance.refresh_districts_last_queued:
-            sender.objects.filter(id=instance.id).update(refresh_districts_last_queued=queued_at)
-            refresh_districts.delay(id=instance.id, queued_at=queued_at)
+            coalescing.enqueue(refresh_districts, instance.id)
@@ -0,0 +1,188 @@
+"""
+Bulk writing of ingested data, for tasks that would otherwise save thousands of objects one at a time
+
+These functions write many objects in a handful of `INSERT … ON CONFLICT` statements. They don't call `save()` and
+don't send model signals. When `settings.ENABLE_MODERATION` is on, objects are instead saved individually, so that
+changes go through :py:class:`commons_api.wikidata.models.Moderateable` and into the moderation queue.
+"""
+
+import collections
+
+from django.conf import settings
+from django.db import connection, router
+from django.db.models.signals import post_save
+
+from .utils import split_every
+
+BATCH_SIZE = 500
+
+
+def _deduplicate(objs):
+    # Postgres won't let one INSERT … ON CONFLICT DO UPDATE touch the same row twice, so the last object for each primary
+    # key wins
+    return list(collections.OrderedDict((obj.pk, obj) for obj in objs).values())
+
+
+def upsert(model, objs, update_fields=(), batch_size=BATCH_SIZE):
+    """Inserts `objs`, updating `update_fields` on any that already exist
+
+    If `update_fields` is empty, objects that already exist are left as they are.
+
+    :returns: The number of rows inserted or updated
+    """
+    objs = _deduplicate(objs)
+    if not objs:
+        return 0
+    if settings.ENABLE_MODERATION:
+        return _save_individually(model, objs, update_fields)
+
+    meta, quote_name = model._meta, connection.ops.quote_name
+    if update_fields:
+        on_conflict = 'DO UPDATE SET ' + ', '.join('{0} = EXCLUDED.{0}'.format(quote_name(meta.get_field(name).column))
+                                                   for name in update_fields)
+    else:
+        on_conflict = 'DO NOTHING'
+    return _insert(model, objs, on_conflict, batch_size)
+
+
+def insert_new(model, objs, batch_size=BATCH_SIZE):
+    """Inserts those of `objs` that don't already exist, leaving existing rows as they are
+
+    Unlike :py:func:`upsert`, this never saves objects individually when moderation is enabled, and so is for
+    bookkeeping models that aren't moderated. As it reports exactly which objects it inserted, it can be used to take
+    locks.
+
+    :returns: A list of the primary keys of the objects inserted
+    """
+    return _insert(model, _deduplicate(objs), 'DO NOTHING', batch_size, returning=True)
+
+
+def _insert(model, objs, on_conflict, batch_size, returning=False):
+    meta, quote_name = model._meta, connection.ops.quote_name
+    fields = meta.concrete_fields
+    row_placeholder = '(' + ', '.join(['%s'] * len(fields)) + ')'
+
+    count, inserted = 0, []
+    with connection.cursor() as cursor:
+        for batch in split_every(objs, batch_size):
+            batch = list(batch)
+            sql = 'INSERT INTO {} ({}) VALUES {} ON CONFLICT ({}) {}'.format(
+                quote_name(meta.db_table),
+                ', '.join(quote_name(field.column) for field in fields),
+                ', '.join([row_placeholder] * len(batch)),
+                quote_name(meta.pk.column),
+                on_conflict)
+            if returning:
+                sql += ' RETURNING ' + quote_name(meta.pk.column)
+            cursor.execute(sql, [field.get_db_prep_save(field.pre_save(obj, True), connection)
+                                 for obj in batch for field in fields])
+            if returning:
+                inserted.extend(row[0] for row in cursor.fetchall())
+            count += cursor.rowcount
+    return inserted if returning else count
+
+
+def _save_individually(model, objs, update_fields):
+    existing = model.objects.in_bulk([obj.pk for obj in objs])
+    count = 0
+    for obj in objs:
+        if obj.pk not in existing:
+            obj.save()
+        elif update_fields:
+            existing_obj = existing[obj.pk]
+            for name in update_fields:
+                attname = model._meta.get_field(name).attname
+                setattr(existing_obj, attname, getattr(obj, attname))
+            existing_obj.save()
+        else:
+            continue
+        count += 1
+    return count
+
+
+def update(model, objs, fields, batch_size=BATCH_SIZE):
+    """Updates `fields` on existing rows for `objs`, in a few UPDATE statements
+
+    :returns: The number of objects updated
+    """
+    objs = _deduplicate(objs)
+    if not objs:
+        return 0
+    if settings.ENABLE_MODERATION:
+        return _save_individually(model, objs, fields)
+    model.objects.bulk_update(objs, fields, batch_size=batch_size)
+    return len(objs)
+
+
+def delete(queryset):
+    """Deletes everything in `queryset`, along with anything that cascades from it
+
+    When moderation is enabled, each object is instead deleted individually, which queues its deletion for moderation.
+
+    :returns: A dict of the number of objects deleted, by model label, including cascaded deletions
+    """
+    if settings.ENABLE_MODERATION:
+        for obj in queryset:
+            obj.delete()
+        return {}
+    total, counts = queryset.delete()
+    return {label: count for label, count in counts.items() if count}
+
+
+def signal_created(model, objs, existing_pks):
+    """Sends `post_save` for those of `objs` that have been created by an upsert
+
+    `existing_pks` are the primary keys that already existed before the upsert. Objects that still don't exist (because
+    their creation is awaiting moderation) are skipped. This lets handlers that react to new objects being created (e.g.
+    to queue refreshing them) work as they would had each object been saved individually.
+
+    :returns: A sorted list of the primary keys of the created objects
+    """
+    new_pks = {obj.pk for obj in objs} - set(existing_pks)
+    created_pks = set(model.objects.filter(pk__in=new_pks).values_list('pk', flat=True))
+    using = router.db_for_write(model)
+    for obj in _deduplicate(objs):
+        if obj.pk in created_pks:
+            post_save.send(sender=model, instance=obj, created=True, update_fields=None, raw=False, using=using)
+    return sorted(created_pks)
+
+
+def create_missing_items(model, labels):
+    """Creates any Wikidata items that don't exist yet, from a dict of IDs to English labels
+
+    This is the bulk equivalent of calling `model.objects.for_id_and_label(id, label, save=True)` for each item."""
+    return upsert(model, [model(id=id, labels={'en': label}) for id, label in labels.items()])
+
+
+def set_many_to_many(model, field_name, values):
+    """Sets a many-to-many field on many objects at once
+
+    `values` is a dict from primary keys of `model` to iterables of primary keys of the related model. This is
+    equivalent to calling `obj.<field_name>.set(…)` for each object, but reads the existing relations for all of the
+    objects in one query, and then makes only the necessary inserts and deletes, each in bulk. When moderation is
+    enabled, objects that don't exist yet (because their creation is awaiting moderation) are skipped, as are related
+    objects that don't exist yet.
+
+    :returns: A tuple of the numbers of relations added and removed
+    """
+    field = model._meta.get_field(field_name)
+    through = field.remote_field.through
+    if settings.ENABLE_MODERATION:
+        existing = set(model.objects.filter(pk__in=list(values)).values_list('pk', flat=True))
+        related_pks = {related_pk for pks in values.values() for related_pk in pks}
+        existing_related = set(field.related_model.objects.filter(pk__in=related_pks).values_list('pk', flat=True))
+        values = {pk: [related_pk for related_pk in pks if related_pk in existing_related]
+                  for pk, pks in values.items() if pk in existing}
+    source, target = field.m2m_field_name() + '_id', field.m2m_reverse_field_name() + '_id'
+
+    wanted = {(pk, related_pk) for pk, related_pks in values.items() for related_pk in related_pks}
+    current = {(pk, related_pk): through_pk
+               for through_pk, pk, related_pk in through.objects.filter(**{source + '__in': list(values)})
+                                                                .values_list('pk', source, target)}
+    to_remove = [through_pk for pair, through_pk in current.items() if pair not in wanted]
+    to_add = sorted(wanted - set(current))
+    for batch in split_every(to_remove, BATCH_SIZE):
+        through.objects.filter(pk__in=list(batch)).delete()
+    through.objects.bulk_create([through(**{source: pk, target: related_pk}) for pk, related_pk in to_add],
+                                batch_size=BATCH_SIZE)
+    return len(to_add), len(to_remove)
@@ -0,0 +1,111 @@
+"""
+Checks which items have changed on Wikidata, so that periodic refreshes can skip those that haven't
+
+Before a periodic refresh, the `schema:dateModified` of the items it depends on are fetched, many at a time, with a
+query that's much cheaper than the refresh itself. When `settings.WIKIDATA_INCREMENTAL_REFRESH` is off, everything is
+refreshed regardless.
+
+For labels, which are stored on the items themselves, the check is exact: an item's labels are refreshed only if its
+modification time differs from the one stored in its `wikidata_modified` field when its labels were last refreshed.
+Items that WDQS doesn't know about have no labels to refresh, and so are skipped.
+
+For the members and districts of a legislative house, the check is a heuristic. Memberships are statements on the
+members themselves, and districts are separate items, so a house is refreshed if the house itself, its positions, or
+its current members or districts have been modified since it was last refreshed (allowing for `settings.WDQS_MAX_LAG`).
+New members and districts, and changes to past ones, aren't seen by this, and so houses are refreshed anyway once
+their last refresh is `settings.WIKIDATA_REFRESH_MAX_AGE` days old.
+"""
+
+import collections
+import datetime
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import bulk, models
+from .utils import item_uri_to_id, sharded_wikidata_query_bindings
+
+
+def modified_times(ids):
+    """Returns a dict of when each of the given items was last modified on Wikidata
+
+    Items that WDQS doesn't know about (e.g. because they've been deleted) are omitted."""
+    bindings = sharded_wikidata_query_bindings('wikidata/query/modified.rq', {'ids': sorted(ids)}, 'ids',
+                                               use_cache=False)
+    return {item_uri_to_id(row['id']['value']): parse_datetime(row['modified']['value']) for row in bindings}
+
+
+def changed_items(model, ids):
+    """Finds which of the given items of `model` have been modified since their labels were last refreshed
+
+    Items that WDQS doesn't know about (e.g. because they've been deleted) are omitted, as they have nothing to refresh.
+
+    :returns: A dict of the IDs of the changed items to their modification times, to be recorded with
+        :py:func:`record_modified` once they've been refreshed
+    """
+    stored = dict(model.objects.filter(id__in=list(ids)).values_list('id', 'wikidata_modified'))
+    modified = modified_times(stored)
+    return {id: modified[id] for id, wikidata_modified in stored.items()
+            if id in modified and modified[id] != wikidata_modified}
+
+
+def record_modified(model, modified):
+    """Stores the modification times returned by :py:func:`changed_items`, once the items have been refreshed
+
+    These are bookkeeping, and so are written directly, even when moderation is enabled."""
+    model.objects.bulk_update([model(id=id, wikidata_modified=wikidata_modified)
+                               for id, wikidata_modified in modified.items()],
+                              ['wikidata_modified'], batch_size=bulk.BATCH_SIZE)
+
+
+def member_sources(house_ids):
+    """Returns a dict from house IDs to the IDs of the items their memberships are drawn from"""
+    sources = collections.defaultdict(set)
+    for house_id in house_ids:
+        sources[house_id].add(house_id)
+    for house_id, position_id in models.LegislativeHouse.positions.through.objects.filter(
+            legislativehouse_id__in=house_ids).values_list('legislativehouse_id', 'position_id'):
+        sources[house_id].add(position_id)
+    for house_id, person_id in models.LegislativeMembership.objects.filter(
+            legislative_house_id__in=house_ids).current().values_list('legislative_house_id', 'person_id'):
+        sources[house_id].add(person_id)
+    return sources
+
+
+def district_sources(house_ids):
+    """Returns a dict from house IDs to the IDs of the items their districts are drawn from"""
+    sources = collections.defaultdict(set)
+    for house_id in house_ids:
+        sources[house_id].add(house_id)
+    for house_id, district_id in models.ElectoralDistrict.objects.filter(
+            legislative_house_id__in=house_ids).current().values_list('legislative_house_id', 'id'):
+        sources[house_id].add(district_id)
+    return sources
+
+
+def _changed_houses(house_ids, get_sources, last_refreshed_attribute):
+    now = timezone.now()
+    max_age_threshold = now - datetime.timedelta(days=settings.WIKIDATA_REFRESH_MAX_AGE)
+    last_refreshed = dict(models.LegislativeHouse.objects.filter(id__in=list(house_ids))
+                                                         .values_list('id', last_refreshed_attribute))
+    changed = {id for id, refreshed in last_refreshed.items() if refreshed is None or refreshed < max_age_threshold}
+
+    sources = get_sources([id for id in last_refreshed if id not in changed])
+    modified = modified_times(set().union(*sources.values()))
+    lag = datetime.timedelta(seconds=settings.WDQS_MAX_LAG)
+    for house_id, source_ids in sources.items():
+        newest = max((modified[id] for id in source_ids if id in modified), default=None)
+        if newest is not None and newest > last_refreshed[house_id] - lag:
+            changed.add(house_id)
+    return [id for id in house_ids if id in changed]
+
+
+def changed_members(model, ids):
+    """Returns those of the given legislative houses whose members may have changed since they were last refreshed"""
+    return _changed_houses(ids, member_sources, 'refresh_members_last_refreshed')
+
+
+def changed_districts(model, ids):
+    """Returns those of the given legislative houses whose districts may have changed since they were last refreshed"""
+    return _changed_houses(ids, district_sources, 'refresh_districts_last_refreshed')
@@ -0,0 +1,116 @@
+"""
+Coalescing of requests to refresh the same object
+
+Refreshes can be requested from several places at once: the periodic queuing tasks, the `post_save` handlers in
+:py:class:`commons_api.wikidata.apps.CountryConfig`, and the refresh buttons on detail pages. Each goes through
+:py:func:`enqueue` (or :py:func:`acquire`, for many objects at once), which only queues a task if one isn't already
+queued or running for the same object, as recorded by a :py:class:`commons_api.wikidata.models.RefreshLock`.
+
+A request made while a refresh is queued is merged into it, as the refresh will fetch the latest data when it runs, and
+any arguments it was made with (e.g. `use_cache=False` from a refresh button) are applied when the refresh starts. A
+request made while a refresh is running is remembered, and the object is refreshed once more when the running refresh
+finishes, as that may have fetched its data before whatever prompted the request.
+
+Locks expire after `settings.REFRESH_LOCK_TIMEOUT` seconds, in case a task is lost.
+"""
+
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import bulk, costs, models
+
+
+def acquire(task_name, object_ids, queued_at, kwargs=None):
+    """Takes locks for refreshing the given objects with a task, merging requests for those already locked
+
+    :param kwargs: Any keyword arguments for the task beyond `id` and `queued_at`, which are applied to a queued
+        refresh when it starts, or used should the object need refreshing again after a running refresh
+    :returns: A list of the IDs of the objects now locked, for which the task should be queued
+    """
+    object_ids = list(object_ids)
+    if not object_ids:
+        return []
+    locks = models.RefreshLock.objects.filter(task=task_name, object_id__in=object_ids)
+    locks.filter(expires__lte=queued_at).delete()
+
+    expires = queued_at + datetime.timedelta(seconds=settings.REFRESH_LOCK_TIMEOUT)
+    acquired = set(bulk.insert_new(models.RefreshLock, [
+        models.RefreshLock(id=models.RefreshLock.make_id(task_name, object_id), task=task_name, object_id=object_id,
+                           queued_at=queued_at, expires=expires)
+        for object_id in object_ids]))
+
+    merged = locks.exclude(id__in=acquired)
+    merged.update(coalesced=F('coalesced') + 1)
+    merged.filter(started_at__isnull=False).update(rerun=True)
+    if kwargs:
+        with transaction.atomic():
+            for lock in merged.select_for_update():
+                if lock.started_at:
+                    lock.rerun_kwargs = dict(lock.rerun_kwargs, **kwargs)
+                else:
+                    lock.merged_kwargs = dict(lock.merged_kwargs, **kwargs)
+                lock.save()
+    return [object_id for object_id in object_ids if models.RefreshLock.make_id(task_name, object_id) in acquired]
+
+
+def start(task_name, object_id, queued_at):
+    """Records that a queued refresh has started running
+
+    :returns: Keyword arguments of requests merged into the refresh while it was queued, to override those it was
+        queued with
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        lock = models.RefreshLock.objects.select_for_update().filter(
+            id=models.RefreshLock.make_id(task_name, object_id), queued_at=queued_at).first()
+        if lock is None:
+            return {}
+        lock.started_at, lock.expires = now, now + datetime.timedelta(seconds=settings.REFRESH_LOCK_TIMEOUT)
+        lock.save()
+    return lock.merged_kwargs
+
+
+def release(task_name, object_id, queued_at):
+    """Releases the lock for a refresh that has finished, whether or not it succeeded
+
+    :returns: Keyword arguments for refreshing the object again, if that was requested while it was running, or None
+    """
+    with transaction.atomic():
+        lock = models.RefreshLock.objects.select_for_update().filter(
+            id=models.RefreshLock.make_id(task_name, object_id), queued_at=queued_at).first()
+        if lock is None:
+            return None
+        lock.delete()
+    return lock.rerun_kwargs if lock.rerun else None
+
+
+def release_many(task_name, object_ids, queued_at):
+    """Releases locks taken by :py:func:`acquire` for objects that turned out not to need refreshing"""
+    models.RefreshLock.objects.filter(id__in=[models.RefreshLock.make_id(task_name, object_id)
+                                              for object_id in object_ids],
+                                      queued_at=queued_at).delete()
+
+
+def enqueue(task, object_id, **kwargs):
+    """Queues a refresh task for an object, unless one is already queued or running
+
+    `task` must have been decorated with :py:func:`commons_api.wikidata.tasks.base.with_periodic_queuing_task`. The
+    object's last-queued attribute is updated, and the task is queued with `id` and `queued_at` as well as `kwargs`, on
+    the heavy queue if the object is expensive to refresh (see :py:mod:`commons_api.wikidata.costs`).
+
+    :returns: Whether the task was queued
+    """
+    queued_at = timezone.now()
+    if not acquire(task.name, [object_id], queued_at, kwargs):
+        return False
+    task.queued_model.objects.filter(id=object_id).update(**{task.last_queued_attribute: queued_at})
+    queue = costs.queue_for(task.name, object_id)
+    if queue:
+        task.apply_async(kwargs=dict(kwargs, id=object_id, queued_at=queued_at), queue=queue)
+    else:
+        task.delay(id=object_id, queued_at=queued_at, **kwargs)
+    return True
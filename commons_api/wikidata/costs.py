@@ -0,0 +1,131 @@
+"""
+Measures what it costs to refresh each object, so that expensive refreshes don't hold up cheap ones
+
+Each run of a refresh task for an individual object (i.e. one decorated with
+:py:func:`commons_api.wikidata.tasks.base.with_periodic_queuing_task` and called with an `id`) is timed, and the query
+result bindings it processes and its peak memory are recorded in a :py:class:`commons_api.wikidata.models.RefreshCost`.
+Only runs that succeed are recorded.
+
+Objects expected to take at least `settings.WIKIDATA_HEAVY_TASK_DURATION` seconds are refreshed on the
+`settings.WIKIDATA_HEAVY_QUEUE` queue, which has its own worker, and the periodic queuing tasks queue the rest
+cheapest first. Objects that have never been refreshed are assumed to be cheap, until they've been measured.
+
+Peak memory is the worker process's high-water mark, which only tells us about a run if it's the first the process has
+made. It is only measured for those runs, which on the heavy queue (whose worker processes each run one task) is all of
+them.
+"""
+
+import contextlib
+import logging
+import resource
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.utils import timezone
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+# How much the expected duration moves towards the latest run's duration, so that it follows objects as they grow
+SMOOTHING = 0.5
+
+# The run being measured in this process, if any. Queries for a run can be made from several threads.
+_current = None
+_lock = threading.Lock()
+# Whether this process has measured a run before, and so reached a peak memory that later runs might not
+_measured = False
+
+
+class RunCost:
+    """Measurements for a single run of a task for an object"""
+    def __init__(self, task_name, object_id):
+        self.task_name = task_name
+        self.object_id = object_id
+        self.duration = 0.0
+        self.bindings = 0
+        self.peak_memory = None
+
+
+def peak_memory():
+    """Returns the peak resident memory of this process so far, in bytes"""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@contextlib.contextmanager
+def measure(task_name, object_id):
+    """A context manager that measures a run of a task for an object, and records it if it succeeds"""
+    global _current, _measured
+    run, start = RunCost(task_name, object_id), time.monotonic()
+    first_run, _measured, _current = not _measured, True, run
+    try:
+        yield run
+    finally:
+        _current = None
+    run.duration = time.monotonic() - start
+    if first_run:
+        run.peak_memory = peak_memory()
+    try:
+        record(run)
+    except DatabaseError:
+        logger.exception("Couldn't record the cost of %s for %s", task_name, object_id)
+
+
+def add_bindings(count):
+    """Counts query result bindings towards the run being measured, if any"""
+    run = _current
+    if run is not None:
+        with _lock:
+            run.bindings += count
+
+
+def record(run):
+    logger.info("%s for %s: %.1fs, %d bindings, %s bytes peak memory", run.task_name, run.object_id, run.duration,
+                run.bindings, 'unknown' if run.peak_memory is None else run.peak_memory)
+    cost, _ = models.RefreshCost.objects.get_or_create(id=models.RefreshCost.make_id(run.task_name, run.object_id),
+                                                       defaults={'task': run.task_name, 'object_id': run.object_id})
+    if cost.runs:
+        cost.duration += SMOOTHING * (run.duration - cost.duration)
+    else:
+        cost.duration = run.duration
+    cost.runs += 1
+    cost.last_duration = run.duration
+    cost.max_duration = max(cost.max_duration, run.duration)
+    cost.bindings = run.bindings
+    if run.peak_memory is not None:
+        cost.peak_memory = run.peak_memory
+    cost.last_run = timezone.now()
+    cost.save()
+
+
+def expected_durations(task_name, object_ids):
+    """Returns a dict of the expected durations of refreshing those of `object_ids` that have been measured"""
+    return dict(models.RefreshCost.objects.filter(task=task_name, object_id__in=list(object_ids))
+                                          .values_list('object_id', 'duration'))
+
+
+def split_by_cost(task_name, object_ids):
+    """Splits objects into those that are cheap to refresh and those that should be refreshed on the heavy queue
+
+    :returns: A tuple of two lists of object IDs, each ordered cheapest first
+    """
+    object_ids = list(object_ids)
+    durations = expected_durations(task_name, object_ids)
+    object_ids.sort(key=lambda object_id: durations.get(object_id, 0))
+    cheap, heavy = [], []
+    for object_id in object_ids:
+        if durations.get(object_id, 0) >= settings.WIKIDATA_HEAVY_TASK_DURATION:
+            heavy.append(object_id)
+        else:
+            cheap.append(object_id)
+    return cheap, heavy
+
+
+def queue_for(task_name, object_id):
+    """Returns the queue to refresh an object on, or None for the task's usual queue"""
+    durations = expected_durations(task_name, [object_id])
+    if durations.get(object_id, 0) >= settings.WIKIDATA_HEAVY_TASK_DURATION:
+        return settings.WIKIDATA_HEAVY_QUEUE
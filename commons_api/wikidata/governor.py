@@ -0,0 +1,155 @@
+"""
+Coordinates queries to WDQS across all processes, so that together they stay within WDQS's usage limits
+
+State is kept in the database (in :py:class:`commons_api.wikidata.models.QueryGovernor`), so every celery worker sees
+the same limits. Before querying, a process takes out a lease on one of `settings.WDQS_MAX_CONCURRENT_QUERIES` slots,
+and a token from a bucket that refills at `settings.WDQS_MAX_QUERIES_PER_MINUTE`. Leases expire (in case the process
+holding one dies) unless renewed, as they are while a streamed response is read. When WDQS tells us to slow down
+(with a 429 or 503 response), the governor stops handing out slots until the `Retry-After` time has passed, and reduces
+the rate at which tokens are handed out. The rate then recovers gradually as queries succeed.
+
+If a slot can't be had within `settings.WDQS_GOVERNOR_MAX_WAIT` seconds, :py:class:`WDQSThrottled` is raised, which
+:py:class:`commons_api.wikidata.tasks.base.WikidataQueryTask` handles by rescheduling the task.
+"""
+
+import contextlib
+import datetime
+import email.utils
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from . import models
+
+GOVERNOR_ID = 'wdqs'
+
+
+class WDQSThrottled(Exception):
+    """Raised when a query can't be made now, but could be made after `retry_after` seconds"""
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__("WDQS is throttled; retry after {:.1f} seconds".format(retry_after))
+
+
+def parse_retry_after(value):
+    """Parses a Retry-After header value into a number of seconds
+
+    Retry-After can be either a number of seconds or an HTTP date. If it is missing or can't be parsed,
+    `settings.WDQS_DEFAULT_RETRY_AFTER` is returned."""
+    if value:
+        try:
+            return max(0, int(value))
+        except ValueError:
+            pass
+        try:
+            return max(0, (email.utils.parsedate_to_datetime(value) - timezone.now()).total_seconds())
+        except (TypeError, ValueError):
+            pass
+    return settings.WDQS_DEFAULT_RETRY_AFTER
+
+
+def try_acquire():
+    """Tries to take out a lease on a query slot
+
+    :returns: A tuple of the new lease's ID (or None if no slot is available yet), and the number of seconds after which
+        it might be worth trying again
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        governor, _ = models.QueryGovernor.objects.select_for_update().get_or_create(id=GOVERNOR_ID)
+        if governor.blocked_until and governor.blocked_until > now:
+            return None, (governor.blocked_until - now).total_seconds()
+
+        leases = models.QueryLease.objects.filter(governor=governor)
+        leases.filter(expires__lt=now).delete()
+        if leases.count() >= settings.WDQS_MAX_CONCURRENT_QUERIES:
+            return None, settings.WDQS_GOVERNOR_POLL_INTERVAL
+
+        # Refill the token bucket for the time since it was last touched. We allow bursts of up to as many queries as
+        # we allow to be concurrent.
+        rate = settings.WDQS_MAX_QUERIES_PER_MINUTE / 60 / governor.backoff
+        if governor.tokens_updated:
+            elapsed = (now - governor.tokens_updated).total_seconds()
+            tokens = min(settings.WDQS_MAX_CONCURRENT_QUERIES, governor.tokens + elapsed * rate)
+        else:
+            tokens = settings.WDQS_MAX_CONCURRENT_QUERIES
+        if tokens < 1:
+            return None, (1 - tokens) / rate
+
+        governor.tokens, governor.tokens_updated = tokens - 1, now
+        governor.save()
+        lease = models.QueryLease.objects.create(governor=governor, expires=now + get_lease_duration())
+        return lease.pk, 0
+
+
+def get_lease_duration():
+    """Returns how long a lease lasts without being renewed, which is as long as a query can take to be answered"""
+    return datetime.timedelta(seconds=settings.WDQS_CONNECT_TIMEOUT + settings.WDQS_READ_TIMEOUT)
+
+
+def acquire(max_wait=None):
+    """Waits for a query slot, returning the ID of its lease
+
+    :raises WDQSThrottled: if no slot will be available within `max_wait` seconds (defaulting to
+        `settings.WDQS_GOVERNOR_MAX_WAIT`)
+    """
+    if max_wait is None:
+        max_wait = settings.WDQS_GOVERNOR_MAX_WAIT
+    deadline = time.monotonic() + max_wait
+    while True:
+        lease_id, retry_after = try_acquire()
+        if lease_id is not None:
+            return lease_id
+        if time.monotonic() + retry_after > deadline:
+            raise WDQSThrottled(retry_after)
+        time.sleep(retry_after)
+
+
+def renew(lease_id):
+    """Extends a lease, so that other processes don't take it to have expired while its slot is still in use"""
+    if lease_id is not None:
+        models.QueryLease.objects.filter(pk=lease_id).update(expires=timezone.now() + get_lease_duration())
+
+
+def release(lease_id):
+    models.QueryLease.objects.filter(pk=lease_id).delete()
+
+
+@contextlib.contextmanager
+def query_slot():
+    """A context manager that holds a query slot for its duration, providing the ID of its lease
+
+    This is a no-op if `settings.WDQS_GOVERNOR_ENABLED` is false, in which case the lease ID is None."""
+    if not settings.WDQS_GOVERNOR_ENABLED:
+        yield None
+        return
+    lease_id = acquire()
+    try:
+        yield lease_id
+    finally:
+        release(lease_id)
+
+
+def record_throttled(retry_after):
+    """Records that WDQS has asked us to wait `retry_after` seconds, and slows down subsequent queries"""
+    if not settings.WDQS_GOVERNOR_ENABLED:
+        return
+    blocked_until = timezone.now() + datetime.timedelta(seconds=retry_after)
+    with transaction.atomic():
+        governor, _ = models.QueryGovernor.objects.select_for_update().get_or_create(id=GOVERNOR_ID)
+        if not governor.blocked_until or governor.blocked_until < blocked_until:
+            governor.blocked_until = blocked_until
+        governor.backoff = min(governor.backoff * 2, settings.WDQS_GOVERNOR_MAX_BACKOFF)
+        governor.save()
+
+
+def record_success():
+    """Records a successful query, allowing the query rate to recover after being throttled"""
+    if not settings.WDQS_GOVERNOR_ENABLED:
+        return
+    models.QueryGovernor.objects.filter(id=GOVERNOR_ID, backoff__gt=1) \
+                                .update(backoff=Greatest(F('backoff') * 0.9, 1.0))
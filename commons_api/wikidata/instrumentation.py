@@ -0,0 +1,118 @@
+"""
+Measures how expensive each SPARQL query template is to run
+
+Every query made through :py:func:`commons_api.wikidata.utils.templated_wikidata_query` or
+:py:func:`commons_api.wikidata.utils.templated_wikidata_query_bindings` is timed and measured, and running totals are
+kept per template in :py:class:`commons_api.wikidata.models.QueryTemplateStats`, which can be seen at `/query-stats`.
+Each query is also logged, with a summary of its context (e.g. the legislative house it was for), and the context of
+the slowest query for each template is kept, so that expensive individual queries can be tracked down.
+"""
+
+import contextlib
+import logging
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, models as db_models
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from . import costs, models
+
+logger = logging.getLogger(__name__)
+
+
+def describe_context(context, max_length=200):
+    """Summarises a query template context, giving IDs for model instances and lengths for lists"""
+    parts = []
+    for key, value in sorted(context.items()):
+        if isinstance(value, db_models.Model):
+            value = value.pk
+        elif isinstance(value, (list, tuple, set)):
+            value = '<{} values>'.format(len(value))
+        parts.append('{}={}'.format(key, value))
+    return ', '.join(parts)[:max_length]
+
+
+class QueryMetrics:
+    """Measurements for a single query, filled in as the query progresses
+
+    `latency` is the time until the response headers were received, and `duration` the time until the results had been
+    consumed, in seconds. `bytes` is the size of the response body."""
+    def __init__(self, template, context):
+        self.template = template
+        self.context = describe_context(context)
+        self.render_time = 0.0
+        self.latency = 0.0
+        self.duration = 0.0
+        self.bytes = 0
+        self.bindings = 0
+        self.cache_hit = False
+        self.error = None
+
+
+@contextlib.contextmanager
+def instrument(template, context):
+    """A context manager that provides a :py:class:`QueryMetrics`, and records it on exit"""
+    metrics = QueryMetrics(template, context)
+    start = time.monotonic()
+    try:
+        yield metrics
+    except Exception as e:
+        metrics.error = e
+        raise
+    finally:
+        metrics.duration = time.monotonic() - start
+        try:
+            record(metrics)
+        except DatabaseError:
+            logger.exception("Couldn't record query metrics for %s", template)
+
+
+def record(metrics):
+    """Logs a query's metrics, and adds them to the totals for its template"""
+    from .governor import WDQSThrottled
+    from .utils import WDQSTimeout
+
+    costs.add_bindings(metrics.bindings)
+    if metrics.cache_hit:
+        logger.info("%s (%s): cached", metrics.template, metrics.context)
+    else:
+        logger.info("%s (%s): %.2fs (%.2fs to respond, %.3fs to render), %d bytes, %d bindings%s",
+                    metrics.template, metrics.context, metrics.duration, metrics.latency, metrics.render_time,
+                    metrics.bytes, metrics.bindings, ', failed: {!r}'.format(metrics.error) if metrics.error else '')
+
+    if not settings.WDQS_INSTRUMENTATION_ENABLED:
+        return
+
+    now = timezone.now()
+    if metrics.cache_hit:
+        updates = {'cache_hits': F('cache_hits') + 1}
+    else:
+        updates = {
+            'queries': F('queries') + 1,
+            'render_time': F('render_time') + metrics.render_time,
+            'latency': F('latency') + metrics.latency,
+            'duration': F('duration') + metrics.duration,
+            'bytes': F('bytes') + metrics.bytes,
+            'bindings': F('bindings') + metrics.bindings,
+            'max_bytes': Greatest(F('max_bytes'), metrics.bytes),
+        }
+        if metrics.error:
+            updates.update({
+                'errors': F('errors') + 1,
+                'timeouts': F('timeouts') + int(isinstance(metrics.error, WDQSTimeout)),
+                'throttled': F('throttled') + int(isinstance(metrics.error, WDQSThrottled)),
+                'last_error': repr(metrics.error)[:1000],
+                'last_error_at': now,
+            })
+    updates['last_queried'] = now
+
+    stats = models.QueryTemplateStats.objects.filter(template=metrics.template)
+    if not stats.update(**updates):
+        models.QueryTemplateStats.objects.get_or_create(template=metrics.template)
+        stats.update(**updates)
+    if not metrics.cache_hit:
+        stats.filter(max_duration__lt=metrics.duration).update(max_duration=metrics.duration,
+                                                               slowest_context=metrics.context)
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from commons_api.wikidata.tasks import pipeline
+
+
+class Command(BaseCommand):
+    help = "Starts the bootstrap pipeline, which refreshes everything in order, a stage at a time"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resume', type=int, metavar='RUN_ID',
+                            help="Resume a stalled run from the stage it had reached, instead of starting a new one")
+
+    def handle(self, resume, **options):
+        if resume:
+            try:
+                run = pipeline.resume(resume)
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.stdout.write("Resumed {}".format(run))
+        else:
+            run = pipeline.start()
+            self.stdout.write("{} is in progress; see /queue-status for its progress".format(run))
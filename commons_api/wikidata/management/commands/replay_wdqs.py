@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from commons_api.wikidata.recording import ReplayServer
+
+
+class Command(BaseCommand):
+    help = "Runs a stand-in WDQS that serves responses recorded with WDQS_RECORD_DIR"
+
+    def add_arguments(self, parser):
+        parser.add_argument('fixtures_directory')
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--latency', type=float, default=0,
+                            help="Seconds to wait before responding to each query")
+        parser.add_argument('--bytes-per-second', type=int, default=None,
+                            help="Limit on how fast each response is sent")
+
+    def handle(self, fixtures_directory, host, port, latency, bytes_per_second, **options):
+        server = ReplayServer((host, port), fixtures_directory, latency=latency, bytes_per_second=bytes_per_second)
+        self.stdout.write("Serving fixtures from {} at {}".format(fixtures_directory, server.url))
+        self.stdout.write("Set WDQS_URL={} for ingest tasks to use it".format(server.url))
+        started = time.monotonic()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        elapsed = time.monotonic() - started
+        self.stdout.write("Served {requests} queries ({missing} without fixtures) and {bytes} bytes".format(
+            **server.stats))
+        self.stdout.write("{:.2f} queries per second over {:.1f} seconds".format(
+            server.stats['requests'] / elapsed if elapsed else 0, elapsed))
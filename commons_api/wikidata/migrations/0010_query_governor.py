@@ -0,0 +1,32 @@
+# Generated by Django 2.1.5 on 2026-10-18 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wikidata', '0009_legislature_last_queued'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryGovernor',
+            fields=[
+                ('id', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('tokens', models.FloatField(default=0)),
+                ('tokens_updated', models.DateTimeField(blank=True, null=True)),
+                ('blocked_until', models.DateTimeField(blank=True, null=True)),
+                ('backoff', models.FloatField(default=1, help_text='Factor by which the permitted query rate is currently reduced')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='QueryLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('expires', models.DateTimeField(db_index=True)),
+                ('governor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wikidata.QueryGovernor')),
+            ],
+        ),
+    ]
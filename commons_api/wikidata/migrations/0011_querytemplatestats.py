@@ -0,0 +1,39 @@
+# Generated by Django 2.1.5 on 2026-10-18 11:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wikidata', '0010_query_governor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryTemplateStats',
+            fields=[
+                ('template', models.CharField(max_length=200, primary_key=True, serialize=False)),
+                ('queries', models.PositiveIntegerField(default=0)),
+                ('cache_hits', models.PositiveIntegerField(default=0)),
+                ('errors', models.PositiveIntegerField(default=0)),
+                ('timeouts', models.PositiveIntegerField(default=0)),
+                ('throttled', models.PositiveIntegerField(default=0)),
+                ('render_time', models.FloatField(default=0)),
+                ('latency', models.FloatField(default=0, help_text='Total time until response headers were received')),
+                ('duration', models.FloatField(default=0, help_text='Total time until results were consumed')),
+                ('max_duration', models.FloatField(default=0)),
+                ('slowest_context', models.CharField(blank=True, max_length=200)),
+                ('bytes', models.BigIntegerField(default=0)),
+                ('max_bytes', models.BigIntegerField(default=0)),
+                ('bindings', models.BigIntegerField(default=0)),
+                ('last_queried', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('last_error_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'query template stats',
+                'ordering': ('-duration',),
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.1.5 on 2026-10-18 12:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wikidata', '0011_querytemplatestats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='electoraldistrict',
+            name='fingerprint',
+            field=models.CharField(blank=True, editable=False, help_text='Hash of the data this was last refreshed from', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='legislativemembership',
+            name='fingerprint',
+            field=models.CharField(blank=True, editable=False, help_text='Hash of the data this was last refreshed from', max_length=40),
+        ),
+    ]
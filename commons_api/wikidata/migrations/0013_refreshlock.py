@@ -0,0 +1,29 @@
+# Generated by Django 2.1.5 on 2026-10-18 15:47
+
+import django.contrib.postgres.fields.jsonb
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wikidata', '0012_fingerprints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RefreshLock',
+            fields=[
+                ('id', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('task', models.CharField(max_length=200)),
+                ('object_id', models.CharField(max_length=64)),
+                ('queued_at', models.DateTimeField()),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('expires', models.DateTimeField(db_index=True)),
+                ('coalesced', models.PositiveIntegerField(default=0, help_text='Number of later requests merged into this one')),
+                ('rerun', models.BooleanField(default=False, help_text='Whether to refresh again once this refresh has finished, because it was requested again while running')),
+                ('rerun_kwargs', django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+            ],
+        ),
+    ]
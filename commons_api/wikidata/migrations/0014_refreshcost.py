@@ -0,0 +1,31 @@
+# Generated by Django 2.1.5 on 2026-10-18 17:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wikidata', '0013_refreshlock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RefreshCost',
+            fields=[
+                ('id', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('task', models.CharField(max_length=200)),
+                ('object_id', models.CharField(max_length=64)),
+                ('runs', models.PositiveIntegerField(default=0)),
+                ('duration', models.FloatField(default=0, help_text='Expected time to refresh, smoothed over recent runs')),
+                ('last_duration', models.FloatField(default=0)),
+                ('max_duration', models.FloatField(default=0)),
+                ('bindings', models.BigIntegerField(default=0, help_text='Query result bindings processed by the last run')),
+                ('peak_memory', models.BigIntegerField(default=0, help_text='Peak memory used by the worker process as of the end of the last run, in bytes')),
+                ('last_run', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ('-duration',),
+            },
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 2.1.5 on 2026-10-18 18:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wikidata', '0014_refreshcost'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='administrativearea',
+            name='wikidata_modified',
+            field=models.DateTimeField(blank=True, editable=False, help_text='When the item was last modified on Wikidata, as of its labels last being refreshed', null=True),
+        ),
+        migrations.AddField(
+            model_name='country',
+            name='wikidata_modified',
+            field=models.DateTimeField(blank=True, editable=False, help_text='When the item was last modified on Wikidata, as of its labels last being refreshed', null=True),
+        ),
+        migrations.AddField(
+            model_name='election',
+            name='wikidata_modified',
+            field=models.DateTimeField(blank=True, editable=False, help_text='When the item was last modified on Wikidata, as of its labels last being refreshed', null=True),
+        ),
+        migrations.AddField(
+            model_name='electoraldistrict',
+            name='wikidata_modified',
+            field=models.DateTimeField(blank=True, editable=False, help_text='When the item was last modified on Wikidata, as of its labels last being refreshed', null=True),
+        ),
+        migrations.AddField(
+            model_name='legislativehouse',
+            name='wikidata_modified',
+            field=models.DateTimeField(blank=True, editable=False, help_text='When the item was last modified on Wikidata, as of its labels last being refreshed', null=True),
+        ),
+        migrations.AddField(
+            model_name='legislativeterm',
+            name='wikidata_modified',
+            field=models.DateTimeField(blank=True, editable=False, help_text='When the item was last modified on Wikidata, as of its labels last being refreshed', null=True),
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='wikidata_modified',
+            field=models.DateTimeField(blank=True, editable=False, help_text='When the item was last modified on Wikidata, as of its labels last being refreshed', null=True),
+        ),
+        migrations.AddField(
+            model_name='person',
+            name='wikidata_modified',
+            field=models.DateTimeField(blank=True, editable=False, help_text='When the item was last modified on Wikidata, as of its labels last being refreshed', null=True),
+        ),
+        migrations.AddField(
+            model_name='position',
+            name='wikidata_modified',
+            field=models.DateTimeField(blank=True, editable=False, help_text='When the item was last modified on Wikidata, as of its labels last being refreshed', null=True),
+        ),
+        migrations.AddField(
+            model_name='term',
+            name='wikidata_modified',
+            field=models.DateTimeField(blank=True, editable=False, help_text='When the item was last modified on Wikidata, as of its labels last being refreshed', null=True),
+        ),
+        migrations.AddField(
+            model_name='legislativehouse',
+            name='refresh_districts_last_refreshed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='legislativehouse',
+            name='refresh_members_last_refreshed',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
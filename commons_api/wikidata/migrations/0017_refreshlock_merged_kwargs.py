@@ -0,0 +1,20 @@
+# Generated by Django 2.1.5 on 2026-10-18 21:05
+
+import django.contrib.postgres.fields.jsonb
+import django.core.serializers.json
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wikidata', '0016_pipeline'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='refreshlock',
+            name='merged_kwargs',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder, help_text='Keyword arguments of requests merged into this one while it was queued, which override those it was queued with'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.5 on 2026-10-18 21:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wikidata', '0017_refreshlock_merged_kwargs'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='refreshcost',
+            name='peak_memory',
+            field=models.BigIntegerField(blank=True, help_text='Peak memory used by the last run that was the first in its worker process, in bytes', null=True),
+        ),
+    ]
@@ -10,6 +10,7 @@ from django.core.validators import RegexValidator
 from django.db import models
 from django.contrib.postgres.fields import HStoreField, JSONField
 from django.urls import reverse, NoReverseMatch
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.utils.translation import gettext
 from dirtyfields import DirtyFieldsMixin
@@ -125,6 +126,9 @@ class WikidataItem(Moderateable, Timebound):
     wikipedia_article_titles = HStoreField(default=dict, blank=True)
 
     refresh_labels_last_queued = models.DateTimeField(null=True, blank=True)
+    wikidata_modified = models.DateTimeField(null=True, blank=True, editable=False,
+                                             help_text='When the item was last modified on Wikidata, as of its labels '
+                                                       'last being refreshed')
 
     objects = WikidataItemManager()
 
@@ -219,6 +223,8 @@ class LegislativeHouse(WikidataItem):
 
     refresh_members_last_queued = models.DateTimeField(null=True, blank=True)
     refresh_districts_last_queued = models.DateTimeField(null=True, blank=True)
+    refresh_members_last_refreshed = models.DateTimeField(null=True, blank=True)
+    refresh_districts_last_refreshed = models.DateTimeField(null=True, blank=True)
 
     def _filter_timebound_queryset(self, queryset, require_start=True, current=False, legislative_term=None):
         if require_start:
@@ -242,6 +248,8 @@ class ElectoralDistrict(Spatial, WikidataItem):
     legislative_house = models.ForeignKey(LegislativeHouse,
                                           blank=True, null=True,
                                           on_delete=models.CASCADE)
+    fingerprint = models.CharField(max_length=40, blank=True, editable=False,
+                                   help_text='Hash of the data this was last refreshed from')
 
 
 class LegislativeHouseTerm(Moderateable, models.Model):
@@ -252,8 +260,12 @@ class LegislativeHouseTerm(Moderateable, models.Model):
     number_of_seats = models.IntegerField(null=True, blank=True)
     number_of_districts = models.IntegerField(null=True, blank=True)
 
+    @staticmethod
+    def make_id(legislative_house_id, legislative_term_id):
+        return '{}/{}'.format(legislative_house_id, legislative_term_id)
+
     def save(self, *args, **kwargs):
-        self.id = '{}/{}'.format(self.legislative_house_id, self.legislative_term_id)
+        self.id = self.make_id(self.legislative_house_id, self.legislative_term_id)
         return super().save(*args, **kwargs)
 
 
@@ -287,6 +299,171 @@ class LegislativeMembership(Membership):
                                   related_name='end_cause_of_legislative_memberships')
     subject_has_role = models.ForeignKey(Term, null=True, blank=True, on_delete=models.CASCADE,
                                          related_name='subject_role_of_legislative_memberships')
+    fingerprint = models.CharField(max_length=40, blank=True, editable=False,
+                                   help_text='Hash of the data this was last refreshed from')
 
     class Meta:
         ordering = ('start', 'end')
+
+
+class QueryGovernor(models.Model):
+    """Rate-limiting state for a SPARQL endpoint, shared by every process that queries it
+
+    See :py:mod:`commons_api.wikidata.governor`."""
+    id = models.CharField(max_length=32, primary_key=True)
+    tokens = models.FloatField(default=0)
+    tokens_updated = models.DateTimeField(null=True, blank=True)
+    blocked_until = models.DateTimeField(null=True, blank=True)
+    backoff = models.FloatField(default=1, help_text='Factor by which the permitted query rate is currently reduced')
+
+
+class QueryLease(models.Model):
+    """A query in flight against a governed SPARQL endpoint"""
+    governor = models.ForeignKey(QueryGovernor, on_delete=models.CASCADE)
+    expires = models.DateTimeField(db_index=True)
+
+
+class RefreshLock(models.Model):
+    """Marks a refresh task as queued or running for an object, so that duplicate requests can be coalesced
+
+    See :py:mod:`commons_api.wikidata.coalescing`."""
+    id = models.CharField(max_length=255, primary_key=True)
+    task = models.CharField(max_length=200)
+    object_id = models.CharField(max_length=64)
+    queued_at = models.DateTimeField()
+    started_at = models.DateTimeField(null=True, blank=True)
+    expires = models.DateTimeField(db_index=True)
+    coalesced = models.PositiveIntegerField(default=0, help_text='Number of later requests merged into this one')
+    rerun = models.BooleanField(default=False, help_text='Whether to refresh again once this refresh has finished, '
+                                                         'because it was requested again while running')
+    rerun_kwargs = JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder)
+    merged_kwargs = JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder,
+                              help_text='Keyword arguments of requests merged into this one while it was queued, which '
+                                        'override those it was queued with')
+
+    @staticmethod
+    def make_id(task, object_id):
+        return '{}:{}'.format(task, object_id)
+
+    def __str__(self):
+        return self.id
+
+
+class RefreshCost(models.Model):
+    """What it costs to refresh an object with a task, used to route and order refreshes
+
+    See :py:mod:`commons_api.wikidata.costs`. Times are in seconds."""
+    id = models.CharField(max_length=255, primary_key=True)
+    task = models.CharField(max_length=200)
+    object_id = models.CharField(max_length=64)
+    runs = models.PositiveIntegerField(default=0)
+    duration = models.FloatField(default=0, help_text='Expected time to refresh, smoothed over recent runs')
+    last_duration = models.FloatField(default=0)
+    max_duration = models.FloatField(default=0)
+    bindings = models.BigIntegerField(default=0, help_text='Query result bindings processed by the last run')
+    peak_memory = models.BigIntegerField(null=True, blank=True,
+                                         help_text='Peak memory used by the last run that was the first in its worker '
+                                                   'process, in bytes')
+    last_run = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('-duration',)
+
+    @staticmethod
+    def make_id(task, object_id):
+        return '{}:{}'.format(task, object_id)
+
+    def __str__(self):
+        return self.id
+
+    @property
+    def heavy(self):
+        return self.duration >= settings.WIKIDATA_HEAVY_TASK_DURATION
+
+
+class PipelineRun(models.Model):
+    """A run of the bootstrap pipeline, which refreshes everything in order, a stage at a time
+
+    See :py:mod:`commons_api.wikidata.tasks.pipeline`."""
+    RUNNING, FINISHED = 'running', 'finished'
+    STATUS_CHOICES = ((RUNNING, 'Running'), (FINISHED, 'Finished'))
+
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=RUNNING)
+    last_activity = models.DateTimeField(default=timezone.now, db_index=True,
+                                         help_text='When a stage last started or refreshed an object')
+
+    class Meta:
+        ordering = ('-started_at',)
+
+    def __str__(self):
+        return 'Bootstrap #{}'.format(self.id)
+
+
+class PipelineStage(models.Model):
+    """The progress of a stage of a :py:class:`PipelineRun`"""
+    PENDING, RUNNING, FINISHED = 'pending', 'running', 'finished'
+    STATUS_CHOICES = ((PENDING, 'Pending'), (RUNNING, 'Running'), (FINISHED, 'Finished'))
+
+    run = models.ForeignKey(PipelineRun, on_delete=models.CASCADE, related_name='stages')
+    name = models.CharField(max_length=50)
+    position = models.PositiveIntegerField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    queued_at = models.DateTimeField(null=True, blank=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    total = models.PositiveIntegerField(default=0)
+    done = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    skipped = models.PositiveIntegerField(default=0, help_text='Objects already being refreshed outside the pipeline')
+
+    class Meta:
+        ordering = ('run', 'position')
+        unique_together = (('run', 'name'),)
+
+    def __str__(self):
+        return '{}: {}'.format(self.run, self.name)
+
+    @property
+    def remaining(self):
+        return max(self.total - self.done - self.failed - self.skipped, 0)
+
+
+class QueryTemplateStats(models.Model):
+    """Running totals of the cost of queries made with a SPARQL query template
+
+    See :py:mod:`commons_api.wikidata.instrumentation`. Times are in seconds, and don't include queries answered from
+    the cache."""
+    template = models.CharField(max_length=200, primary_key=True)
+    queries = models.PositiveIntegerField(default=0)
+    cache_hits = models.PositiveIntegerField(default=0)
+    errors = models.PositiveIntegerField(default=0)
+    timeouts = models.PositiveIntegerField(default=0)
+    throttled = models.PositiveIntegerField(default=0)
+    render_time = models.FloatField(default=0)
+    latency = models.FloatField(default=0, help_text='Total time until response headers were received')
+    duration = models.FloatField(default=0, help_text='Total time until results were consumed')
+    max_duration = models.FloatField(default=0)
+    slowest_context = models.CharField(max_length=200, blank=True)
+    bytes = models.BigIntegerField(default=0)
+    max_bytes = models.BigIntegerField(default=0)
+    bindings = models.BigIntegerField(default=0)
+    last_queried = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    last_error_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('-duration',)
+        verbose_name_plural = 'query template stats'
+
+    def __str__(self):
+        return self.template
+
+    @property
+    def mean_duration(self):
+        return self.duration / self.queries if self.queries else None
+
+    @property
+    def mean_bytes(self):
+        return self.bytes / self.queries if self.queries else None
@@ -0,0 +1,108 @@
+"""
+Progress reporting for long-running ingest tasks
+
+Tasks publish their progress as the custom Celery task state ``PROGRESS``, whose metadata is stored with the task's
+result and shown on the queue status page. The metadata has the current `phase` (e.g. ``'fetch'`` or ``'write'``),
+the number of `rows` processed in that phase, the `total` expected (where known), the `rate` in rows per second, the
+`elapsed` seconds, and an `eta` in seconds (where the total is known).
+
+Progress is published at most every `settings.INGEST_PROGRESS_INTERVAL` seconds, so that reporting doesn't slow the
+task down. When a task is called directly, rather than by a worker, progress is only logged, unless it is called from
+within a task that is, with :py:func:`published_as`.
+"""
+
+import contextlib
+import logging
+import threading
+import time
+
+import celery
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+PROGRESS = 'PROGRESS'
+
+_published_as = threading.local()
+
+
+@contextlib.contextmanager
+def published_as(task):
+    """Publishes the progress of tasks called directly within this as the progress of `task`
+
+    Tasks that call another task directly for each of several objects (e.g. batch tasks) use this, as a task called
+    directly has no request of its own to publish its progress with."""
+    previous = getattr(_published_as, 'task', None)
+    _published_as.task = task
+    try:
+        yield
+    finally:
+        _published_as.task = previous
+
+
+class Progress:
+    """Tracks and publishes the progress of the current task through its phases
+
+    Usage:
+
+    progress = Progress('refresh_members Q11005')
+    progress.phase('fetch')
+    for row in progress.iterate(results):
+        …
+    progress.phase('write', total=len(memberships))
+    …
+    progress.finish()
+    """
+    def __init__(self, description, task=None):
+        self.description = description
+        self.task = task or getattr(_published_as, 'task', None) or celery.current_task
+        self.start = time.monotonic()
+        self.last_published = self.start
+        self.name, self.rows, self.total, self.phase_start = None, 0, None, self.start
+
+    def phase(self, name, total=None):
+        """Starts a new phase, logging how the last one went"""
+        if self.name:
+            self.log()
+        self.name, self.rows, self.total, self.phase_start = name, 0, total, time.monotonic()
+        self.publish()
+
+    def iterate(self, iterable):
+        """Yields from `iterable`, counting each item as a row processed"""
+        for item in iterable:
+            yield item
+            self.advance()
+
+    def advance(self, rows=1):
+        self.rows += rows
+        if time.monotonic() - self.last_published >= settings.INGEST_PROGRESS_INTERVAL:
+            self.publish()
+
+    def finish(self):
+        """Logs the last phase, and the total time taken"""
+        if self.name:
+            self.log()
+        logger.info("%s: finished in %.1fs", self.description, time.monotonic() - self.start)
+
+    @property
+    def meta(self):
+        now = time.monotonic()
+        elapsed = now - self.phase_start
+        rate = self.rows / elapsed if elapsed > 0 else None
+        if self.total is not None and rate:
+            eta = max(self.total - self.rows, 0) / rate
+        else:
+            eta = None
+        return {'description': self.description, 'phase': self.name, 'rows': self.rows, 'total': self.total,
+                'rate': rate, 'elapsed': now - self.start, 'eta': eta}
+
+    def log(self):
+        meta = self.meta
+        logger.info("%s: %s phase processed %d rows (%s rows/s)", self.description, meta['phase'], meta['rows'],
+                    '{:.1f}'.format(meta['rate']) if meta['rate'] is not None else '-')
+
+    def publish(self):
+        self.last_published = time.monotonic()
+        if self.task is None or self.task.request.called_directly:
+            return
+        self.task.update_state(state=PROGRESS, meta=self.meta)
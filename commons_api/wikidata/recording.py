@@ -0,0 +1,127 @@
+"""
+Recording and replaying of WDQS responses, for running ingest tasks without access to the real WDQS
+
+If `settings.WDQS_RECORD_DIR` is set, every successful response from WDQS is saved there as a fixture, keyed on the
+query and the result format requested. A directory of fixtures can then be served by a stand-in WDQS, started with
+``manage.py replay_wdqs``, with `settings.WDQS_URL` pointed at it. The stand-in can add latency and limit bandwidth,
+so that ingest throughput can be measured reproducibly.
+"""
+
+import hashlib
+import http.client
+import http.server
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+
+def fixture_key(query, accept):
+    return hashlib.sha256('{}\n{}'.format(accept, query).encode()).hexdigest()
+
+
+def save_fixture(directory, query, accept, body, content_type):
+    """Saves a response body as a fixture for the given query and Accept header"""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, fixture_key(query, accept))
+    with open(path + '.body', 'wb') as f:
+        f.write(body)
+    with open(path + '.json', 'w') as f:
+        json.dump({'query': query, 'accept': accept, 'content_type': content_type}, f, indent=2)
+
+
+def record_response(directory, query, accept, response):
+    """Saves a `requests` response as a fixture
+
+    This reads the whole response body, which `requests` then keeps, so the response can still be streamed afterwards.
+    """
+    save_fixture(directory, query, accept, response.content, response.headers.get('Content-Type', accept))
+
+
+def load_fixture(directory, query, accept):
+    """Returns the body and content type recorded for a query, or raises FileNotFoundError"""
+    path = os.path.join(directory, fixture_key(query, accept))
+    with open(path + '.json') as f:
+        metadata = json.load(f)
+    with open(path + '.body', 'rb') as f:
+        return f.read(), metadata['content_type']
+
+
+class ReplayRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handles SPARQL protocol requests, responding with recorded fixtures"""
+    server_version = 'WDQSReplay/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query).get('query', [''])[0]
+        self.respond(query)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        query = urllib.parse.parse_qs(self.rfile.read(length).decode()).get('query', [''])[0]
+        self.respond(query)
+
+    def respond(self, query):
+        server = self.server
+        accept = self.headers.get('Accept', 'application/sparql-results+json')
+        time.sleep(server.latency)
+        try:
+            body, content_type = load_fixture(server.fixtures_directory, query, accept)
+        except FileNotFoundError:
+            logger.warning("No fixture for query with key %s", fixture_key(query, accept))
+            server.record_request(missing=True)
+            body = b'No fixture recorded for this query'
+            self.send_response(http.client.NOT_FOUND)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.send_response(http.client.OK)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        chunk_size = 64 * 1024
+        for start in range(0, len(body), chunk_size):
+            self.wfile.write(body[start:start + chunk_size])
+            if server.bytes_per_second:
+                time.sleep(chunk_size / server.bytes_per_second)
+        server.record_request(sent=len(body))
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class ReplayServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """A stand-in WDQS that serves recorded fixtures
+
+    :param fixtures_directory: A directory of fixtures, as written when `settings.WDQS_RECORD_DIR` is set
+    :param latency: Seconds to wait before responding to each request
+    :param bytes_per_second: If given, limits how fast each response body is sent
+    """
+    daemon_threads = True
+
+    def __init__(self, server_address, fixtures_directory, latency=0, bytes_per_second=None):
+        super().__init__(server_address, ReplayRequestHandler)
+        self.fixtures_directory = fixtures_directory
+        self.latency = latency
+        self.bytes_per_second = bytes_per_second
+        self.stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'missing': 0, 'bytes': 0}
+
+    def record_request(self, sent=0, missing=False):
+        with self.stats_lock:
+            self.stats['requests'] += 1
+            self.stats['missing'] += int(missing)
+            self.stats['bytes'] += sent
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}/sparql'.format(host, port)
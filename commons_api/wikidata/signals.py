@@ -0,0 +1,17 @@
+"""
+Signals sent by ingest tasks, for anything that needs to know precisely what changed (e.g. to invalidate caches)
+
+Tasks write in bulk, so the usual model signals aren't sent for each object they change.
+"""
+
+import django.dispatch
+
+#: Sent by :py:func:`commons_api.wikidata.tasks.refresh_districts` when a legislative house's electoral districts have
+#: changed, with `sender` as :py:class:`commons_api.wikidata.models.LegislativeHouse`, and `house` and the `created`,
+#: `updated` and `removed` lists of district IDs as keyword arguments. Removed districts still exist, but are no
+#: longer linked to the house.
+districts_changed = django.dispatch.Signal()
+
+#: Sent by :py:mod:`commons_api.wikidata.tasks.pipeline` when the last stage of a bootstrap pipeline run has finished,
+#: with `sender` as :py:class:`commons_api.wikidata.models.PipelineRun`, and the `run` as a keyword argument.
+bootstrap_finished = django.dispatch.Signal()
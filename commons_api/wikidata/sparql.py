@@ -0,0 +1,16 @@
+"""
+Rendering of SPARQL query templates
+
+Queries are Django templates under `templates/wikidata/query/`, loaded through the configured template loaders, which
+compile each once per process unless `DEBUG` is on. Lists of Wikidata items for VALUES blocks should be rendered with
+the `wikidata_values` and `wikidata_value_rows` filters from the `sparql` template tag library, which join them into a
+single string rather than looping over them in the template. This keeps rendering a query for thousands of items
+cheap, and ensures that only well-formed item IDs end up in queries.
+"""
+
+from django.template.loader import get_template
+
+
+def render_query(query_name, context):
+    """Renders the SPARQL query template `query_name` with `context`"""
+    return get_template(query_name).render(context)
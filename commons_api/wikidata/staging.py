@@ -0,0 +1,339 @@
+"""
+Set-based ingest through staging tables, for legislative houses too large for even bulk ORM writes
+
+When `settings.WIKIDATA_INGEST_MODE` is ``'staging'``, :py:func:`commons_api.wikidata.tasks.refresh_members` and
+:py:func:`commons_api.wikidata.tasks.refresh_districts` stream query results with ``COPY`` into temporary staging
+tables, which PostgreSQL doesn't write to its WAL. Everything is then merged from there in a handful of set-based SQL
+statements within one transaction: creating missing items, upserting, reconciling many-to-many relations and
+removing stale rows.
+
+Query results are spooled to a temporary file before that transaction is opened, so that the query itself runs
+outside it. Otherwise the governor's, instrumentation's and progress reporting's writes would hold their locks and stay
+invisible to other workers until the merge commits.
+
+Rows are only updated where something has actually changed. Fingerprints aren't computed in this mode, so they are
+cleared on anything written, and everything is written once when switching back to the default ``'bulk'`` mode.
+"""
+
+import tempfile
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import models
+from .utils import item_uri_to_id, statement_uri_to_id, get_date
+
+INDEPENDENT = 'Q327591'
+
+MEMBERSHIP_STAGING_COLUMNS = [
+    ('ordinal', 'integer'),
+    ('statement', 'text'),
+    ('person', 'text'),
+    ('person_label', 'text'),
+    ('grp', 'text'),
+    ('grp_label', 'text'),
+    ('party', 'text'),
+    ('party_label', 'text'),
+    ('district', 'text'),
+    ('district_label', 'text'),
+    ('role', 'text'),
+    ('term', 'text'),
+    ('term_label', 'text'),
+    ('start', 'date'),
+    ('"end"', 'date'),
+    ('end_cause', 'text'),
+    ('end_cause_label', 'text'),
+    ('subject_has_role', 'text'),
+    ('subject_has_role_label', 'text'),
+]
+
+# Spooled rows are kept in memory up to this many characters, and written to disk beyond that
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+DISTRICT_STAGING_COLUMNS = [
+    ('ordinal', 'integer'),
+    ('id', 'text'),
+    ('label', 'text'),
+    ('start', 'date'),
+    ('"end"', 'date'),
+]
+
+
+def enabled():
+    """Whether ingest tasks should merge through staging tables
+
+    This needs PostgreSQL, and isn't used when moderation is enabled, as every change then needs to be queued for
+    moderation individually."""
+    return (settings.WIKIDATA_INGEST_MODE == 'staging' and connection.vendor == 'postgresql'
+            and not settings.ENABLE_MODERATION)
+
+
+def copy_value(value):
+    """Encodes a value for ``COPY … FROM`` in text format"""
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class CopyFile:
+    """A read-only file-like object over rows, encoded for ``COPY … FROM`` in text format
+
+    Rows are encoded as they are read, so that results can be spooled without being held in memory."""
+    def __init__(self, rows):
+        self.lines = ('\t'.join(map(copy_value, row)) + '\n' for row in rows)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        chunks, length = [self.buffer], len(self.buffer)
+        while size < 0 or length < size:
+            try:
+                line = next(self.lines)
+            except StopIteration:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = ''.join(chunks)
+        if size < 0:
+            size = len(data)
+        data, self.buffer = data[:size], data[size:]
+        return data
+
+
+def spool(rows):
+    """Reads all of `rows` into a temporary file, encoded for ``COPY … FROM`` in text format
+
+    :returns: The file, ready to be read from the start
+    """
+    file, copy_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode='w+'), CopyFile(rows)
+    for chunk in iter(lambda: copy_file.read(64 * 1024), ''):
+        file.write(chunk)
+    file.seek(0)
+    return file
+
+
+def _create_staging_table(cursor, name, columns):
+    cursor.execute('DROP TABLE IF EXISTS pg_temp.{}'.format(name))
+    cursor.execute('CREATE TEMPORARY TABLE {} ({}) ON COMMIT DROP'.format(
+        name, ', '.join('{} {}'.format(column, type) for column, type in columns)))
+
+
+def _copy(cursor, table, columns, file):
+    cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(table, ', '.join(column for column, type in columns)), file)
+    cursor.execute('ANALYZE {}'.format(table))
+
+
+def _insert_select(model, expressions, source, values=None, on_conflict='DO NOTHING'):
+    """Returns SQL and parameters to insert rows into `model`'s table from a query
+
+    `expressions` maps field names to SQL expressions over `source`, and `values` maps field names to constant values.
+    Other fields take their defaults. `source` and `on_conflict` mustn't contain parameters.
+    """
+    meta, quote_name = model._meta, connection.ops.quote_name
+    values = values or {}
+    columns, selects, params = [], [], []
+    for field in meta.concrete_fields:
+        columns.append(quote_name(field.column))
+        if field.name in expressions:
+            selects.append(expressions[field.name])
+        else:
+            selects.append('%s')
+            value = values[field.name] if field.name in values else field.get_default()
+            params.append(field.get_db_prep_save(value, connection))
+    sql = 'INSERT INTO {} AS existing ({}) SELECT {} FROM {} ON CONFLICT ({}) {}'.format(
+        quote_name(meta.db_table), ', '.join(columns), ', '.join(selects), source, quote_name(meta.pk.column),
+        on_conflict)
+    return sql, params
+
+
+def _update_changed(model, field_names, also_set=()):
+    """Returns an ON CONFLICT clause that updates the given fields, but only on rows where they have changed"""
+    quote_name = connection.ops.quote_name
+    columns = [quote_name(model._meta.get_field(name).column) for name in field_names]
+    also_set = [quote_name(model._meta.get_field(name).column) for name in also_set]
+    return 'DO UPDATE SET {} WHERE ({}) IS DISTINCT FROM ({})'.format(
+        ', '.join('{0} = EXCLUDED.{0}'.format(column) for column in columns + also_set),
+        ', '.join('existing.' + column for column in columns),
+        ', '.join('EXCLUDED.' + column for column in columns))
+
+
+def _insert_missing_items(cursor, model, source):
+    """Creates any Wikidata items of `model` that don't exist yet, from a query selecting `id`, `label` and `ordinal`
+
+    Where an item appears more than once, the label from the row with the lowest ordinal is used."""
+    sql, params = _insert_select(model, {'id': 'id', 'labels': "hstore('en', label)"},
+                                 '(SELECT DISTINCT ON (id) id, label FROM ({}) AS items WHERE id IS NOT NULL '
+                                 'ORDER BY id, ordinal) AS items'.format(source))
+    cursor.execute(sql, params)
+
+
+def _membership_staging_rows(rows):
+    def item(term):
+        return item_uri_to_id(term) if term else None
+
+    # This mirrors how refresh_members interprets each row
+    for ordinal, row in enumerate(rows):
+        yield (ordinal, statement_uri_to_id(row.statement), item(row.person), row.personLabel,
+               item(row.group), row.groupLabel, item(row.party), row.partyLabel,
+               item(row.district) if row.districtLabel is not None else None, row.districtLabel,
+               item(row.role),
+               item(row.term) if row.termLabel is not None else None, row.termLabel,
+               get_date(row.start), get_date(row.end),
+               item(row.endCause) if getattr(row.endCauseLabel, 'type', None) == 'uri' else None, row.endCauseLabel,
+               item(row.subjectHasRole) if row.subjectHasRoleLabel is not None else None, row.subjectHasRoleLabel)
+
+
+def merge_memberships(house, rows, progress=None):
+    """Merges the results of ``legislature_memberships.rq``, as TSV rows, into the memberships of `house`
+
+    If a :py:class:`commons_api.wikidata.progress.Progress` is given, a write phase is started once the rows have been
+    read.
+
+    :returns: A summary, with the number of memberships listed, and the numbers written and removed
+    """
+    Membership = models.LegislativeMembership
+    through = Membership.legislative_terms.through
+    field = Membership._meta.get_field('legislative_terms')
+    quote_name = connection.ops.quote_name
+    tables = {
+        'membership': quote_name(Membership._meta.db_table),
+        'through': quote_name(through._meta.db_table),
+        'source': quote_name(through._meta.get_field(field.m2m_field_name()).column),
+        'target': quote_name(through._meta.get_field(field.m2m_reverse_field_name()).column),
+        'legislative_term': quote_name(models.LegislativeTerm._meta.db_table),
+        'house': quote_name(Membership._meta.get_field('legislative_house').column),
+    }
+
+    staged = spool(_membership_staging_rows(rows))
+    if progress:
+        progress.phase('write')
+
+    with staged, transaction.atomic(), connection.cursor() as cursor:
+        _create_staging_table(cursor, 'membership_staging', MEMBERSHIP_STAGING_COLUMNS)
+        _copy(cursor, 'membership_staging', MEMBERSHIP_STAGING_COLUMNS, staged)
+
+        for model, id_column, label_column in ((models.Person, 'person', 'person_label'),
+                                               (models.ElectoralDistrict, 'district', 'district_label'),
+                                               (models.Term, 'end_cause', 'end_cause_label'),
+                                               (models.Term, 'subject_has_role', 'subject_has_role_label'),
+                                               (models.LegislativeTerm, 'term', 'term_label'),
+                                               (models.Organization, 'grp', 'grp_label'),
+                                               (models.Organization, 'party', 'party_label')):
+            _insert_missing_items(cursor, model, "SELECT {} AS id, {} AS label, ordinal FROM membership_staging "
+                                                 "WHERE {} <> '{}'".format(id_column, label_column, id_column,
+                                                                           INDEPENDENT))
+
+        # One row per statement, from its first row. Memberships without their own dates take them from their
+        # legislative terms.
+        cursor.execute('DROP TABLE IF EXISTS pg_temp.membership_merge')
+        cursor.execute("""
+            CREATE TEMPORARY TABLE membership_merge ON COMMIT DROP AS
+            SELECT DISTINCT ON (statement) statement, person, district, role, end_cause, subject_has_role,
+                   NULLIF(grp, %(independent)s) AS parliamentary_group,
+                   COALESCE(NULLIF(party, %(independent)s), NULLIF(grp, %(independent)s)) AS party,
+                   COALESCE(%(independent)s IN (grp, party), FALSE) AS independent,
+                   start, "end"
+            FROM membership_staging
+            ORDER BY statement, ordinal""", {'independent': INDEPENDENT})
+        cursor.execute("""
+            UPDATE membership_merge
+            SET start = COALESCE(membership_merge.start, term_dates.start),
+                "end" = COALESCE(membership_merge."end", term_dates."end")
+            FROM (SELECT membership_staging.statement, min(legislative_term.start) AS start,
+                         min(legislative_term."end") AS "end"
+                  FROM membership_staging
+                  JOIN {legislative_term} AS legislative_term ON legislative_term.id = membership_staging.term
+                  GROUP BY membership_staging.statement) AS term_dates
+            WHERE term_dates.statement = membership_merge.statement""".format(**tables))
+        cursor.execute('SELECT count(*) FROM membership_merge')
+        count = cursor.fetchone()[0]
+
+        fields = ['person', 'district', 'legislative_house', 'subject_has_role', 'end_cause', 'start', 'end',
+                  'position', 'independent', 'parliamentary_group', 'party']
+        sql, params = _insert_select(Membership,
+                                     {'id': 'statement', 'person': 'person', 'district': 'district',
+                                      'position': 'role', 'end_cause': 'end_cause',
+                                      'subject_has_role': 'subject_has_role',
+                                      'parliamentary_group': 'parliamentary_group', 'party': 'party',
+                                      'independent': 'independent', 'start': 'start', 'end': '"end"'},
+                                     'membership_merge',
+                                     values={'legislative_house': house.id, 'fingerprint': ''},
+                                     on_conflict=_update_changed(Membership, fields, also_set=['fingerprint']))
+        cursor.execute(sql, params)
+        written = cursor.rowcount
+
+        # Relations to legislative terms, including those of stale memberships, which are deleted below
+        cursor.execute("""
+            DELETE FROM {through} AS through USING {membership} AS membership
+            WHERE through.{source} = membership.id AND membership.{house} = %s
+              AND NOT EXISTS (SELECT 1 FROM membership_staging
+                              WHERE membership_staging.statement = through.{source}
+                                AND membership_staging.term = through.{target})""".format(**tables), [house.id])
+        cursor.execute("""
+            INSERT INTO {through} ({source}, {target})
+            SELECT DISTINCT statement, term FROM membership_staging
+            WHERE term IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM {through} AS through
+                              WHERE through.{source} = membership_staging.statement
+                                AND through.{target} = membership_staging.term)""".format(**tables))
+
+        cursor.execute("""
+            DELETE FROM {membership} AS membership
+            WHERE membership.{house} = %s
+              AND NOT EXISTS (SELECT 1 FROM membership_merge
+                              WHERE membership_merge.statement = membership.id)""".format(**tables), [house.id])
+        removed = cursor.rowcount
+
+    return {'memberships': count, 'written': written, 'removed': removed}
+
+
+def merge_districts(house, rows, progress=None):
+    """Merges the results of ``legislature_constituencies.rq``, as TSV rows, into the electoral districts of `house`
+
+    As with the default ingest mode, districts no longer returned are unlinked from the house rather than deleted. As
+    with :py:func:`merge_memberships`, a `progress` may be given.
+
+    :returns: A tuple of the number of districts listed, and lists of the IDs of those created, updated and removed
+    """
+    District = models.ElectoralDistrict
+    quote_name = connection.ops.quote_name
+    tables = {
+        'district': quote_name(District._meta.db_table),
+        'house': quote_name(District._meta.get_field('legislative_house').column),
+        'fingerprint': quote_name(District._meta.get_field('fingerprint').column),
+    }
+
+    staged = spool((ordinal, item_uri_to_id(row.constituency), row.constituencyLabel, get_date(row.start),
+                    get_date(row.end))
+                   for ordinal, row in enumerate(rows))
+    if progress:
+        progress.phase('write')
+
+    with staged, transaction.atomic(), connection.cursor() as cursor:
+        _create_staging_table(cursor, 'district_staging', DISTRICT_STAGING_COLUMNS)
+        _copy(cursor, 'district_staging', DISTRICT_STAGING_COLUMNS, staged)
+        cursor.execute('SELECT count(DISTINCT id) FROM district_staging')
+        count = cursor.fetchone()[0]
+
+        # Where a district has more than one row, the last one wins. xmax is zero for rows that were inserted.
+        sql, params = _insert_select(District,
+                                     {'id': 'id', 'labels': "hstore('en', label)", 'start': 'start',
+                                      'end': '"end"'},
+                                     '(SELECT DISTINCT ON (id) * FROM district_staging '
+                                     'ORDER BY id, ordinal DESC) AS districts',
+                                     values={'legislative_house': house.id, 'fingerprint': ''},
+                                     on_conflict=_update_changed(District, ['start', 'end', 'legislative_house'],
+                                                                 also_set=['fingerprint']))
+        cursor.execute(sql + ' RETURNING id, xmax = 0', params)
+        written = cursor.fetchall()
+
+        cursor.execute("""
+            UPDATE {district} AS district SET {house} = NULL, {fingerprint} = ''
+            WHERE district.{house} = %s
+              AND NOT EXISTS (SELECT 1 FROM district_staging WHERE district_staging.id = district.id)
+            RETURNING district.id""".format(**tables), [house.id])
+        removed = cursor.fetchall()
+
+    return (count,
+            sorted(id for id, inserted in written if inserted),
+            sorted(id for id, inserted in written if not inserted),
+            sorted(id for id, in removed))
@@ -3,4 +3,5 @@ Celery tasks for pulling in data from Wikidata
 """
 from .country import *
 from .legislature import *
+from .pipeline import *
 from .wikidata_item import *
@@ -1,13 +1,20 @@
 import datetime
 import inspect
+import logging
+import random
 
 import celery
 from django.apps import apps
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.db.models import Q
 from django.utils import timezone
 
-from .. import models
+from .. import coalescing, costs, models, progress
+from ..governor import WDQSThrottled
+from ..utils import split_every
+
+logger = logging.getLogger(__name__)
 
 
 def get_wikidata_model_by_name(app_label, model, superclass=models.WikidataItem):
@@ -22,8 +29,50 @@ def get_wikidata_models(superclass=models.WikidataItem):
     return [model for model in apps.get_models() if issubclass(model, superclass)]
 
 
+class WikidataQueryTask(celery.Task):
+    """Base class for tasks that query WDQS
+
+    If WDQS is throttling us, the task is rescheduled for after it's expected to let us through again, instead of
+    failing. Some random jitter is added so that rescheduled tasks don't all come back at once.
+
+    For refresh tasks queued through :py:mod:`commons_api.wikidata.coalescing`, any arguments of requests merged into
+    the task while it was queued are applied when it starts. The object's lock is released when the task finishes (but
+    not when it's rescheduled), and the object is queued again if that was requested meanwhile. The cost of refreshing
+    the object is recorded; see :py:mod:`commons_api.wikidata.costs`.
+
+    Usage:
+
+    @celery.shared_task(base=WikidataQueryTask)
+    def refresh_something(…):
+        …
+    """
+    max_retries = settings.WDQS_THROTTLED_MAX_RETRIES
+
+    def __call__(self, *args, **kwargs):
+        measured = hasattr(self, 'queued_model') and 'id' in kwargs
+        coalesced = measured and 'queued_at' in kwargs
+        if coalesced:
+            kwargs.update(coalescing.start(self.name, kwargs['id'], kwargs['queued_at']))
+        throttled = False
+        try:
+            if measured:
+                with costs.measure(self.name, kwargs['id']):
+                    return super().__call__(*args, **kwargs)
+            return super().__call__(*args, **kwargs)
+        except WDQSThrottled as e:
+            throttled = True
+            raise self.retry(exc=e, countdown=e.retry_after * random.uniform(1, 1.5))
+        finally:
+            if coalesced and not throttled:
+                rerun_kwargs = coalescing.release(self.name, kwargs['id'], kwargs['queued_at'])
+                if rerun_kwargs is not None:
+                    coalescing.enqueue(self, kwargs['id'], **rerun_kwargs)
+
+
 def with_periodic_queuing_task(last_queued_attribute=None,
-                               superclass=models.WikidataItem):
+                               superclass=models.WikidataItem,
+                               batch_size=None,
+                               changed=None):
     """A decorator that creates a task that will call the decorated task for objects that haven't been refreshed recently
 
     Usage:
@@ -43,13 +92,28 @@ def with_periodic_queuing_task(last_queued_attribute=None,
     The decorated task can take the following parameters:
 
     * queued_at (required):
-    * id (optional): A Wikidata ID. If this is present, the task will be queued once per object. If it is absent,
+    * id (optional): A Wikidata ID. If this is present, the task will be queued for each object. If it is absent,
           it is assumed that the task can find all items to act upon based on `queued_at`.
 
+    For tasks that take an `id`, objects that already have the task queued or running are skipped; see
+    :py:mod:`commons_api.wikidata.coalescing`. Other objects are queued cheapest first, in batches, each handled by one
+    invocation of a batch task (which is available as `task.batch_task`). This calls the task for each object in turn,
+    sharing the worker's connections and caches, and avoids flooding the broker with a message per object. Their
+    progress is published as the batch task's; see :py:func:`commons_api.wikidata.progress.published_as`. If WDQS
+    throttles the batch, the objects not yet refreshed are queued again as a new batch for when it's expected to let us
+    through again. Objects that are expensive to refresh are instead queued individually on the heavy queue; see
+    :py:mod:`commons_api.wikidata.costs`.
+
 
     :param last_queued_attribute: The name of the attribute which records when an object was last queued to have the
         decorated task act upon it. If omitted, defaults to the name of the task with '_last_queued' appended
     :param superclass: A model superclass for which the task is relevant
+    :param batch_size: The number of objects in each batch, defaulting to `settings.WIKIDATA_QUEUING_BATCH_SIZE`. If
+        1, the task itself is queued once per object.
+    :param changed: For tasks that take an `id`, a function taking a model and a list of object IDs, and returning
+        those whose data on Wikidata may have changed since they were last refreshed; see
+        :py:mod:`commons_api.wikidata.changes`. The task is only queued for those, and the others are skipped until
+        they're next due.
     :returns: A decorator, which can be applied to a celery task
     """
     if callable(last_queued_attribute):
@@ -81,6 +145,23 @@ def with_periodic_queuing_task(last_queued_attribute=None,
                 # Find all objects that haven't been queued recently, or have never been queued.
                 queryset = model.objects.filter(Q(**{last_queued_attribute + '__lt': last_queued_threshold}) |
                                                 Q(**{last_queued_attribute + '__isnull': True}))
+                # Skip any that already have the task queued or running, leaving their last-queued time alone so that
+                # the pending task still finds them
+                if 'id' in task_signature.parameters:
+                    queryset = model.objects.filter(id__in=coalescing.acquire(
+                        task.name, queryset.values_list('id', flat=True), queued_at))
+                    # Also skip any whose data hasn't changed, recording them as queued so that they're not checked
+                    # again until they're next due
+                    if changed and settings.WIKIDATA_INCREMENTAL_REFRESH:
+                        object_ids = list(queryset.values_list('id', flat=True))
+                        try:
+                            unchanged_ids = set(object_ids) - set(changed(model, object_ids)) if object_ids else set()
+                        except Exception:
+                            coalescing.release_many(task.name, object_ids, queued_at)
+                            raise
+                        coalescing.release_many(task.name, unchanged_ids, queued_at)
+                        queryset.filter(id__in=unchanged_ids).update(**{last_queued_attribute: queued_at})
+                        queryset = queryset.exclude(id__in=unchanged_ids)
                 # Try to update any matching objects, and if any have been updated, we'll be queuing the task for them.
                 if queryset.update(**{last_queued_attribute: queued_at}) > 0:
                     task_kwargs = {'queued_at': queued_at}
@@ -94,18 +175,51 @@ def with_periodic_queuing_task(last_queued_attribute=None,
                     # As per the docstring, if the task takes an `id` parameter, we need to queue the task for each
                     # object individually.
                     if 'id' in task_signature.parameters:
-                        filter_kwargs = {last_queued_attribute: queued_at}
-                        for item_id in model.objects.filter(**filter_kwargs).values_list('id', flat=True):
-                            task.delay(id=item_id, **task_kwargs)
+                        item_ids = queryset.order_by('id').values_list('id', flat=True)
+                        cheap_ids, heavy_ids = costs.split_by_cost(task.name, item_ids)
+                        size = batch_size or settings.WIKIDATA_QUEUING_BATCH_SIZE
+                        if size > 1:
+                            for batch in split_every(cheap_ids, size):
+                                task.batch_task.delay(ids=list(batch), **task_kwargs)
+                        else:
+                            for item_id in cheap_ids:
+                                task.delay(id=item_id, **task_kwargs)
+                        for item_id in heavy_ids:
+                            task.apply_async(kwargs=dict(task_kwargs, id=item_id), queue=settings.WIKIDATA_HEAVY_QUEUE)
                     else:
                         task.delay(**task_kwargs)
 
+        def batch_task(self, ids, **task_kwargs):
+            failed = []
+            for i, item_id in enumerate(ids):
+                try:
+                    with progress.published_as(self):
+                        task(id=item_id, **task_kwargs)
+                except WDQSThrottled as e:
+                    # Leave the rest of the batch for when WDQS is expected to let us through again
+                    remaining = ids[i:]
+                    logger.warning("Throttled; requeuing %d of %d objects for %s", len(remaining), len(ids), task.name)
+                    task.batch_task.apply_async(kwargs=dict(task_kwargs, ids=remaining),
+                                                countdown=e.retry_after * random.uniform(1, 1.5))
+                    return {'refreshed': i - len(failed), 'failed': failed, 'requeued': remaining}
+                except Exception:
+                    logger.exception("Failed to run %s for %s", task.name, item_id)
+                    failed.append(item_id)
+            return {'refreshed': len(ids) - len(failed), 'failed': failed, 'requeued': []}
+
         # We need to give the new task function a sensible __name__ and __module__ so that celery can construct a
         # task name for it (which we can refer to in e.g. commons_api.celery.app.conf.beat_schedule. We also make the
         # periodic queuing task an attribute on the original task so we can refer to it in code.
         queuing_task.__name__ = task.__name__ + '_queue_periodically'
         queuing_task.__module__ = task.__module__
         task.periodic_queuing_task = celery.shared_task(queuing_task)
+        if 'id' in task_signature.parameters:
+            # For queuing the task for individual objects with coalescing.enqueue
+            task.queued_model = superclass
+            task.last_queued_attribute = last_queued_attribute
+            batch_task.__name__ = task.__name__ + '_batch'
+            batch_task.__module__ = task.__module__
+            task.batch_task = celery.shared_task(batch_task, bind=True)
         return task
 
     return decorator
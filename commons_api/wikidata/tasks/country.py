@@ -1,27 +1,45 @@
+import logging
+
 import celery
-from SPARQLWrapper import SPARQLWrapper, JSON
-from django.conf import settings
-from django.template.loader import get_template
 
-from commons_api.wikidata.utils import item_uri_to_id
-from commons_api.wikidata import models
+from commons_api.wikidata.utils import item_uri_to_id, templated_wikidata_query
+from commons_api.wikidata import bulk, models
+from commons_api.wikidata.tasks.base import WikidataQueryTask
 
 
 __all__ = ['refresh_country_list']
 
+logger = logging.getLogger(__name__)
+
+
+@celery.shared_task(base=WikidataQueryTask)
+def refresh_country_list(use_cache=True):
+    """Refreshes the list of countries, creating new ones and deleting those that are no longer countries
+
+    Countries are upserted together, and those no longer listed are deleted together. Deleting a country cascades to
+    its legislative houses, their memberships, and so on.
+
+    :returns: A summary, with the number of countries listed, the IDs of those created, and the number of objects
+        deleted by model
+    """
+    results = templated_wikidata_query('wikidata/query/country_list.rq', {}, use_cache=use_cache)
+    countries = [models.Country(id=item_uri_to_id(result['item']),
+                                labels={'en': str(result['itemLabel']['value'])},
+                                iso_3166_1_code=result['itemCode']['value'].upper() if result.get('itemCode') else None)
+                 for result in results['results']['bindings']]
+    seen_ids = {country.id for country in countries}
+
+    existing_ids = list(models.Country.objects.values_list('id', flat=True))
+    bulk.upsert(models.Country, countries, update_fields=['iso_3166_1_code'])
+    # CountryConfig relies on post_save to queue refreshing each new country's legislatures
+    created_ids = bulk.signal_created(models.Country, countries, existing_ids)
 
-@celery.shared_task
-def refresh_country_list():
-    sparql = SPARQLWrapper(settings.WDQS_URL)
-    sparql.setQuery(get_template('wikidata/query/country_list.rq').render())
-    sparql.setReturnFormat(JSON)
-    results = sparql.query().convert()
-    seen_ids = set()
-    for result in results['results']['bindings']:
-        id = item_uri_to_id(result['item'])
-        country = models.Country.objects.for_id_and_label(id, str(result['itemLabel']['value']))
-        country.iso_3166_1_code = result['itemCode']['value'].upper() if result.get('itemCode') else None
-        country.save()
-        seen_ids.add(id)
-    for country in models.Country.objects.exclude(id__in=seen_ids):
-        country.delete()
+    deleted = bulk.delete(models.Country.objects.exclude(id__in=seen_ids))
+    if created_ids or deleted:
+        logger.info("Created %d countries; deleted %s", len(created_ids),
+                    ', '.join('{} {}'.format(count, label) for label, count in sorted(deleted.items())) or 'nothing')
+    return {
+        'countries': len(seen_ids),
+        'created': created_ids,
+        'deleted': deleted,
+    }
@@ -1,4 +1,4 @@
-from commons_api.wikidata.tasks.base import with_periodic_queuing_task
+from commons_api.wikidata.tasks.base import with_periodic_queuing_task, WikidataQueryTask
 
 __all__ = [
     'refresh_legislatures',
@@ -8,191 +8,336 @@ __all__ = [
 
 import celery
 import collections
-import itertools
-from SPARQLWrapper import SPARQLWrapper, JSON
-from django.conf import settings
-from django.template.loader import get_template
+import logging
+
+from django.utils import timezone
 
 from commons_api.wikidata.namespaces import WD
-from commons_api.wikidata.utils import item_uri_to_id, statement_uri_to_id, get_date, templated_wikidata_query
-from .. import models
+from commons_api.wikidata.utils import item_uri_to_id, statement_uri_to_id, get_date, fingerprint, \
+    templated_wikidata_query_bindings, sharded_wikidata_query_bindings
+from .. import bulk, changes, models, signals, staging
+from ..progress import Progress
+
+logger = logging.getLogger(__name__)
+
+
+HOUSE_FIELDS = ['country', 'administrative_area', 'number_of_seats', 'number_of_districts']
 
 
 @with_periodic_queuing_task(superclass=models.Country)
-@celery.shared_task
-def refresh_legislatures(id, queued_at):
+@celery.shared_task(base=WikidataQueryTask)
+def refresh_legislatures(id, queued_at, use_cache=True):
+    """Refreshes the legislative houses of a country, along with their positions and terms
+
+    Each administrative area, house, position and term is written once, however many rows it appears in, and
+    everything is written in bulk. Links between houses and terms that are no longer returned are removed.
+
+    :returns: A summary, with the number of houses and terms listed, the IDs of newly-created houses, and the number
+        of house/term links removed
+    """
     country = models.Country.objects.get(id=id, refresh_legislatures_last_queued=queued_at)
-    results = templated_wikidata_query('wikidata/query/legislature_list.rq', {'country': country})
-    # print(get_template('wikidata/query/legislature_list.rq').render())
-    # print(len(results['results']['bindings']))
+    progress = Progress('refresh_legislatures {}'.format(country.id))
+    progress.phase('fetch')
+    results = templated_wikidata_query_bindings('wikidata/query/legislature_list.rq', {'country': country},
+                                                use_cache=use_cache)
+
+    # These map IDs to labels
+    administrative_areas, positions = {}, {}
+    legislatures = collections.OrderedDict()
     legislature_positions = collections.defaultdict(list)
-    legislative_terms = collections.defaultdict(list)
-    for result in results['results']['bindings']:
-        administrative_area = models.AdministrativeArea.objects.for_id_and_label(item_uri_to_id(result['adminArea']),
-                                                                                 result['adminAreaLabel']['value'])
-        administrative_area.save()
-        legislature = models.LegislativeHouse.objects.for_id_and_label(item_uri_to_id(result['legislature']),
-                                                                       result['legislatureLabel']['value'])
-        legislature.administrative_area = administrative_area
-        legislature.country = country
-        legislature.number_of_seats = result['numberOfSeats']['value'] if 'numberOfSeats' in result else None
-        legislature.number_of_districts = result['numberOfDistricts']['value'] if 'numberOfDistricts' in result else None
-        legislature.save()
+    for result in progress.iterate(results):
+        administrative_area_id = item_uri_to_id(result['adminArea'])
+        administrative_areas.setdefault(administrative_area_id, result['adminAreaLabel']['value'])
+        legislature_id = item_uri_to_id(result['legislature'])
+        legislatures[legislature_id] = models.LegislativeHouse(
+            id=legislature_id,
+            labels={'en': result['legislatureLabel']['value']},
+            country=country,
+            administrative_area_id=administrative_area_id,
+            number_of_seats=result['numberOfSeats']['value'] if 'numberOfSeats' in result else None,
+            number_of_districts=result['numberOfDistricts']['value'] if 'numberOfDistricts' in result else None)
         if 'legislaturePostLabel' in result:
-            position = models.Position.objects.for_id_and_label(item_uri_to_id(result['legislaturePost']),
-                                                                result['legislaturePostLabel']['value'])
-            position.save()
-            legislature_positions[legislature.id].append(position)
+            position_id = item_uri_to_id(result['legislaturePost'])
+            positions.setdefault(position_id, result['legislaturePostLabel']['value'])
+            legislature_positions[legislature_id].append(position_id)
 
-    for legislature in models.LegislativeHouse.objects.filter(id__in=legislature_positions):
-        legislature.positions.set(legislature_positions[legislature.id])
+    progress.phase('write', total=len(legislatures))
+    bulk.create_missing_items(models.AdministrativeArea, administrative_areas)
+    bulk.create_missing_items(models.Position, positions)
+    existing_legislature_ids = list(models.LegislativeHouse.objects.filter(id__in=legislatures)
+                                                                   .values_list('id', flat=True))
+    bulk.upsert(models.LegislativeHouse, legislatures.values(), update_fields=HOUSE_FIELDS)
+    # CountryConfig relies on post_save to queue refreshing each new house's members and districts
+    created_legislature_ids = bulk.signal_created(models.LegislativeHouse, legislatures.values(),
+                                                  existing_legislature_ids)
+    bulk.set_many_to_many(models.LegislativeHouse, 'positions', legislature_positions)
+    progress.advance(len(legislatures))
 
-    house_positions = [{'house': legislature_id, 'position': position.id}
-                       for legislature_id, positions in legislature_positions.items()
-                       for position in positions]
+    house_positions = [{'house': legislature_id, 'position': position_id}
+                       for legislature_id, position_ids in legislature_positions.items()
+                       for position_id in position_ids]
 
-    results = templated_wikidata_query('wikidata/query/legislature_terms_list.rq',
-                                       {'house_positions': house_positions})
-    for result in results['results']['bindings']:
-        if 'termSpecificPositionLabel' in result:
-            term_specific_position = models.Position.objects.for_id_and_label(
-                item_uri_to_id(result['termSpecificPosition']),
-                result['termSpecificPositionLabel']['value'])
-            term_specific_position.save()
-        else:
-            term_specific_position = None
-        legislative_term = models.LegislativeTerm.objects.for_id_and_label(item_uri_to_id(result['term']),
-                                                                           result['termLabel']['value'])
-        legislative_term.start = get_date(result.get('termStart'))
-        legislative_term.end = get_date(result.get('termEnd'))
+    results = sharded_wikidata_query_bindings('wikidata/query/legislature_terms_list.rq',
+                                              {'house_positions': house_positions}, 'house_positions',
+                                              use_cache=use_cache)
+    progress.phase('fetch')
+    term_specific_positions, legislative_terms, house_terms = {}, {}, {}
+    for result in progress.iterate(results):
+        legislative_term = models.LegislativeTerm(id=item_uri_to_id(result['term']),
+                                                  labels={'en': result['termLabel']['value']},
+                                                  start=get_date(result.get('termStart')),
+                                                  end=get_date(result.get('termEnd')))
         try:
-            legislative_term.series_ordinal = int(result.get('seriesOrdinal'))
-        except (ValueError, TypeError):
+            legislative_term.series_ordinal = int(result['seriesOrdinal']['value'])
+        except (KeyError, ValueError):
             legislative_term.series_ordinal = None
-        legislative_term.save()
-        legislative_terms[item_uri_to_id(result['house'])].append(legislative_term)
+        legislative_terms[legislative_term.id] = legislative_term
 
-        try:
-            lht = models.LegislativeHouseTerm.objects.get(legislative_house_id=item_uri_to_id(result['house']),
-                                                          legislative_term_id=item_uri_to_id(result['term']))
-        except models.LegislativeHouseTerm.DoesNotExist:
-            lht = models.LegislativeHouseTerm(legislative_house_id=item_uri_to_id(result['house']),
-                                              legislative_term_id=item_uri_to_id(result['term']))
-        lht.term_specific_position = term_specific_position
-        lht.save()
+        house_term = models.LegislativeHouseTerm(legislative_house_id=item_uri_to_id(result['house']),
+                                                 legislative_term_id=legislative_term.id)
+        house_term.id = house_term.make_id(house_term.legislative_house_id, house_term.legislative_term_id)
+        if 'termSpecificPositionLabel' in result:
+            house_term.term_specific_position_id = item_uri_to_id(result['termSpecificPosition'])
+            term_specific_positions.setdefault(house_term.term_specific_position_id,
+                                               result['termSpecificPositionLabel']['value'])
+        house_terms[house_term.id] = house_term
+
+    progress.phase('write', total=len(house_terms))
+    bulk.create_missing_items(models.Position, term_specific_positions)
+    bulk.upsert(models.LegislativeTerm, legislative_terms.values(), update_fields=['start', 'end', 'series_ordinal'])
+    bulk.upsert(models.LegislativeHouseTerm, house_terms.values(), update_fields=['term_specific_position'])
+    # Only houses with positions had their terms queried
+    deleted = bulk.delete(models.LegislativeHouseTerm.objects.filter(legislative_house_id__in=legislature_positions)
+                                                             .exclude(id__in=house_terms))
+    progress.advance(len(house_terms))
+    progress.finish()
+
+    summary = {
+        'houses': len(legislatures),
+        'created': created_legislature_ids,
+        'terms': len(legislative_terms),
+        'house_terms_removed': deleted.get(models.LegislativeHouseTerm._meta.label, 0),
+    }
+    logger.info("Refreshed legislatures for %s: %s", country.id, summary)
+    return summary
+
+
+MEMBERSHIP_FIELDS = ['person', 'district', 'legislative_house', 'subject_has_role', 'end_cause', 'start', 'end',
+                     'position', 'independent', 'parliamentary_group', 'party']
 
 
-@with_periodic_queuing_task(superclass=models.LegislativeHouse)
-@celery.shared_task
+@with_periodic_queuing_task(superclass=models.LegislativeHouse, changed=changes.changed_members)
+@celery.shared_task(base=WikidataQueryTask)
 def refresh_members(id, queued_at):
+    """Refreshes the memberships of a legislative house
+
+    Only memberships that have changed since they were last refreshed are written, in bulk. Memberships no longer
+    returned are deleted.
+
+    :returns: A summary, with the number of memberships listed, and the numbers written and removed
+    """
     house = models.LegislativeHouse.objects.get(id=id, refresh_members_last_queued=queued_at)
+    started = timezone.now()
+    progress = Progress('refresh_members {}'.format(house.id))
+    progress.phase('fetch')
+
+    # Results are only ordered by statement within each shard, and a statement can be returned by more than one shard
+    # (where its position is a subclass of more than one of the house's), so rows are grouped by statement below
+    # whatever order they come in
+    results = sharded_wikidata_query_bindings('wikidata/query/legislature_memberships.rq',
+                                              {'positions': house.positions.all()}, 'positions',
+                                              result_format='tsv')
+    results = progress.iterate(results)
 
-    results = templated_wikidata_query('wikidata/query/legislature_memberships.rq',
-                                       {'positions': house.positions.all()})
-    seen_statement_ids = set()
-    for i, (statement, rows) in enumerate(itertools.groupby(results['results']['bindings'],
-                                                            key=lambda row: row['statement']['value'])):
-        rows = list(rows)
-        statement_id = statement_uri_to_id(statement)
-        seen_statement_ids.add(statement_id)
+    if staging.enabled():
+        summary = staging.merge_memberships(house, results, progress=progress)
+        progress.finish()
+        models.LegislativeHouse.objects.filter(id=house.id).update(refresh_members_last_refreshed=started)
+        logger.info("Refreshed members for %s: %s", house.id, summary)
+        return summary
+
+    # Gather everything the memberships refer to first, so that each model can then be written in bulk. These map IDs
+    # to labels.
+    people, districts, terms, legislative_terms, organizations = {}, {}, {}, {}, {}
+    memberships, membership_legislative_terms = [], {}
+    statement_rows = collections.OrderedDict()
+    for row in results:
+        statement_rows.setdefault(row.statement, []).append(row)
+    progress.phase('parse', total=len(statement_rows))
+    for statement, rows in statement_rows.items():
         first_row = rows[0]
-        person = models.Person.objects.for_id_and_label(item_uri_to_id(first_row['person']),
-                                                        first_row['personLabel']['value'])
-        person.save()
-        print("{:6} {:10} {} | {}".format(i,
-                                          item_uri_to_id(first_row['person']),
-                                          first_row['personLabel']['value'],
-                                          first_row.get('group', {}).get('value')))
-
-        if 'districtLabel' in first_row:
-            district = models.ElectoralDistrict.objects.for_id_and_label(item_uri_to_id(first_row['district']),
-                                                                         first_row['districtLabel']['value'],
-                                                                         save=True)
-        else:
-            district = None
-        if first_row.get('endCauseLabel', {}).get('type') == 'uri':
-            end_cause = models.Term.objects.for_id_and_label(item_uri_to_id(first_row['endCause']),
-                                                             first_row['endCauseLabel']['value'],
-                                                             save=True)
-        else:
-            end_cause = None
-        if 'subjectHasRoleLabel' in first_row:
-            subject_has_role = models.Term.objects.for_id_and_label(item_uri_to_id(first_row['subjectHasRole']),
-                                                                    first_row['subjectHasRoleLabel']['value'],
-                                                                    save=True)
-        else:
-            subject_has_role = None
+        membership = models.LegislativeMembership(id=statement_uri_to_id(statement), legislative_house=house)
+
+        membership.person_id = item_uri_to_id(first_row.person)
+        people.setdefault(membership.person_id, first_row.personLabel)
 
-        legislative_terms = []
+        if first_row.districtLabel is not None:
+            membership.district_id = item_uri_to_id(first_row.district)
+            districts.setdefault(membership.district_id, first_row.districtLabel)
+        if getattr(first_row.endCauseLabel, 'type', None) == 'uri':
+            membership.end_cause_id = item_uri_to_id(first_row.endCause)
+            terms.setdefault(membership.end_cause_id, first_row.endCauseLabel)
+        if first_row.subjectHasRoleLabel is not None:
+            membership.subject_has_role_id = item_uri_to_id(first_row.subjectHasRole)
+            terms.setdefault(membership.subject_has_role_id, first_row.subjectHasRoleLabel)
+
+        membership_legislative_terms[membership.id] = []
         for row in rows:
-            if 'termLabel' in row:
-                legislative_term = models.LegislativeTerm.objects.for_id_and_label(item_uri_to_id(row['term']),
-                                                                                   row['termLabel']['value'],
-                                                                                   save=True)
-                legislative_terms.append(legislative_term)
+            if row.termLabel is not None:
+                legislative_term_id = item_uri_to_id(row.term)
+                legislative_terms.setdefault(legislative_term_id, row.termLabel)
+                membership_legislative_terms[membership.id].append(legislative_term_id)
 
-        try:
-            membership = models.LegislativeMembership.objects.get(id=statement_id)
-        except models.LegislativeMembership.DoesNotExist:
-            membership = models.LegislativeMembership(id=statement_id)
-        membership.person = person
-        membership.district = district
-        membership.legislative_house = house
-        membership.subject_has_role = subject_has_role
-        membership.end_cause = end_cause
-        membership.start = get_date(first_row.get('start'))
-        membership.end = get_date(first_row.get('end'))
-        membership.position_id = item_uri_to_id(first_row['role'])
+        membership.start = get_date(first_row.start)
+        membership.end = get_date(first_row.end)
+        membership.position_id = item_uri_to_id(first_row.role)
 
+        group, party = first_row.group, first_row.party
         membership.independent = False
-        for name in ('party', 'group'):
-            if first_row.get(name) and item_uri_to_id(first_row[name]) == 'Q327591':
-                del first_row[name]
-                membership.independent = True
-
-        if first_row.get('group'):
-            membership.parliamentary_group = models.Organization.objects.for_id_and_label(item_uri_to_id(first_row['group']),
-                                                                                          first_row['groupLabel']['value'],
-                                                                                          save=True)
-        else:
-            membership.parliamentary_group = None
+        if group and item_uri_to_id(group) == 'Q327591':
+            group, membership.independent = None, True
+        if party and item_uri_to_id(party) == 'Q327591':
+            party, membership.independent = None, True
 
-        if first_row.get('party'):
-            membership.party = models.Organization.objects.for_id_and_label(item_uri_to_id(first_row['party']),
-                                                                            first_row['partyLabel']['value'],
-                                                                            save=True)
+        if group:
+            membership.parliamentary_group_id = item_uri_to_id(group)
+            organizations.setdefault(membership.parliamentary_group_id, first_row.groupLabel)
+        if party:
+            membership.party_id = item_uri_to_id(party)
+            organizations.setdefault(membership.party_id, first_row.partyLabel)
         else:
-            membership.party = membership.parliamentary_group
+            membership.party_id = membership.parliamentary_group_id
 
+        memberships.append(membership)
+        progress.advance()
 
+    # Memberships without their own dates take them from their legislative terms
+    legislative_term_dates = {id: (start, end) for id, start, end in models.LegislativeTerm.objects.filter(
+        id__in=legislative_terms).values_list('id', 'start', 'end')}
+    for membership in memberships:
+        dates = [legislative_term_dates.get(legislative_term_id, (None, None))
+                 for legislative_term_id in membership_legislative_terms[membership.id]]
         if not membership.start:
-            try:
-                membership.start = min(term.start for term in legislative_terms if term.start)
-            except ValueError:
-                pass
+            membership.start = min((start for start, end in dates if start), default=None)
         if not membership.end:
-            try:
-                membership.end = min(term.end for term in legislative_terms if term.end)
-            except ValueError:
-                pass
-        membership.save()
-        membership.legislative_terms.set(legislative_terms)
+            membership.end = min((end for start, end in dates if end), default=None)
+        membership.fingerprint = fingerprint([getattr(membership, membership._meta.get_field(name).attname)
+                                              for name in MEMBERSHIP_FIELDS],
+                                             sorted(set(membership_legislative_terms[membership.id])))
+
+    # Memberships that haven't changed since they were last refreshed are skipped, and so is creating anything that only
+    # they refer to, as that will already exist
+    fingerprints = dict(models.LegislativeMembership.objects.filter(legislative_house=house)
+                                                            .values_list('id', 'fingerprint'))
+    changed_memberships = [membership for membership in memberships
+                           if fingerprints.get(membership.id) != membership.fingerprint]
+    progress.phase('write', total=len(changed_memberships))
+    referenced_ids = {getattr(membership, attname)
+                      for membership in changed_memberships
+                      for attname in ('person_id', 'district_id', 'end_cause_id', 'subject_has_role_id',
+                                      'parliamentary_group_id', 'party_id')}
+    referenced_ids.update(legislative_term_id
+                          for membership in changed_memberships
+                          for legislative_term_id in membership_legislative_terms[membership.id])
+    for model, labels in ((models.Person, people),
+                          (models.ElectoralDistrict, districts),
+                          (models.Term, terms),
+                          (models.LegislativeTerm, legislative_terms),
+                          (models.Organization, organizations)):
+        bulk.create_missing_items(model, {id: label for id, label in labels.items() if id in referenced_ids})
+
+    bulk.upsert(models.LegislativeMembership, changed_memberships, update_fields=MEMBERSHIP_FIELDS + ['fingerprint'])
+    bulk.set_many_to_many(models.LegislativeMembership, 'legislative_terms',
+                          {membership.id: membership_legislative_terms[membership.id]
+                           for membership in changed_memberships})
+    progress.advance(len(changed_memberships))
+
+    deleted = bulk.delete(models.LegislativeMembership.objects.filter(legislative_house=house)
+                                                              .exclude(id__in=membership_legislative_terms))
+    progress.finish()
+    models.LegislativeHouse.objects.filter(id=house.id).update(refresh_members_last_refreshed=started)
+
+    summary = {
+        'memberships': len(memberships),
+        'written': len(changed_memberships),
+        'removed': deleted.get(models.LegislativeMembership._meta.label, 0),
+    }
+    logger.info("Refreshed members for %s: %s", house.id, summary)
+    return summary
 
-    models.LegislativeMembership.objects.filter(legislative_house=house).exclude(id__in=seen_statement_ids).delete()
 
+DISTRICT_FIELDS = ['start', 'end', 'legislative_house', 'fingerprint']
 
-@with_periodic_queuing_task(superclass=models.LegislativeHouse)
-@celery.shared_task
+
+@with_periodic_queuing_task(superclass=models.LegislativeHouse, changed=changes.changed_districts)
+@celery.shared_task(base=WikidataQueryTask)
 def refresh_districts(id, queued_at):
+    """Refreshes the electoral districts of a legislative house
+
+    Changed districts are upserted together. Districts no longer returned for the house are unlinked from it, rather
+    than deleted, as memberships and boundaries may still refer to them. If anything changed,
+    :py:data:`commons_api.wikidata.signals.districts_changed` is sent.
+
+    The labels of new districts are taken from the results, but those of existing districts are left to
+    :py:func:`commons_api.wikidata.tasks.refresh_labels`, which refreshes them in every language.
+
+    :returns: A summary, with the number of districts listed, and the IDs of those created, updated and removed
+    """
     house = models.LegislativeHouse.objects.get(id=id, refresh_districts_last_queued=queued_at)
+    started = timezone.now()
+    progress = Progress('refresh_districts {}'.format(house.id))
+    progress.phase('fetch')
+
+    results = templated_wikidata_query_bindings('wikidata/query/legislature_constituencies.rq',
+                                                {'house': house}, result_format='tsv')
+    results = progress.iterate(results)
+
+    if staging.enabled():
+        district_count, created_ids, updated_ids, removed_ids = staging.merge_districts(house, results, progress)
+    else:
+        district_count, created_ids, updated_ids, removed_ids = _refresh_districts_in_bulk(house, results, progress)
+    progress.finish()
+    models.LegislativeHouse.objects.filter(id=house.id).update(refresh_districts_last_refreshed=started)
+
+    summary = {
+        'districts': district_count,
+        'created': created_ids,
+        'updated': updated_ids,
+        'removed': removed_ids,
+    }
+    if created_ids or updated_ids or removed_ids:
+        logger.info("Refreshed districts for %s: %d created, %d updated, %d removed", house.id,
+                    len(summary['created']), len(summary['updated']), len(summary['removed']))
+        signals.districts_changed.send(sender=models.LegislativeHouse, house=house, created=summary['created'],
+                                       updated=summary['updated'], removed=summary['removed'])
+    return summary
+
+
+def _refresh_districts_in_bulk(house, results, progress):
+    # Where a district has more than one row, the last one wins
+    results = collections.OrderedDict((item_uri_to_id(result.constituency), result) for result in results)
+    fingerprints = dict(models.ElectoralDistrict.objects.filter(id__in=results).values_list('id', 'fingerprint'))
+
+    changed_districts = []
+    for id, result in results.items():
+        start, end = get_date(result.start), get_date(result.end)
+        district_fingerprint = fingerprint(start, end, house.id)
+        if fingerprints.get(id) != district_fingerprint:
+            changed_districts.append(models.ElectoralDistrict(id=id, labels={'en': result.constituencyLabel},
+                                                              start=start, end=end, legislative_house=house,
+                                                              fingerprint=district_fingerprint))
+    progress.phase('write', total=len(changed_districts))
+    bulk.upsert(models.ElectoralDistrict, changed_districts, update_fields=DISTRICT_FIELDS)
+    progress.advance(len(changed_districts))
 
-    results = templated_wikidata_query('wikidata/query/legislature_constituencies.rq',
-                                       {'house': house})
+    # The fingerprint is cleared so that a district is written again should it come back
+    removed_ids = sorted(models.ElectoralDistrict.objects.filter(legislative_house=house)
+                                                         .exclude(id__in=results).values_list('id', flat=True))
+    bulk.update(models.ElectoralDistrict,
+                [models.ElectoralDistrict(id=id, legislative_house=None, fingerprint='') for id in removed_ids],
+                ['legislative_house', 'fingerprint'])
 
-    for result in results['results']['bindings']:
-        electoral_district = models.ElectoralDistrict.objects.for_id_and_label(item_uri_to_id(result['constituency']),
-                                                                               result['constituencyLabel']['value'])
-        electoral_district.start = get_date(result.get('start'))
-        electoral_district.end = get_date(result.get('end'))
-        electoral_district.legislative_house = house
-        electoral_district.save()
+    return (len(results),
+            sorted(district.id for district in changed_districts if district.id not in fingerprints),
+            sorted(district.id for district in changed_districts if district.id in fingerprints),
+            removed_ids)
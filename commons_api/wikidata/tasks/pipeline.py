@@ -0,0 +1,266 @@
+"""
+The bootstrap pipeline, which refreshes everything in order, a stage at a time
+
+Normally, creating a country queues refreshing its legislatures, which creates legislative houses, which queues
+refreshing each one's members and districts (see :py:class:`commons_api.wikidata.apps.CountryConfig`). Starting from
+an empty database, that becomes thousands of tasks with no overall progress or end. The bootstrap pipeline instead runs
+these stages in turn:
+
+* ``countries``: the list of countries
+* ``legislatures``: each country's legislative houses, and their terms
+* ``districts``: each house's electoral districts
+* ``members``: each house's memberships, which refer to districts
+* ``labels``: the labels of every Wikidata item, for each model
+* ``boundaries``: the boundaries from each country's Democratic Commons repository, each imported by its own lane on
+  the ``shapefiles`` queue, so this stage needs a worker consuming that queue (see the Procfile)
+
+Each stage is a chord of "lane" tasks, of which there are at most `settings.PIPELINE_CONCURRENCY[stage]` (default 1).
+Each lane refreshes its share of the stage's objects in turn, with the most expensive objects spread between lanes (see
+:py:mod:`commons_api.wikidata.costs`). When all of a stage's lanes have finished, the next stage is started. The
+progress of each stage is recorded in a :py:class:`commons_api.wikidata.models.PipelineStage`, and is shown on the queue
+status page. When the last stage has finished, :py:data:`commons_api.wikidata.signals.bootstrap_finished` is sent.
+
+While a run is in progress, creating countries and legislative houses doesn't queue refreshing them, as later stages
+refresh everything anyway. Objects that already have a refresh queued or running are skipped (see
+:py:mod:`commons_api.wikidata.coalescing`).
+
+A run that has stalled (e.g. because a worker was lost) stops suppressing refreshes once it has done nothing for
+`settings.PIPELINE_STALL_TIMEOUT` seconds, and can then be resumed from the stage it had reached with :py:func:`resume`.
+Houses whose members or districts were refreshed earlier in the stage aren't refreshed again.
+
+Usage:
+
+    manage.py bootstrap
+    manage.py bootstrap --resume <run ID>
+"""
+
+import datetime
+import logging
+import random
+
+import celery
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .. import coalescing, costs, models, progress, signals
+from ..governor import WDQSThrottled
+from .base import get_wikidata_models
+from .country import refresh_country_list
+from .legislature import refresh_legislatures, refresh_members, refresh_districts
+from .wikidata_item import refresh_labels
+
+__all__ = ['run_stage', 'run_lane', 'finish_stage']
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    """A stage of the pipeline that runs a single task
+
+    :param queue: The queue to run the stage's lanes on, if not the default
+    """
+    queue = None
+
+    def __init__(self, name, run_item):
+        self.name = name
+        self.run_item = run_item
+
+    def get_items(self, stage, previous_queued_at):
+        """Returns the items for the stage to run, the number already done, and the number skipped"""
+        return [self.name], 0, 0
+
+    def get_lanes(self, items, count):
+        return [items] if items else []
+
+
+class ModelStage(Stage):
+    """A stage of the pipeline that refreshes labels for each Wikidata model"""
+    def get_items(self, stage, previous_queued_at):
+        return sorted(model._meta.label_lower for model in get_wikidata_models()), 0, 0
+
+    def get_lanes(self, items, count):
+        return [items[i::count] for i in range(min(count, len(items)))]
+
+
+class ObjectStage(Stage):
+    """A stage of the pipeline that runs a refresh task for each object, as its periodic queuing task would
+
+    :param last_refreshed_attribute: The name of a field recording when each object was last refreshed by the task, if
+        there is one. Objects refreshed since the stage first started aren't refreshed again when it's resumed.
+    """
+    def __init__(self, name, task, last_refreshed_attribute=None):
+        self.name = name
+        self.task = task
+        self.last_refreshed_attribute = last_refreshed_attribute
+
+    def get_items(self, stage, previous_queued_at):
+        model = self.task.queued_model
+        object_ids = list(model.objects.order_by('id').values_list('id', flat=True))
+        done = set()
+        if self.last_refreshed_attribute and stage.started_at:
+            done = set(model.objects.filter(**{self.last_refreshed_attribute + '__gte': stage.started_at})
+                                    .values_list('id', flat=True))
+            object_ids = [object_id for object_id in object_ids if object_id not in done]
+        # Any locks left from before the stage was resumed are ours to take again
+        if previous_queued_at:
+            coalescing.release_many(self.task.name, object_ids, previous_queued_at)
+        acquired = coalescing.acquire(self.task.name, object_ids, stage.queued_at)
+        model.objects.filter(id__in=acquired).update(**{self.task.last_queued_attribute: stage.queued_at})
+        return acquired, len(done), len(object_ids) - len(acquired)
+
+    def get_lanes(self, items, count):
+        # Give each of the most expensive objects to the lane with the least work so far
+        durations = costs.expected_durations(self.task.name, items)
+        lanes = [([], 0)] * min(count, len(items))
+        for item in sorted(items, key=lambda item: durations.get(item, 0), reverse=True):
+            i = min(range(len(lanes)), key=lambda i: lanes[i][1])
+            lanes[i] = (lanes[i][0] + [item], lanes[i][1] + durations.get(item, 0))
+        return [lane for lane, duration in lanes]
+
+    def run_item(self, stage, item):
+        self.task(id=item, queued_at=stage.queued_at)
+
+
+class BoundariesStage(Stage):
+    """A stage of the pipeline that imports the boundaries from each country's Democratic Commons repository
+
+    Each repository gets a lane of its own on the ``shapefiles`` queue, whose worker bounds how many run at once, and
+    runs each task in a new process so that the memory used by GDAL is freed after each country.
+    """
+    queue = 'shapefiles'
+
+    def __init__(self, name):
+        self.name = name
+
+    def get_items(self, stage, previous_queued_at):
+        from commons_api.proto_commons.tasks import get_commons_repos
+        return [[country_id, repo_full_name] for country_id, repo_full_name in get_commons_repos()], 0, 0
+
+    def get_lanes(self, items, count):
+        return [[item] for item in items]
+
+    def run_item(self, stage, item):
+        from commons_api.proto_commons.tasks import import_boundaries_for_country
+        import_boundaries_for_country(*item)
+
+
+STAGES = [
+    Stage('countries', lambda stage, item: refresh_country_list()),
+    ObjectStage('legislatures', refresh_legislatures),
+    ObjectStage('districts', refresh_districts, 'refresh_districts_last_refreshed'),
+    ObjectStage('members', refresh_members, 'refresh_members_last_refreshed'),
+    ModelStage('labels', lambda stage, item: refresh_labels(*item.split('.'))),
+    BoundariesStage('boundaries'),
+]
+STAGES_BY_NAME = {stage.name: stage for stage in STAGES}
+
+
+def active_run():
+    """Returns the pipeline run in progress, if any, ignoring any that have stalled"""
+    threshold = timezone.now() - datetime.timedelta(seconds=settings.PIPELINE_STALL_TIMEOUT)
+    return models.PipelineRun.objects.filter(status=models.PipelineRun.RUNNING, last_activity__gte=threshold).first()
+
+
+def start():
+    """Starts a run of the pipeline, unless one is already in progress
+
+    :returns: The new run, or the one already in progress
+    """
+    run = active_run()
+    if run is not None:
+        return run
+    run = models.PipelineRun.objects.create()
+    models.PipelineStage.objects.bulk_create([models.PipelineStage(run=run, name=stage.name, position=position)
+                                              for position, stage in enumerate(STAGES)])
+    run_stage.delay(run.id, STAGES[0].name)
+    return run
+
+
+def resume(run_id):
+    """Resumes a stalled run of the pipeline from the first stage it hadn't finished
+
+    :raises ValueError: If the run has finished, or is still in progress
+    """
+    run = models.PipelineRun.objects.get(id=run_id)
+    if run.status == models.PipelineRun.FINISHED:
+        raise ValueError('{} has already finished'.format(run))
+    if active_run() == run:
+        raise ValueError('{} is still in progress'.format(run))
+    stage = run.stages.exclude(status=models.PipelineStage.FINISHED).first()
+    _record_activity(run.id)
+    if stage is None:
+        # Only finishing the run itself was left
+        finish_stage.delay(run.id, STAGES[-1].name)
+    else:
+        run_stage.delay(run.id, stage.name)
+    return run
+
+
+def _record_activity(run_id):
+    models.PipelineRun.objects.filter(id=run_id).update(last_activity=timezone.now())
+
+
+@celery.shared_task
+def run_stage(run_id, name):
+    """Starts a stage of a pipeline run, as a chord of lanes which calls :py:func:`finish_stage` when they're done"""
+    stage = models.PipelineStage.objects.get(run_id=run_id, name=name)
+    definition = STAGES_BY_NAME[name]
+    previous_queued_at = stage.queued_at
+    stage.status, stage.queued_at = models.PipelineStage.RUNNING, timezone.now()
+    stage.started_at = stage.started_at or stage.queued_at
+    items, stage.done, stage.skipped = definition.get_items(stage, previous_queued_at)
+    stage.total, stage.failed = stage.done + stage.skipped + len(items), 0
+    stage.save()
+    _record_activity(run_id)
+
+    lanes = definition.get_lanes(items, settings.PIPELINE_CONCURRENCY.get(name, 1))
+    logger.info("Starting %s of pipeline run %d, with %d items in %d lanes", name, run_id, len(items), len(lanes))
+    if lanes:
+        signatures = [run_lane.si(run_id, name, lane) for lane in lanes]
+        if definition.queue:
+            signatures = [signature.set(queue=definition.queue) for signature in signatures]
+        celery.chord(signatures)(finish_stage.si(run_id, name))
+    else:
+        finish_stage.delay(run_id, name)
+
+
+@celery.shared_task(bind=True, max_retries=settings.WDQS_THROTTLED_MAX_RETRIES)
+def run_lane(self, run_id, name, items):
+    """Runs a stage for each of `items` in turn, recording its progress
+
+    Failures are logged and counted, rather than stopping the lane. If WDQS throttles us, the lane is retried with the
+    items it hadn't finished, so that the stage's chord still completes. The progress of each item is published as the
+    lane's.
+    """
+    stage = models.PipelineStage.objects.get(run_id=run_id, name=name)
+    definition = STAGES_BY_NAME[name]
+    for i, item in enumerate(items):
+        try:
+            with progress.published_as(self):
+                definition.run_item(stage, item)
+        except WDQSThrottled as e:
+            raise self.retry(args=(run_id, name, items[i:]), countdown=e.retry_after * random.uniform(1, 1.5))
+        except Exception:
+            logger.exception("Pipeline run %d failed to run %s for %s", run_id, name, item)
+            models.PipelineStage.objects.filter(id=stage.id).update(failed=F('failed') + 1)
+        else:
+            models.PipelineStage.objects.filter(id=stage.id).update(done=F('done') + 1)
+        _record_activity(run_id)
+
+
+@celery.shared_task
+def finish_stage(run_id, name):
+    """Records that a stage has finished, and starts the next one, or finishes the run"""
+    now = timezone.now()
+    models.PipelineStage.objects.filter(run_id=run_id, name=name).update(status=models.PipelineStage.FINISHED,
+                                                                         finished_at=now)
+    position = STAGES.index(STAGES_BY_NAME[name])
+    if position + 1 < len(STAGES):
+        run_stage.delay(run_id, STAGES[position + 1].name)
+        return
+    models.PipelineRun.objects.filter(id=run_id).update(status=models.PipelineRun.FINISHED, finished_at=now,
+                                                        last_activity=now)
+    run = models.PipelineRun.objects.get(id=run_id)
+    logger.info("Finished %s", run)
+    signals.bootstrap_finished.send(sender=models.PipelineRun, run=run)
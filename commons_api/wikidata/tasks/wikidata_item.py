@@ -1,31 +1,96 @@
-import datetime
+import collections
+import itertools
+import logging
 
 import celery
-import itertools
+from django.conf import settings
+from django.utils import timezone
+
+from commons_api.wikidata import bulk, changes, utils
+from commons_api.wikidata.progress import Progress
+from commons_api.wikidata.tasks.base import with_periodic_queuing_task, get_wikidata_model_by_name, \
+    get_wikidata_models, WikidataQueryTask
+
+__all__ = ['refresh_labels', 'refresh_all_labels']
+
+logger = logging.getLogger(__name__)
+
+
+def label_queries(model, ids):
+    """Returns (key, query_name, context) tuples for utils.iter_concurrent_wikidata_queries, one per chunk of `ids`"""
+    return [((model, chunk), 'wikidata/query/labels.rq', {'ids': chunk})
+            for chunk in (list(chunk) for chunk in utils.split_every(sorted(ids), settings.WDQS_SHARD_SIZE))]
+
+
+def update_labels(model, ids, bindings):
+    """Updates the labels for the given items of `model` from the results of labels.rq
 
-from commons_api.wikidata import utils
-from commons_api.wikidata.tasks.base import with_periodic_queuing_task, get_wikidata_model_by_name
+    Only items whose labels have changed are written, in bulk.
 
-__all__ = ['refresh_labels']
+    :returns: The number of items whose labels changed
+    """
+    current_labels = dict(model.objects.filter(id__in=ids).values_list('id', 'labels'))
+    changed = []
+    for id, rows in itertools.groupby(bindings, key=lambda row: row['id']['value']):
+        id = utils.item_uri_to_id(id)
+        labels = {row['label']['xml:lang']: row['label']['value'] for row in rows}
+        if id in current_labels and current_labels[id] != labels:
+            changed.append(model(id=id, labels=labels))
+    return bulk.update(model, changed, ['labels'])
+
+
+def run_label_queries(queries, use_cache=True):
+    progress = Progress('refresh_labels')
+    # Items are counted once their labels have been fetched and written
+    progress.phase('fetch', total=sum(len(ids) for (model, ids), query_name, context in queries))
+    updated = collections.Counter()
+    for (model, ids), bindings in utils.iter_concurrent_wikidata_queries(queries, use_cache=use_cache):
+        updated[model._meta.label] += update_labels(model, ids, bindings)
+        progress.advance(len(ids))
+    progress.finish()
+    for model_label, count in sorted(updated.items()):
+        logger.info("Updated labels for %d %s", count, model_label)
+    return dict(updated)
 
 
 @with_periodic_queuing_task
-@celery.shared_task
-def refresh_labels(app_label, model, ids=None, queued_at=None):
-    """Refreshes all labels for the given model"""
-    queryset = get_wikidata_model_by_name(app_label, model).objects.all()
+@celery.shared_task(base=WikidataQueryTask)
+def refresh_labels(app_label, model, ids=None, queued_at=None, use_cache=True):
+    """Refreshes all labels for the given model
+
+    If `settings.WIKIDATA_INCREMENTAL_REFRESH` is on, only items that have been modified on Wikidata since their labels
+    were last refreshed are queried, bypassing the cache (whose results for them would be out of date); see
+    :py:mod:`commons_api.wikidata.changes`. Passing `use_cache=False` queries every item, whether or not it has changed.
+
+    :returns: A dict of the number of items whose labels changed, by model"""
+    model = get_wikidata_model_by_name(app_label, model)
+    queryset = model.objects.all()
     if queued_at is not None:
         queryset = queryset.filter(refresh_labels_last_queued=queued_at)
     if ids is not None:
-        queryset = queryset.objects.filter(id__in=ids)
-    for items in utils.split_every(queryset, 250):
-        items = {item.id: item for item in items}
-        results = utils.templated_wikidata_query('wikidata/query/labels.rq', {'ids': sorted(items)})
-        for id, rows in itertools.groupby(results['results']['bindings'],
-                                            key=lambda row: row['id']['value']):
-            id = utils.item_uri_to_id(id)
-            rows = list(rows)
-            items[id].labels = {row['label']['xml:lang']: row['label']['value']
-                                for row in rows}
-            items[id].save()
+        queryset = queryset.filter(id__in=ids)
+    ids = list(queryset.values_list('id', flat=True))
+    if not settings.WIKIDATA_INCREMENTAL_REFRESH or not use_cache:
+        return run_label_queries(label_queries(model, ids), use_cache=use_cache)
+
+    modified = changes.changed_items(model, ids)
+    logger.info("%d of %d %s have changed", len(modified), len(ids), model._meta.label)
+    updated = run_label_queries(label_queries(model, modified), use_cache=False)
+    changes.record_modified(model, modified)
+    return updated
+
+
+@celery.shared_task(base=WikidataQueryTask)
+def refresh_all_labels(use_cache=True):
+    """Refreshes labels for every Wikidata item, across all models
+
+    Queries for all models are run together, with `settings.WDQS_BATCH_CONCURRENCY` in flight at once, so that the
+    slowest queries don't hold up the rest.
 
+    :returns: A dict of the number of items whose labels changed, by model"""
+    queued_at = timezone.now()
+    queries = []
+    for model in get_wikidata_models():
+        model.objects.update(refresh_labels_last_queued=queued_at)
+        queries.extend(label_queries(model, model.objects.values_list('id', flat=True)))
+    return run_label_queries(queries, use_cache=use_cache)
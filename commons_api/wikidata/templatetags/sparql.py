@@ -0,0 +1,40 @@
+import re
+
+from django import template
+from django.utils.safestring import mark_safe
+
+register = template.Library()
+
+ENTITY_ID_RE = re.compile('^[QP][1-9][0-9]*$')
+
+
+def entity_id(value):
+    """Returns the ID of a Wikidata item (or of a model instance for one), checking it's safe to put in a query"""
+    value = getattr(value, 'id', value)
+    if not isinstance(value, str) or not ENTITY_ID_RE.match(value):
+        raise ValueError("Not a Wikidata entity ID: {!r}".format(value))
+    return value
+
+
+@register.filter
+def wikidata_values(items):
+    """Renders Wikidata items (or their IDs) as `wd:` names separated by spaces, for use in a VALUES block
+
+    Usage: VALUES ?id { {{ ids|wikidata_values }} }
+    """
+    return mark_safe(' '.join(['wd:' + entity_id(item) for item in items]))
+
+
+@register.filter
+def wikidata_value_rows(rows, keys):
+    """Renders dicts of Wikidata items as rows for a VALUES block with more than one variable
+
+    `keys` is a comma-separated list of the keys to take from each dict, in order. Missing values are rendered as
+    `rdf:nil`.
+
+    Usage: VALUES (?house ?position) { {{ house_positions|wikidata_value_rows:"house,position" }} }
+    """
+    keys = keys.split(',')
+    return mark_safe('\n'.join(['(' + ' '.join(['wd:' + entity_id(row[key]) if row.get(key) else 'rdf:nil'
+                                                for key in keys]) + ')'
+                                for row in rows]))
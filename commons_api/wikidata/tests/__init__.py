@@ -1,8 +1,19 @@
 from .api_links import *
+from .bulk import *
+from .changes import *
+from .coalescing import *
+from .costs import *
 from .geojson import *
+from .governor import *
+from .instrumentation import *
 from .moderation import *
+from .pipeline import *
 from .popolo import *
+from .progress import *
+from .recording import *
 from .serializers import *
+from .sparql import *
+from .staging import *
 from .updating import *
 from .utils import *
 from .views import *
\ No newline at end of file
@@ -0,0 +1,51 @@
+import unittest.mock
+
+from django.test import TestCase, override_settings
+
+from .. import bulk, models
+from ..tasks import legislature
+
+
+class BulkTestCase(TestCase):
+    def testCreateMissingItems(self):
+        models.Term.objects.create(id='Q1', labels={'en': 'existing', 'de': 'vorhanden'})
+        bulk.create_missing_items(models.Term, {'Q1': 'new', 'Q2': 'new'})
+        self.assertEqual({'Q1': {'en': 'existing', 'de': 'vorhanden'}, 'Q2': {'en': 'new'}},
+                         dict(models.Term.objects.values_list('id', 'labels')))
+
+    def testUpsertUpdatesGivenFields(self):
+        models.Person.objects.create(id='Q1', labels={'en': 'Old'}, twitter_id='old')
+        bulk.upsert(models.Person, [models.Person(id='Q1', labels={'en': 'New'}, twitter_id='new'),
+                                    models.Person(id='Q2', labels={'en': 'Other'})],
+                    update_fields=['twitter_id'])
+        person = models.Person.objects.get(id='Q1')
+        self.assertEqual(({'en': 'Old'}, 'new'), (person.labels, person.twitter_id))
+        self.assertTrue(models.Person.objects.filter(id='Q2').exists())
+
+    def testUpsertDuplicates(self):
+        bulk.upsert(models.Person, [models.Person(id='Q1', twitter_id='first'),
+                                    models.Person(id='Q1', twitter_id='second')],
+                    update_fields=['twitter_id'])
+        self.assertEqual('second', models.Person.objects.get().twitter_id)
+
+    @unittest.mock.patch.object(legislature.refresh_members, 'delay')
+    @unittest.mock.patch.object(legislature.refresh_districts, 'delay')
+    @unittest.mock.patch.object(legislature.refresh_legislatures, 'delay')
+    def testSetManyToMany(self, *delays):
+        country = models.Country.objects.create(id='Q145')
+        administrative_area = models.AdministrativeArea.objects.create(id='Q145')
+        house = models.LegislativeHouse.objects.create(id='Q11005', country=country,
+                                                       administrative_area=administrative_area)
+        for id in ('Q1', 'Q2', 'Q3'):
+            models.Position.objects.create(id=id)
+        house.positions.set(['Q1', 'Q2'])
+        self.assertEqual((1, 1), bulk.set_many_to_many(models.LegislativeHouse, 'positions',
+                                                       {'Q11005': ['Q2', 'Q3', 'Q3']}))
+        self.assertEqual({'Q2', 'Q3'}, set(house.positions.values_list('id', flat=True)))
+        self.assertEqual((0, 0), bulk.set_many_to_many(models.LegislativeHouse, 'positions', {'Q11005': ['Q3', 'Q2']}))
+
+    @override_settings(ENABLE_MODERATION=True)
+    def testModeratedObjectsSavedIndividually(self):
+        bulk.create_missing_items(models.Person, {'Q42': 'Douglas Adams'})
+        self.assertFalse(models.Person.objects.exists())
+        self.assertEqual('Q42', models.ModerationItem.objects.get().object_id)
@@ -0,0 +1,138 @@
+import datetime
+import json
+import shutil
+import tempfile
+import threading
+import unittest.mock
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from .. import changes, models, recording, sparql
+from ..tasks import legislature, wikidata_item
+
+JSON = 'application/sparql-results+json'
+
+
+class ChangedItemsTestCase(TestCase):
+    """Checks for changes against a stand-in WDQS"""
+    def setUp(self):
+        self.fixtures_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.fixtures_directory)
+        self.server = recording.ReplayServer(('127.0.0.1', 0), self.fixtures_directory)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        settings_override = override_settings(WDQS_URL=self.server.url, WIKIDATA_INCREMENTAL_REFRESH=True)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.modified = datetime.datetime(2019, 1, 15, 10, 51, 7, tzinfo=datetime.timezone.utc)
+        models.Person.objects.create(id='Q1', labels={'en': 'One'}, wikidata_modified=self.modified)
+        models.Person.objects.create(id='Q2', labels={'en': 'Two'},
+                                     wikidata_modified=self.modified - datetime.timedelta(1))
+        models.Person.objects.create(id='Q3', labels={'en': 'Three'})
+        self.save_fixture('wikidata/query/modified.rq', ['id', 'modified'], [
+            {'id': self.uri(id),
+             'modified': {'type': 'literal', 'value': '2019-01-15T10:51:07Z',
+                          'datatype': 'http://www.w3.org/2001/XMLSchema#dateTime'}}
+            for id in ('Q1', 'Q2', 'Q3')])
+
+    def uri(self, id):
+        return {'type': 'uri', 'value': 'http://www.wikidata.org/entity/' + id}
+
+    def save_fixture(self, query_name, variables, bindings, ids=('Q1', 'Q2', 'Q3')):
+        query = sparql.render_query(query_name, {'ids': list(ids)})
+        results = {'head': {'vars': variables}, 'results': {'bindings': bindings}}
+        recording.save_fixture(self.fixtures_directory, query, JSON, json.dumps(results).encode(), JSON)
+
+    def testModifiedTimes(self):
+        self.assertEqual({'Q1': self.modified, 'Q2': self.modified, 'Q3': self.modified},
+                         changes.modified_times(['Q3', 'Q1', 'Q2']))
+
+    def testChangedItems(self):
+        self.assertEqual({'Q2': self.modified, 'Q3': self.modified},
+                         changes.changed_items(models.Person, ['Q1', 'Q2', 'Q3']))
+
+    def testItemsMissingFromWDQSSkipped(self):
+        self.save_fixture('wikidata/query/modified.rq', ['id', 'modified'], [
+            {'id': self.uri(id),
+             'modified': {'type': 'literal', 'value': '2019-01-15T10:51:07Z',
+                          'datatype': 'http://www.w3.org/2001/XMLSchema#dateTime'}}
+            for id in ('Q1', 'Q2')])
+        self.assertEqual({'Q2': self.modified}, changes.changed_items(models.Person, ['Q1', 'Q2', 'Q3']))
+
+    def testRefreshLabelsOnlyQueriesChangedItems(self):
+        self.save_fixture('wikidata/query/labels.rq', ['id', 'label'], [
+            {'id': self.uri('Q2'), 'label': {'type': 'literal', 'value': 'Deux', 'xml:lang': 'fr'}},
+            {'id': self.uri('Q3'), 'label': {'type': 'literal', 'value': 'Three', 'xml:lang': 'en'}},
+        ], ids=('Q2', 'Q3'))
+        self.assertEqual({'wikidata.Person': 1}, wikidata_item.refresh_labels('wikidata', 'person'))
+        self.assertEqual({'fr': 'Deux'}, models.Person.objects.get(id='Q2').labels)
+        self.assertFalse(models.Person.objects.exclude(wikidata_modified=self.modified).exists())
+        self.assertEqual(2, self.server.stats['requests'])
+
+        # Nothing has changed since, so only the check is made
+        self.assertEqual({}, wikidata_item.refresh_labels('wikidata', 'person'))
+        self.assertEqual(3, self.server.stats['requests'])
+        self.assertEqual(0, self.server.stats['missing'])
+
+
+    def testRefreshLabelsWithoutCacheQueriesAllItems(self):
+        self.save_fixture('wikidata/query/labels.rq', ['id', 'label'], [
+            {'id': self.uri('Q1'), 'label': {'type': 'literal', 'value': 'One', 'xml:lang': 'en'}},
+            {'id': self.uri('Q2'), 'label': {'type': 'literal', 'value': 'Deux', 'xml:lang': 'fr'}},
+            {'id': self.uri('Q3'), 'label': {'type': 'literal', 'value': 'Three', 'xml:lang': 'en'}},
+        ])
+        self.assertEqual({'wikidata.Person': 1},
+                         wikidata_item.refresh_labels('wikidata', 'person', use_cache=False))
+        self.assertEqual({'fr': 'Deux'}, models.Person.objects.get(id='Q2').labels)
+        # No check for changes is made
+        self.assertEqual(1, self.server.stats['requests'])
+        self.assertEqual(0, self.server.stats['missing'])
+
+class ChangedHousesTestCase(TestCase):
+    @unittest.mock.patch.object(legislature.refresh_members, 'delay')
+    @unittest.mock.patch.object(legislature.refresh_districts, 'delay')
+    @unittest.mock.patch.object(legislature.refresh_legislatures, 'delay')
+    def setUp(self, *delays):
+        self.now = timezone.now()
+        country = models.Country.objects.create(id='Q145')
+        administrative_area = models.AdministrativeArea.objects.create(id='Q145')
+        position = models.Position.objects.create(id='Q16707842')
+        person = models.Person.objects.create(id='Q1')
+        past_person = models.Person.objects.create(id='Q2')
+        for id, days_since_refreshed in (('Q11005', 1), ('Q11007', 1), ('Q234993', 60), ('Q243', None)):
+            last_refreshed = self.now - datetime.timedelta(days_since_refreshed) if days_since_refreshed else None
+            house = models.LegislativeHouse.objects.create(id=id, country=country,
+                                                           administrative_area=administrative_area,
+                                                           refresh_members_last_refreshed=last_refreshed,
+                                                           refresh_districts_last_refreshed=last_refreshed)
+            house.positions.add(position)
+        models.LegislativeMembership.objects.create(id='Q1-1', person=person, legislative_house_id='Q11005',
+                                                    start=datetime.date(2017, 6, 8))
+        models.LegislativeMembership.objects.create(id='Q2-1', person=past_person, legislative_house_id='Q11007',
+                                                    start=datetime.date(2010, 5, 6), end=datetime.date(2015, 3, 30))
+        models.ElectoralDistrict.objects.create(id='Q1146817', legislative_house_id='Q11007')
+
+    def testMemberSources(self):
+        sources = changes.member_sources(['Q11005', 'Q11007'])
+        self.assertEqual({'Q11005': {'Q11005', 'Q16707842', 'Q1'}, 'Q11007': {'Q11007', 'Q16707842'}}, sources)
+
+    def testDistrictSources(self):
+        self.assertEqual({'Q11007': {'Q11007', 'Q1146817'}}, changes.district_sources(['Q11007']))
+
+    @unittest.mock.patch.object(changes, 'modified_times')
+    def testChangedMembers(self, modified_times):
+        # Q1 was modified since Q11005 was last refreshed, while Q2 is no longer a member of Q11007. Q234993 is due a
+        # refresh anyway, and Q243 has never been refreshed.
+        modified_times.return_value = {'Q1': self.now, 'Q2': self.now,
+                                       'Q16707842': self.now - datetime.timedelta(30)}
+        self.assertEqual(['Q11005', 'Q234993', 'Q243'],
+                         changes.changed_members(models.LegislativeHouse, ['Q11005', 'Q11007', 'Q234993', 'Q243']))
+        modified_times.assert_called_once_with({'Q11005', 'Q11007', 'Q16707842', 'Q1'})
+
+    @unittest.mock.patch.object(changes, 'modified_times')
+    def testChangesWithinLagAllowanceCounted(self, modified_times):
+        modified_times.return_value = {'Q1146817': self.now - datetime.timedelta(days=1, minutes=30)}
+        self.assertEqual(['Q11007'], changes.changed_districts(models.LegislativeHouse, ['Q11005', 'Q11007']))
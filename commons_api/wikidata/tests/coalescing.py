@@ -0,0 +1,59 @@
+import unittest.mock
+
+from django.test import TestCase, override_settings
+
+from .. import coalescing, models
+
+
+class CoalescingTestCase(TestCase):
+    def setUp(self):
+        self.task = unittest.mock.Mock(last_queued_attribute='refresh_members_last_queued')
+        self.task.name = 'commons_api.wikidata.tasks.legislature.refresh_members'
+
+    def queued_at(self):
+        return self.task.delay.call_args[1]['queued_at']
+
+    def testDuplicateRequestsCoalesced(self):
+        self.assertTrue(coalescing.enqueue(self.task, 'Q11005'))
+        self.assertFalse(coalescing.enqueue(self.task, 'Q11005'))
+        self.task.delay.assert_called_once_with(id='Q11005', queued_at=unittest.mock.ANY)
+        self.task.queued_model.objects.filter(id='Q11005').update.assert_called_once_with(
+            refresh_members_last_queued=self.queued_at())
+        lock = models.RefreshLock.objects.get()
+        self.assertEqual((1, False), (lock.coalesced, lock.rerun))
+
+    def testRequestWhileRunningReruns(self):
+        coalescing.enqueue(self.task, 'Q11005')
+        coalescing.start(self.task.name, 'Q11005', self.queued_at())
+        self.assertFalse(coalescing.enqueue(self.task, 'Q11005', use_cache=False))
+        self.assertEqual({'use_cache': False}, coalescing.release(self.task.name, 'Q11005', self.queued_at()))
+        self.assertFalse(models.RefreshLock.objects.exists())
+
+    def testRequestWhileQueuedOverridesArguments(self):
+        coalescing.enqueue(self.task, 'Q11005')
+        self.assertFalse(coalescing.enqueue(self.task, 'Q11005', use_cache=False))
+        self.assertFalse(coalescing.enqueue(self.task, 'Q11005'))
+        self.assertEqual({'use_cache': False}, coalescing.start(self.task.name, 'Q11005', self.queued_at()))
+        self.assertIsNone(coalescing.release(self.task.name, 'Q11005', self.queued_at()))
+
+    def testReleaseAllowsRequeueing(self):
+        coalescing.enqueue(self.task, 'Q11005')
+        self.assertIsNone(coalescing.release(self.task.name, 'Q11005', self.queued_at()))
+        self.assertTrue(coalescing.enqueue(self.task, 'Q11005'))
+
+    def testStaleReleaseIgnored(self):
+        coalescing.enqueue(self.task, 'Q11005')
+        coalescing.release(self.task.name, 'Q11005', '2000-01-01T00:00:00Z')
+        self.assertTrue(models.RefreshLock.objects.exists())
+
+    @override_settings(REFRESH_LOCK_TIMEOUT=0)
+    def testExpiredLockReplaced(self):
+        coalescing.enqueue(self.task, 'Q11005')
+        self.assertTrue(coalescing.enqueue(self.task, 'Q11005'))
+        self.assertEqual(2, self.task.delay.call_count)
+
+    def testAcquireMany(self):
+        coalescing.enqueue(self.task, 'Q11005')
+        acquired = coalescing.acquire(self.task.name, ['Q11005', 'Q11007', 'Q234993'], self.queued_at())
+        self.assertEqual(['Q11007', 'Q234993'], acquired)
+        self.assertEqual(3, models.RefreshLock.objects.count())
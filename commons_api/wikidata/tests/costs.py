@@ -0,0 +1,72 @@
+import unittest.mock
+
+from django.test import TestCase, override_settings
+
+from .. import coalescing, costs, models, utils
+
+TASK_NAME = 'commons_api.wikidata.tasks.legislature.refresh_members'
+
+
+class CostsTestCase(TestCase):
+    def setCost(self, object_id, duration):
+        models.RefreshCost.objects.create(id=models.RefreshCost.make_id(TASK_NAME, object_id), task=TASK_NAME,
+                                          object_id=object_id, runs=1, duration=duration)
+
+    @unittest.mock.patch.object(costs, '_measured', False)
+    @unittest.mock.patch('commons_api.wikidata.utils.wikidata_query_bindings')
+    def testRunMeasured(self, wikidata_query_bindings):
+        wikidata_query_bindings.return_value = iter([{}, {}, {}])
+        with costs.measure(TASK_NAME, 'Q11005'):
+            list(utils.templated_wikidata_query_bindings('wikidata/query/legislature_constituencies.rq',
+                                                         {'house': 'Q11005'}))
+        cost = models.RefreshCost.objects.get()
+        self.assertEqual((TASK_NAME, 'Q11005', 1, 3), (cost.task, cost.object_id, cost.runs, cost.bindings))
+        self.assertEqual(cost.duration, cost.last_duration)
+        self.assertGreater(cost.peak_memory, 0)
+        self.assertIsNotNone(cost.last_run)
+
+    @unittest.mock.patch.object(costs, '_measured', False)
+    def testPeakMemoryOnlyMeasuredForFirstRunInProcess(self):
+        with costs.measure(TASK_NAME, 'Q11005'):
+            pass
+        with costs.measure(TASK_NAME, 'Q11007'):
+            pass
+        self.assertGreater(models.RefreshCost.objects.get(object_id='Q11005').peak_memory, 0)
+        self.assertIsNone(models.RefreshCost.objects.get(object_id='Q11007').peak_memory)
+
+    def testFailedRunNotRecorded(self):
+        with self.assertRaises(ValueError):
+            with costs.measure(TASK_NAME, 'Q11005'):
+                raise ValueError
+        self.assertFalse(models.RefreshCost.objects.exists())
+
+    def testBindingsOutsideRunIgnored(self):
+        costs.add_bindings(10)
+        self.assertIsNone(costs._current)
+
+    def testDurationSmoothed(self):
+        self.setCost('Q11005', 100)
+        run = costs.RunCost(TASK_NAME, 'Q11005')
+        run.duration = 20
+        costs.record(run)
+        cost = models.RefreshCost.objects.get()
+        self.assertEqual((2, 60, 20, 20), (cost.runs, cost.duration, cost.last_duration, cost.max_duration))
+
+    @override_settings(WIKIDATA_HEAVY_TASK_DURATION=60)
+    def testSplitByCost(self):
+        self.setCost('Q11005', 600)
+        self.setCost('Q11007', 5)
+        self.setCost('Q234993', 1)
+        self.assertEqual((['Q1', 'Q234993', 'Q11007'], ['Q11005']),
+                         costs.split_by_cost(TASK_NAME, ['Q1', 'Q11005', 'Q11007', 'Q234993']))
+
+    @override_settings(WIKIDATA_HEAVY_TASK_DURATION=60, WIKIDATA_HEAVY_QUEUE='heavy')
+    def testEnqueueRoutesHeavyObjects(self):
+        self.setCost('Q11005', 600)
+        task = unittest.mock.Mock(last_queued_attribute='refresh_members_last_queued')
+        task.name = TASK_NAME
+        coalescing.enqueue(task, 'Q11005')
+        coalescing.enqueue(task, 'Q11007')
+        task.apply_async.assert_called_once_with(kwargs={'id': 'Q11005', 'queued_at': unittest.mock.ANY},
+                                                 queue='heavy')
+        task.delay.assert_called_once_with(id='Q11007', queued_at=unittest.mock.ANY)
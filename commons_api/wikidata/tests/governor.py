@@ -0,0 +1,126 @@
+import datetime
+import http.client
+import itertools
+import unittest.mock
+
+import celery
+import requests
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from .. import governor, models, utils
+from ..tasks.base import WikidataQueryTask
+
+
+@override_settings(WDQS_MAX_CONCURRENT_QUERIES=2, WDQS_MAX_QUERIES_PER_MINUTE=60)
+class GovernorTestCase(TestCase):
+    def testConcurrentQueriesLimited(self):
+        first, _ = governor.try_acquire()
+        second, _ = governor.try_acquire()
+        third, retry_after = governor.try_acquire()
+        self.assertIsNotNone(first)
+        self.assertIsNotNone(second)
+        self.assertIsNone(third)
+        self.assertGreater(retry_after, 0)
+
+        governor.release(first)
+        models.QueryGovernor.objects.update(tokens=2)
+        fourth, _ = governor.try_acquire()
+        self.assertIsNotNone(fourth)
+
+    def testExpiredLeasesReleased(self):
+        governor.try_acquire()
+        governor.try_acquire()
+        models.QueryLease.objects.update(expires=timezone.now() - datetime.timedelta(1))
+        models.QueryGovernor.objects.update(tokens=2)
+        lease_id, _ = governor.try_acquire()
+        self.assertIsNotNone(lease_id)
+        self.assertEqual(1, models.QueryLease.objects.count())
+
+    def testRateLimited(self):
+        for i in range(2):
+            lease_id, _ = governor.try_acquire()
+            governor.release(lease_id)
+        lease_id, retry_after = governor.try_acquire()
+        self.assertIsNone(lease_id)
+        self.assertAlmostEqual(1, retry_after, places=1)
+
+    def testThrottlingBlocksAndBacksOff(self):
+        governor.record_throttled(30)
+        lease_id, retry_after = governor.try_acquire()
+        self.assertIsNone(lease_id)
+        self.assertAlmostEqual(30, retry_after, places=0)
+        self.assertEqual(2, models.QueryGovernor.objects.get().backoff)
+
+        with self.assertRaises(governor.WDQSThrottled):
+            governor.acquire(max_wait=5)
+
+    def testSuccessRecoversRate(self):
+        governor.record_throttled(0)
+        for i in range(20):
+            governor.record_success()
+        self.assertEqual(1, models.QueryGovernor.objects.get().backoff)
+
+    def testParseRetryAfter(self):
+        self.assertEqual(120, governor.parse_retry_after('120'))
+        self.assertEqual(0, governor.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'))
+        with override_settings(WDQS_DEFAULT_RETRY_AFTER=42):
+            self.assertEqual(42, governor.parse_retry_after(None))
+            self.assertEqual(42, governor.parse_retry_after('soon'))
+
+    @unittest.mock.patch('commons_api.wikidata.utils.get_wdqs_session')
+    def testTooManyRequestsRaisesThrottled(self, get_wdqs_session):
+        response = unittest.mock.MagicMock()
+        response.status_code = http.client.TOO_MANY_REQUESTS
+        response.headers = requests.structures.CaseInsensitiveDict({'Retry-After': '15'})
+        get_wdqs_session.return_value.post.return_value = response
+
+        with self.assertRaises(governor.WDQSThrottled) as cm:
+            utils.wikidata_query('SELECT * {}')
+        self.assertEqual(15, cm.exception.retry_after)
+        self.assertGreater(models.QueryGovernor.objects.get().blocked_until, timezone.now())
+        self.assertEqual(0, models.QueryLease.objects.count())
+
+
+    def streamed_response(self, get_wdqs_session):
+        response = unittest.mock.MagicMock()
+        response.status_code = http.client.OK
+        response.iter_content.return_value = iter([b'{"results": {"bindings": [{"a": 1}', b', {"a": 2}', b']}}'])
+        get_wdqs_session.return_value.post.return_value = response
+
+    @unittest.mock.patch('commons_api.wikidata.utils.get_wdqs_session')
+    def testLeaseRenewedWhileStreaming(self, get_wdqs_session):
+        self.streamed_response(get_wdqs_session)
+        bindings = utils.wikidata_query_bindings('SELECT * {}')
+        # Each reading of the clock is a minute after the last, outlasting the lease between chunks
+        with unittest.mock.patch('time.monotonic', side_effect=itertools.count(0, 60)):
+            self.assertEqual({'a': 1}, next(bindings))
+            models.QueryLease.objects.update(expires=timezone.now() - datetime.timedelta(seconds=1))
+            self.assertEqual({'a': 2}, next(bindings))
+        self.assertGreater(models.QueryLease.objects.get().expires, timezone.now())
+        self.assertEqual([], list(bindings))
+        self.assertEqual(0, models.QueryLease.objects.count())
+
+    @unittest.mock.patch('commons_api.wikidata.utils.get_wdqs_session')
+    def testSuccessRecordedWhenStreamClosedEarly(self, get_wdqs_session):
+        self.streamed_response(get_wdqs_session)
+        governor.record_throttled(0)
+        bindings = utils.wikidata_query_bindings('SELECT * {}')
+        self.assertEqual({'a': 1}, next(bindings))
+        bindings.close()
+        self.assertLess(models.QueryGovernor.objects.get().backoff, 2)
+        self.assertEqual(0, models.QueryLease.objects.count())
+
+
+@celery.shared_task(base=WikidataQueryTask)
+def throttled_task():
+    raise governor.WDQSThrottled(10)
+
+
+class WikidataQueryTaskTestCase(TestCase):
+    def testThrottledTaskIsRetried(self):
+        with unittest.mock.patch.object(throttled_task, 'retry', return_value=celery.exceptions.Retry()) as retry:
+            with self.assertRaises(celery.exceptions.Retry):
+                throttled_task()
+        retry.assert_called_once_with(exc=unittest.mock.ANY, countdown=unittest.mock.ANY)
+        self.assertGreaterEqual(retry.call_args[1]['countdown'], 10)
@@ -0,0 +1,65 @@
+import unittest.mock
+
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from .. import instrumentation, models, utils
+
+
+class InstrumentationTestCase(TestCase):
+    bindings = [{'id': {'type': 'uri', 'value': 'http://www.wikidata.org/entity/Q142'}}]
+
+    def fake_query_bindings(self, query, result_format, metrics):
+        metrics.latency, metrics.bytes = 0.5, 100
+        yield from self.bindings
+
+    def testDescribeContext(self):
+        country = models.Country(id='Q142')
+        self.assertEqual('country=Q142, ids=<3 values>, limit=10',
+                         instrumentation.describe_context({'ids': ['Q1', 'Q2', 'Q3'], 'country': country, 'limit': 10}))
+
+    @unittest.mock.patch('commons_api.wikidata.utils.wikidata_query_bindings')
+    def testQueriesRecorded(self, wikidata_query_bindings):
+        wikidata_query_bindings.side_effect = self.fake_query_bindings
+        for i in range(2):
+            list(utils.templated_wikidata_query_bindings('wikidata/query/legislature_constituencies.rq',
+                                                         {'house': 'Q1'}))
+        stats = models.QueryTemplateStats.objects.get()
+        self.assertEqual('wikidata/query/legislature_constituencies.rq', stats.template)
+        self.assertEqual(2, stats.queries)
+        self.assertEqual(1.0, stats.latency)
+        self.assertEqual(200, stats.bytes)
+        self.assertEqual(2, stats.bindings)
+        self.assertEqual('house=Q1', stats.slowest_context)
+        self.assertGreater(stats.render_time, 0)
+        self.assertGreaterEqual(stats.duration, stats.max_duration)
+
+    @unittest.mock.patch('commons_api.wikidata.utils.wikidata_query')
+    def testErrorsRecorded(self, wikidata_query):
+        wikidata_query.side_effect = utils.WDQSTimeout
+        with self.assertRaises(utils.WDQSTimeout):
+            utils.templated_wikidata_query('wikidata/query/country_list.rq', {})
+        stats = models.QueryTemplateStats.objects.get()
+        self.assertEqual((1, 1, 1, 0), (stats.queries, stats.errors, stats.timeouts, stats.throttled))
+        self.assertIn('WDQSTimeout', stats.last_error)
+        self.assertIsNotNone(stats.last_error_at)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                               'wdqs': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                       WDQS_CACHE_TIMEOUTS={'wikidata/query/labels.rq': 60})
+    @unittest.mock.patch('commons_api.wikidata.utils.wikidata_query_bindings')
+    def testCacheHitsCountedSeparately(self, wikidata_query_bindings):
+        caches['wdqs'].clear()
+        wikidata_query_bindings.side_effect = self.fake_query_bindings
+        for i in range(3):
+            list(utils.templated_wikidata_query_bindings('wikidata/query/labels.rq', {'ids': ['Q142']}))
+        stats = models.QueryTemplateStats.objects.get()
+        self.assertEqual((1, 2), (stats.queries, stats.cache_hits))
+        self.assertEqual(1, stats.bindings)
+
+    @override_settings(WDQS_INSTRUMENTATION_ENABLED=False)
+    @unittest.mock.patch('commons_api.wikidata.utils.wikidata_query_bindings')
+    def testDisabled(self, wikidata_query_bindings):
+        wikidata_query_bindings.side_effect = self.fake_query_bindings
+        list(utils.templated_wikidata_query_bindings('wikidata/query/labels.rq', {'ids': ['Q142']}))
+        self.assertFalse(models.QueryTemplateStats.objects.exists())
@@ -0,0 +1,152 @@
+import datetime
+import unittest.mock
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from .. import coalescing, models, signals
+from ..governor import WDQSThrottled
+from ..progress import Progress
+from ..tasks import legislature, pipeline
+
+
+class PipelineTestCase(TestCase):
+    @unittest.mock.patch.object(pipeline.run_stage, 'delay')
+    def setUp(self, run_stage_delay):
+        self.run = pipeline.start()
+        run_stage_delay.assert_called_once_with(self.run.id, 'countries')
+
+    def stage(self, name):
+        return models.PipelineStage.objects.get(run=self.run, name=name)
+
+    def testStartCreatesStages(self):
+        self.assertEqual(['countries', 'legislatures', 'districts', 'members', 'labels', 'boundaries'],
+                         list(self.run.stages.values_list('name', flat=True)))
+        self.assertEqual(self.run, pipeline.active_run())
+
+    def testStartWhileRunningReturnsRun(self):
+        with unittest.mock.patch.object(pipeline.run_stage, 'delay') as run_stage_delay:
+            self.assertEqual(self.run, pipeline.start())
+        run_stage_delay.assert_not_called()
+
+    @unittest.mock.patch.object(pipeline.run_stage, 'delay')
+    def testFinishStageStartsNext(self, run_stage_delay):
+        pipeline.finish_stage(self.run.id, 'countries')
+        run_stage_delay.assert_called_once_with(self.run.id, 'legislatures')
+        self.assertEqual(models.PipelineStage.FINISHED, self.stage('countries').status)
+
+    def testLastStageFinishesRun(self):
+        receiver = unittest.mock.Mock()
+        signals.bootstrap_finished.connect(receiver)
+        self.addCleanup(signals.bootstrap_finished.disconnect, receiver)
+        pipeline.finish_stage(self.run.id, 'boundaries')
+        self.run.refresh_from_db()
+        self.assertEqual(models.PipelineRun.FINISHED, self.run.status)
+        self.assertIsNotNone(self.run.finished_at)
+        receiver.assert_called_once_with(signal=signals.bootstrap_finished, sender=models.PipelineRun, run=self.run)
+        self.assertIsNone(pipeline.active_run())
+
+    @unittest.mock.patch.object(pipeline, 'celery')
+    def testStageRunsBoundedLanes(self, celery):
+        with override_settings(PIPELINE_CONCURRENCY={'labels': 2}):
+            pipeline.run_stage(self.run.id, 'labels')
+        lanes = [lane.args[2] for lane in celery.chord.call_args[0][0]]
+        self.assertEqual(2, len(lanes))
+        self.assertIn('wikidata.country', lanes[0] + lanes[1])
+        stage = self.stage('labels')
+        self.assertEqual((models.PipelineStage.RUNNING, len(lanes[0] + lanes[1])), (stage.status, stage.total))
+
+    @unittest.mock.patch.object(pipeline, 'celery')
+    @unittest.mock.patch('commons_api.proto_commons.tasks.get_commons_repos')
+    def testBoundariesStageRunsEachRepoOnShapefilesQueue(self, get_commons_repos, celery):
+        get_commons_repos.return_value = iter([('Q145', 'mysociety/uk-commons'), ('Q16', 'mysociety/ca-commons')])
+        pipeline.run_stage(self.run.id, 'boundaries')
+        lanes = celery.chord.call_args[0][0]
+        self.assertEqual([[['Q145', 'mysociety/uk-commons']], [['Q16', 'mysociety/ca-commons']]],
+                         [lane.args[2] for lane in lanes])
+        self.assertEqual({'shapefiles'}, {lane.options['queue'] for lane in lanes})
+        # The run only finishes once the imports have, as the chord's callback
+        self.assertEqual(pipeline.finish_stage.si(self.run.id, 'boundaries'), celery.chord.return_value.call_args[0][0])
+
+        with unittest.mock.patch('commons_api.proto_commons.tasks.import_boundaries_for_country') as import_boundaries:
+            pipeline.run_lane(self.run.id, 'boundaries', [['Q145', 'mysociety/uk-commons']])
+        import_boundaries.assert_called_once_with('Q145', 'mysociety/uk-commons')
+        self.assertEqual(1, self.stage('boundaries').done)
+
+    def testLaneCountsDoneAndFailed(self):
+        with unittest.mock.patch.object(pipeline.STAGES_BY_NAME['labels'], 'run_item') as run_item:
+            run_item.side_effect = [None, ValueError, None]
+            pipeline.run_lane(self.run.id, 'labels', ['wikidata.country', 'wikidata.person', 'wikidata.term'])
+        stage = self.stage('labels')
+        self.assertEqual((2, 1), (stage.done, stage.failed))
+
+    def testLanePublishesProgress(self):
+        with unittest.mock.patch.object(pipeline.STAGES_BY_NAME['labels'], 'run_item') as run_item, \
+                unittest.mock.patch.object(pipeline.run_lane, 'update_state') as update_state:
+            run_item.side_effect = lambda stage, item: Progress('refresh_labels ' + item).phase('fetch')
+            pipeline.run_lane.apply(args=(self.run.id, 'labels', ['wikidata.country', 'wikidata.person']))
+        self.assertEqual(['refresh_labels wikidata.country', 'refresh_labels wikidata.person'],
+                         [call[1]['meta']['description'] for call in update_state.call_args_list])
+        self.assertEqual(2, self.stage('labels').done)
+
+    def testThrottledLaneRetriesRemaining(self):
+        with unittest.mock.patch.object(pipeline.STAGES_BY_NAME['labels'], 'run_item') as run_item, \
+                unittest.mock.patch.object(pipeline.run_lane, 'retry', side_effect=RuntimeError) as retry:
+            run_item.side_effect = [None, WDQSThrottled(10)]
+            with self.assertRaises(RuntimeError):
+                pipeline.run_lane(self.run.id, 'labels', ['wikidata.country', 'wikidata.person', 'wikidata.term'])
+        self.assertEqual((self.run.id, 'labels', ['wikidata.person', 'wikidata.term']), retry.call_args[1]['args'])
+        self.assertGreaterEqual(retry.call_args[1]['countdown'], 10)
+        self.assertEqual(1, self.stage('labels').done)
+
+    def testResumeStalledRun(self):
+        models.PipelineStage.objects.filter(run=self.run, name='countries').update(
+            status=models.PipelineStage.FINISHED)
+        with self.assertRaises(ValueError):
+            pipeline.resume(self.run.id)
+        models.PipelineRun.objects.update(last_activity=timezone.now() - datetime.timedelta(days=1))
+        self.assertIsNone(pipeline.active_run())
+        with unittest.mock.patch.object(pipeline.run_stage, 'delay') as run_stage_delay:
+            pipeline.resume(self.run.id)
+        run_stage_delay.assert_called_once_with(self.run.id, 'legislatures')
+        self.assertEqual(self.run, pipeline.active_run())
+
+
+class PipelineHousesTestCase(TestCase):
+    @unittest.mock.patch.object(pipeline.run_stage, 'delay')
+    def setUp(self, run_stage_delay):
+        self.run = pipeline.start()
+        country = models.Country.objects.create(id='Q145')
+        administrative_area = models.AdministrativeArea.objects.create(id='Q145')
+        for id in ('Q11005', 'Q11007', 'Q234993'):
+            models.LegislativeHouse.objects.create(id=id, country=country, administrative_area=administrative_area)
+
+    def testCreatingHousesDoesntQueueRefreshes(self):
+        self.assertFalse(models.RefreshLock.objects.exists())
+        self.assertIsNone(models.LegislativeHouse.objects.get(id='Q11005').refresh_members_last_queued)
+
+    @unittest.mock.patch.object(pipeline, 'celery')
+    def testObjectStageTakesLocksAndBalancesLanes(self, celery):
+        task_name = legislature.refresh_members.name
+        models.RefreshCost.objects.create(id=models.RefreshCost.make_id(task_name, 'Q11005'), task=task_name,
+                                          object_id='Q11005', runs=1, duration=600)
+        coalescing.acquire(task_name, ['Q234993'], timezone.now())
+        with override_settings(PIPELINE_CONCURRENCY={'members': 2}):
+            pipeline.run_stage(self.run.id, 'members')
+        lanes = [lane.args[2] for lane in celery.chord.call_args[0][0]]
+        self.assertEqual([['Q11005'], ['Q11007']], lanes)
+        stage = models.PipelineStage.objects.get(run=self.run, name='members')
+        self.assertEqual((2, 0, 1), (stage.total - stage.skipped, stage.done, stage.skipped))
+        self.assertEqual(2, models.LegislativeHouse.objects.filter(refresh_members_last_queued=stage.queued_at).count())
+
+    @unittest.mock.patch.object(pipeline, 'celery')
+    def testResumedObjectStageSkipsRefreshedHouses(self, celery):
+        stage = models.PipelineStage.objects.get(run=self.run, name='districts')
+        stage.started_at = timezone.now() - datetime.timedelta(hours=1)
+        stage.save()
+        models.LegislativeHouse.objects.filter(id='Q11005').update(refresh_districts_last_refreshed=timezone.now())
+        pipeline.run_stage(self.run.id, 'districts')
+        stage.refresh_from_db()
+        self.assertEqual((3, 1), (stage.total, stage.done))
+        self.assertEqual(['Q11007', 'Q234993'],
+                         sorted(item for lane in celery.chord.call_args[0][0] for item in lane.args[2]))
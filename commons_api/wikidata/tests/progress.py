@@ -0,0 +1,46 @@
+import unittest.mock
+
+from django.test import SimpleTestCase, override_settings
+
+from .. import progress
+
+
+class ProgressTestCase(SimpleTestCase):
+    def setUp(self):
+        self.task = unittest.mock.Mock()
+        self.task.request.called_directly = False
+
+    def testPublishesPhases(self):
+        p = progress.Progress('refresh_members Q11005', task=self.task)
+        p.phase('write', total=10)
+        meta = self.task.update_state.call_args[1]['meta']
+        self.assertEqual(progress.PROGRESS, self.task.update_state.call_args[1]['state'])
+        self.assertEqual(('refresh_members Q11005', 'write', 0, 10), (meta['description'], meta['phase'], meta['rows'],
+                                                                      meta['total']))
+
+    @override_settings(INGEST_PROGRESS_INTERVAL=3600)
+    def testAdvanceDoesntPublishTooOften(self):
+        p = progress.Progress('refresh_members Q11005', task=self.task)
+        p.phase('fetch')
+        self.assertEqual(['a', 'b'], list(p.iterate(['a', 'b'])))
+        self.assertEqual(1, self.task.update_state.call_count)
+        self.assertEqual(2, p.rows)
+
+    @override_settings(INGEST_PROGRESS_INTERVAL=0)
+    def testRateAndEta(self):
+        p = progress.Progress('refresh_members Q11005', task=self.task)
+        p.phase('write', total=4)
+        with unittest.mock.patch('time.monotonic', return_value=p.phase_start + 2):
+            p.advance(1)
+        meta = self.task.update_state.call_args[1]['meta']
+        self.assertEqual((1, 0.5, 6.0), (meta['rows'], meta['rate'], meta['eta']))
+
+    def testNotPublishedWhenCalledDirectly(self):
+        self.task.request.called_directly = True
+        progress.Progress('refresh_members Q11005', task=self.task).phase('fetch')
+        self.task.update_state.assert_not_called()
+
+    def testPublishedAsEnclosingTask(self):
+        with progress.published_as(self.task):
+            progress.Progress('refresh_members Q11005').phase('fetch')
+        self.assertEqual('fetch', self.task.update_state.call_args[1]['meta']['phase'])
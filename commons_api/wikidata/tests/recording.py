@@ -0,0 +1,181 @@
+import datetime
+import json
+import shutil
+import tempfile
+import threading
+import unittest.mock
+
+import requests
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from .. import models, namespaces, recording, sparql, utils
+from ..tasks import legislature
+
+JSON = 'application/sparql-results+json'
+TSV = 'text/tab-separated-values'
+
+
+class ReplayServerTestCase(TestCase):
+    results = {'head': {'vars': ['item']},
+               'results': {'bindings': [{'item': {'type': 'uri', 'value': 'http://www.wikidata.org/entity/Q142'}}]}}
+
+    def setUp(self):
+        self.fixtures_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.fixtures_directory)
+        self.server = recording.ReplayServer(('127.0.0.1', 0), self.fixtures_directory)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        settings_override = override_settings(WDQS_URL=self.server.url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def testReplaysRecordedResponse(self):
+        query = 'SELECT ?item { VALUES ?item { wd:Q142 } }'
+        recording.save_fixture(self.fixtures_directory, query, JSON, json.dumps(self.results).encode(), JSON)
+        self.assertEqual(self.results, utils.wikidata_query(query))
+        self.assertEqual(self.results['results']['bindings'], list(utils.wikidata_query_bindings(query)))
+        self.assertEqual(2, self.server.stats['requests'])
+
+    def testMissingFixture(self):
+        with self.assertRaises(requests.HTTPError):
+            utils.wikidata_query('SELECT ?item { }')
+        self.assertEqual(1, self.server.stats['missing'])
+
+    def testRecordsResponses(self):
+        query = 'SELECT ?item { VALUES ?item { wd:Q142 } }'
+        recording.save_fixture(self.fixtures_directory, query, JSON, json.dumps(self.results).encode(), JSON)
+        record_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, record_directory)
+        with override_settings(WDQS_RECORD_DIR=record_directory):
+            self.assertEqual(self.results['results']['bindings'], list(utils.wikidata_query_bindings(query)))
+        body, content_type = recording.load_fixture(record_directory, query, JSON)
+        self.assertEqual(self.results, json.loads(body.decode()))
+
+    @unittest.mock.patch.object(legislature.refresh_members, 'delay')
+    @unittest.mock.patch.object(legislature.refresh_districts, 'delay')
+    @unittest.mock.patch.object(legislature.refresh_legislatures, 'delay')
+    def testRefreshDistricts(self, *delays):
+        queued_at = timezone.now()
+        country = models.Country.objects.create(id='Q145')
+        administrative_area = models.AdministrativeArea.objects.create(id='Q145')
+        house = models.LegislativeHouse.objects.create(id='Q11005', country=country,
+                                                       administrative_area=administrative_area,
+                                                       refresh_districts_last_queued=queued_at)
+        query = sparql.render_query('wikidata/query/legislature_constituencies.rq', {'house': house})
+        recording.save_fixture(self.fixtures_directory, query, TSV, '\n'.join([
+            '?constituency\t?constituencyLabel\t?start\t?end',
+            '<http://www.wikidata.org/entity/Q1146817>\t"Oxford East"@en\t'
+            '"1983-06-09T00:00:00Z"^^<http://www.w3.org/2001/XMLSchema#dateTime>\t',
+        ]).encode(), TSV)
+
+        legislature.refresh_districts(house.id, queued_at)
+
+        district = models.ElectoralDistrict.objects.get()
+        self.assertEqual('Q1146817', district.id)
+        self.assertEqual({'en': 'Oxford East'}, district.labels)
+        self.assertEqual(datetime.date(1983, 6, 9), district.start)
+        self.assertEqual(house, district.legislative_house)
+
+    def literal(self, value, **kwargs):
+        return dict({'type': 'literal', 'value': value}, **kwargs)
+
+    def uri(self, id):
+        return {'type': 'uri', 'value': namespaces.WD[id]}
+
+    @unittest.mock.patch.object(legislature.refresh_members, 'delay')
+    @unittest.mock.patch.object(legislature.refresh_districts, 'delay')
+    @unittest.mock.patch.object(legislature.refresh_legislatures, 'delay')
+    def testRefreshLegislatures(self, *delays):
+        queued_at = timezone.now()
+        country = models.Country.objects.create(id='Q145', refresh_legislatures_last_queued=queued_at)
+        query = sparql.render_query('wikidata/query/legislature_list.rq', {'country': country})
+        recording.save_fixture(self.fixtures_directory, query, JSON, json.dumps({
+            'head': {'vars': ['legislature', 'legislatureLabel', 'adminArea', 'adminAreaLabel', 'legislaturePost',
+                              'legislaturePostLabel', 'numberOfSeats']},
+            'results': {'bindings': [
+                {'legislature': self.uri('Q11005'), 'legislatureLabel': self.literal('House of Commons', lang='en'),
+                 'adminArea': self.uri('Q145'), 'adminAreaLabel': self.literal('United Kingdom', lang='en'),
+                 'legislaturePost': self.uri('Q16707842'),
+                 'legislaturePostLabel': self.literal('Member of the House of Commons', lang='en'),
+                 'numberOfSeats': self.literal('650', datatype='http://www.w3.org/2001/XMLSchema#decimal')},
+                {'legislature': self.uri('Q11007'), 'legislatureLabel': self.literal('House of Lords', lang='en'),
+                 'adminArea': self.uri('Q145'), 'adminAreaLabel': self.literal('United Kingdom', lang='en')},
+            ]},
+        }).encode(), JSON)
+        query = sparql.render_query('wikidata/query/legislature_terms_list.rq',
+                                    {'house_positions': [{'house': 'Q11005', 'position': 'Q16707842'}]})
+        recording.save_fixture(self.fixtures_directory, query, JSON, json.dumps({
+            'head': {'vars': ['house', 'houseLabel', 'term', 'termLabel', 'termStart', 'termEnd']},
+            'results': {'bindings': [
+                {'house': self.uri('Q11005'), 'houseLabel': self.literal('House of Commons', lang='en'),
+                 'term': self.uri('Q29974940'),
+                 'termLabel': self.literal('57th United Kingdom Parliament', lang='en'),
+                 'termStart': self.literal('2017-06-13T00:00:00Z',
+                                           datatype='http://www.w3.org/2001/XMLSchema#dateTime')},
+            ]},
+        }).encode(), JSON)
+
+        summary = legislature.refresh_legislatures(country.id, queued_at)
+
+        self.assertEqual({'houses': 2, 'created': ['Q11005', 'Q11007'], 'terms': 1, 'house_terms_removed': 0},
+                         summary)
+        commons = models.LegislativeHouse.objects.get(id='Q11005')
+        self.assertEqual(({'en': 'House of Commons'}, 650), (commons.labels, commons.number_of_seats))
+        self.assertEqual(['Q16707842'], [position.id for position in commons.positions.all()])
+        self.assertEqual({'en': 'Member of the House of Commons'}, models.Position.objects.get(id='Q16707842').labels)
+        term = models.LegislativeTerm.objects.get()
+        self.assertEqual(('Q29974940', datetime.date(2017, 6, 13)), (term.id, term.start))
+        self.assertEqual([('Q11005', 'Q29974940')],
+                         list(models.LegislativeHouseTerm.objects.values_list('legislative_house_id',
+                                                                              'legislative_term_id')))
+        self.assertEqual(2, self.server.stats['requests'])
+
+    @unittest.mock.patch.object(legislature.refresh_members, 'delay')
+    @unittest.mock.patch.object(legislature.refresh_districts, 'delay')
+    @unittest.mock.patch.object(legislature.refresh_legislatures, 'delay')
+    def testRefreshMembers(self, *delays):
+        queued_at = timezone.now()
+        country = models.Country.objects.create(id='Q145')
+        administrative_area = models.AdministrativeArea.objects.create(id='Q145')
+        house = models.LegislativeHouse.objects.create(id='Q11005', country=country,
+                                                       administrative_area=administrative_area,
+                                                       refresh_members_last_queued=queued_at)
+        position = models.Position.objects.create(id='Q16707842')
+        house.positions.add(position)
+        models.LegislativeTerm.objects.create(id='Q29974940', start=datetime.date(2017, 6, 13))
+        query = sparql.render_query('wikidata/query/legislature_memberships.rq', {'positions': [position]})
+
+        def row(statement, person, person_label, party, party_label, district, district_label, start=''):
+            return '\t'.join([
+                '<{}>'.format(namespaces.WDS[statement]), '<{}>'.format(namespaces.WD[person]),
+                '"{}"@en'.format(person_label), '', '', '<{}>'.format(namespaces.WD[party]),
+                '"{}"@en'.format(party_label), '<{}>'.format(namespaces.WD[district]), '"{}"@en'.format(district_label),
+                '<{}>'.format(namespaces.WD['Q16707842']), '"Member of the House of Commons"@en',
+                '<{}>'.format(namespaces.WD['Q29974940']), '"57th United Kingdom Parliament"@en', '', '',
+                '"{}T00:00:00Z"^^<http://www.w3.org/2001/XMLSchema#dateTime>'.format(start) if start else '',
+                '', '', '', '', ''])
+
+        recording.save_fixture(self.fixtures_directory, query, TSV, '\n'.join([
+            '\t'.join(['?statement', '?person', '?personLabel', '?group', '?groupLabel', '?party', '?partyLabel',
+                       '?district', '?districtLabel', '?role', '?roleLabel', '?term', '?termLabel', '?termStart',
+                       '?termEnd', '?start', '?end', '?endCause', '?endCauseLabel', '?subjectHasRole',
+                       '?subjectHasRoleLabel']),
+            row('Q264766-9C3E7BD2-4FEF-4D5E-8A54-1F5C0E7A2B31', 'Q264766', 'Theresa May', 'Q9626',
+                'Conservative Party', 'Q1468432', 'Maidenhead'),
+            row('Q291169-0E1B6C8F-2A7D-4C36-9D1E-5B8F3A6C4D20', 'Q291169', 'Jeremy Corbyn', 'Q9630', 'Labour Party',
+                'Q1543620', 'Islington North', start='2017-06-08'),
+        ]).encode(), TSV)
+
+        summary = legislature.refresh_members(house.id, queued_at)
+
+        self.assertEqual({'memberships': 2, 'written': 2, 'removed': 0}, summary)
+        may, corbyn = models.LegislativeMembership.objects.order_by('person_id')
+        self.assertEqual(('Q264766', 'Q9626', 'Q1468432', datetime.date(2017, 6, 13)),
+                         (may.person_id, may.party_id, may.district_id, may.start))
+        self.assertEqual(['Q29974940'], [term.id for term in may.legislative_terms.all()])
+        self.assertEqual(datetime.date(2017, 6, 8), corbyn.start)
+        self.assertEqual({'en': 'Theresa May'}, models.Person.objects.get(id='Q264766').labels)
+        self.assertEqual({'en': 'Islington North'}, models.ElectoralDistrict.objects.get(id='Q1543620').labels)
+        self.assertEqual(1, self.server.stats['requests'])
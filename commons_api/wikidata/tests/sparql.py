@@ -0,0 +1,28 @@
+from django.test import TestCase
+
+from .. import sparql
+
+
+class QueryRenderingTestCase(TestCase):
+    def testIdValues(self):
+        query = sparql.render_query('wikidata/query/labels.rq', {'ids': ['Q1', 'Q2']})
+        self.assertIn('VALUES ?id { wd:Q1 wd:Q2 }', query)
+
+    def testModelValues(self):
+        class Position:
+            def __init__(self, id):
+                self.id = id
+        query = sparql.render_query('wikidata/query/legislature_memberships.rq',
+                                    {'positions': [Position('Q18941264'), Position('Q486839')]})
+        self.assertIn('VALUES ?role { wd:Q18941264 wd:Q486839 }', query)
+
+    def testValueRows(self):
+        query = sparql.render_query('wikidata/query/legislature_terms_list.rq',
+                                    {'house_positions': [{'house': 'Q11005', 'position': 'Q16707842'},
+                                                         {'house': 'Q11007', 'position': None}]})
+        self.assertIn('(wd:Q11005 wd:Q16707842)\n(wd:Q11007 rdf:nil)', query)
+
+    def testInvalidIdsRejected(self):
+        for id in ['Q1 } DELETE', 'Q01', '', None]:
+            with self.subTest(id=id), self.assertRaises(ValueError):
+                sparql.render_query('wikidata/query/labels.rq', {'ids': [id]})
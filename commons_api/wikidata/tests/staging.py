@@ -0,0 +1,77 @@
+import contextlib
+import unittest.mock
+
+from django.db import connection
+from django.test import SimpleTestCase, override_settings
+
+from .. import models, staging, utils
+from . import updating
+
+
+@contextlib.contextmanager
+def fetched_outside_transaction(test):
+    """Fails `test` if query results are read within a transaction opened after entering this
+
+    Query results are read lazily, and reading them is when queries are actually made."""
+    depth = len(connection.savepoint_ids)
+    iter_sparql_tsv_rows = utils.iter_sparql_tsv_rows
+
+    def check_depth(lines):
+        for row in iter_sparql_tsv_rows(lines):
+            test.assertEqual(depth, len(connection.savepoint_ids), "Query results were read within a transaction")
+            yield row
+
+    with unittest.mock.patch.object(utils, 'iter_sparql_tsv_rows', check_depth):
+        yield
+
+
+class CopyFileTestCase(SimpleTestCase):
+    def testEncodesValues(self):
+        self.assertEqual('\\N', staging.copy_value(None))
+        self.assertEqual('a\\tb\\nc\\\\d\\re', staging.copy_value('a\tb\nc\\d\re'))
+        self.assertEqual('1', staging.copy_value(1))
+
+    def testReadsInChunks(self):
+        copy_file = staging.CopyFile([('a', None), ('b\tc', 2)])
+        chunks = iter(lambda: copy_file.read(3), '')
+        self.assertEqual('a\t\\N\nb\\tc\t2\n', ''.join(chunks))
+
+    def testReadsEverything(self):
+        self.assertEqual('a\nb\n', staging.CopyFile([('a',), ('b',)]).read())
+
+    def testSpoolsRows(self):
+        rows = iter([('a', None), ('b', 2)])
+        with staging.spool(rows) as file:
+            self.assertIsNone(next(rows, None))
+            self.assertEqual('a\t\\N\nb\t2\n', file.read())
+
+
+@override_settings(WIKIDATA_INGEST_MODE='staging')
+class StagingMembersTestCase(updating.MembersTestCase):
+    def testUnchangedMembershipsSkipped(self):
+        rows = [self.row('Q1-A', 'Q1', term='Q21084472', group='Q9630')]
+        self.assertEqual({'memberships': 1, 'written': 1, 'removed': 1}, self.refresh_members(rows))
+        self.assertEqual({'memberships': 1, 'written': 0, 'removed': 0}, self.refresh_members(rows))
+        self.refresh_members([self.row('Q1-A', 'Q1', term='Q21084472', group='Q9631')])
+        self.assertEqual('Q9631', models.LegislativeMembership.objects.get().parliamentary_group_id)
+
+    def testFetchesOutsideTransaction(self):
+        with fetched_outside_transaction(self):
+            self.refresh_members([self.row('Q1-A', 'Q1', term='Q21084472', group='Q9630')])
+
+
+@override_settings(WIKIDATA_INGEST_MODE='staging')
+class StagingDistrictsTestCase(updating.DistrictsTestCase):
+    def testRefreshDistricts(self):
+        summary = self.refresh_districts(('Q1146817', 'Oxford East'), ('Q2000000', 'Oxford West and Abingdon'),
+                                         ('Q2000000', 'Oxford West and Abingdon'))
+
+        # Unlike in the default mode, districts whose data hasn't changed aren't written
+        self.assertEqual({'districts': 2, 'created': ['Q2000000'], 'updated': [], 'removed': ['Q1-stale']}, summary)
+        self.assertEqual({'Q1146817', 'Q2000000'}, set(self.house.electoraldistrict_set.values_list('id', flat=True)))
+        self.assertEqual({'en': 'Oxford West and Abingdon'}, models.ElectoralDistrict.objects.get(id='Q2000000').labels)
+        self.assertIsNone(models.ElectoralDistrict.objects.get(id='Q1-stale').legislative_house)
+
+    def testFetchesOutsideTransaction(self):
+        with fetched_outside_transaction(self):
+            self.refresh_districts(('Q1146817', 'Oxford East'))
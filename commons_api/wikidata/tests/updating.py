@@ -1,11 +1,13 @@
 import datetime
 import unittest.mock
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.utils import timezone
 
-from .. import models, namespaces
-from ..tasks import legislature, wikidata_item
+from .. import coalescing, models, namespaces, signals, utils
+from ..governor import WDQSThrottled
+from ..progress import Progress
+from ..tasks import country, legislature, wikidata_item
 
 
 class LabelsTestCase(TestCase):
@@ -39,18 +41,376 @@ class LabelsTestCase(TestCase):
         self.country.refresh_from_db()
         self.assertEqual(self.country.refresh_labels_last_queued, self.refresh_labels_last_queued)
 
-    @unittest.mock.patch('commons_api.wikidata.utils.templated_wikidata_query')
-    def testRefreshForModelRefreshesMatchingLastQueued(self, templated_wikidata_query):
-        templated_wikidata_query.return_value = {
-            'results': {'bindings': [{
-                'id': {'value': namespaces.WD[self.country.id]},
-                'label': {'value': 'France', 'xml:lang': 'en'},
-            }, {
-                'id': {'value': namespaces.WD[self.country.id]},
-                'label': {'value': 'Frankreich', 'xml:lang': 'de'},
-            }]}
-        }
-        wikidata_item.refresh_labels('wikidata', 'country', queued_at=self.refresh_labels_last_queued)
-        templated_wikidata_query.assert_called_once_with('wikidata/query/labels.rq', {'ids': [self.country.id]})
+    @override_settings(WIKIDATA_INCREMENTAL_REFRESH=False)
+    @unittest.mock.patch('commons_api.wikidata.utils.templated_wikidata_query_bindings')
+    def testRefreshForModelRefreshesMatchingLastQueued(self, templated_wikidata_query_bindings):
+        templated_wikidata_query_bindings.return_value = iter([{
+            'id': {'value': namespaces.WD[self.country.id]},
+            'label': {'value': 'France', 'xml:lang': 'en'},
+        }, {
+            'id': {'value': namespaces.WD[self.country.id]},
+            'label': {'value': 'Frankreich', 'xml:lang': 'de'},
+        }])
+        updated = wikidata_item.refresh_labels('wikidata', 'country', queued_at=self.refresh_labels_last_queued)
+        templated_wikidata_query_bindings.assert_called_once_with('wikidata/query/labels.rq',
+                                                                  {'ids': [self.country.id]},
+                                                                  use_cache=True)
+        self.assertEqual({'wikidata.Country': 1}, updated)
         self.country.refresh_from_db()
         self.assertEqual({'en': 'France', 'de': 'Frankreich'}, self.country.labels)
+
+    @override_settings(WIKIDATA_INCREMENTAL_REFRESH=False)
+    @unittest.mock.patch('commons_api.wikidata.utils.templated_wikidata_query_bindings')
+    def testUnchangedLabelsNotWritten(self, templated_wikidata_query_bindings):
+        models.Country.objects.update(labels={'en': 'France'})
+        templated_wikidata_query_bindings.return_value = iter([{
+            'id': {'value': namespaces.WD[self.country.id]},
+            'label': {'value': 'France', 'xml:lang': 'en'},
+        }])
+        with unittest.mock.patch.object(models.Country.objects, 'bulk_update') as bulk_update:
+            updated = wikidata_item.refresh_labels('wikidata', 'country')
+        self.assertEqual({'wikidata.Country': 0}, updated)
+        bulk_update.assert_not_called()
+
+    @unittest.mock.patch('commons_api.wikidata.utils.templated_wikidata_query_bindings')
+    def testRefreshAllLabels(self, templated_wikidata_query_bindings):
+        templated_wikidata_query_bindings.return_value = iter([{
+            'id': {'value': namespaces.WD[self.country.id]},
+            'label': {'value': 'France', 'xml:lang': 'en'},
+        }])
+        wikidata_item.refresh_all_labels()
+        templated_wikidata_query_bindings.assert_called_once_with('wikidata/query/labels.rq',
+                                                                  {'ids': [self.country.id]},
+                                                                  use_cache=True)
+        self.country.refresh_from_db()
+        self.assertEqual({'en': 'France'}, self.country.labels)
+        self.assertGreater(self.country.refresh_labels_last_queued, self.refresh_labels_last_queued)
+
+
+class LegislaturesTestCase(TestCase):
+    def binding(self, **values):
+        def value(name, value):
+            if name.endswith('Label') or name.startswith('numberOf'):
+                return {'type': 'literal', 'value': value}
+            elif name in ('termStart', 'termEnd'):
+                return {'type': 'literal', 'value': value + 'T00:00:00Z'}
+            return {'type': 'uri', 'value': namespaces.WD[value]}
+        return {name: value(name, v) for name, v in values.items()}
+
+    @unittest.mock.patch.object(legislature.refresh_members, 'delay')
+    @unittest.mock.patch.object(legislature.refresh_districts, 'delay')
+    @unittest.mock.patch.object(legislature.refresh_legislatures, 'delay')
+    def setUp(self, *delays):
+        self.queued_at = timezone.now()
+        self.country = models.Country.objects.create(id='Q145', refresh_legislatures_last_queued=self.queued_at)
+        administrative_area = models.AdministrativeArea.objects.create(id='Q145', labels={'en': 'United Kingdom'})
+        models.LegislativeHouse.objects.create(id='Q11005', labels={'en': 'House of Commons'}, country=self.country,
+                                               administrative_area=administrative_area,
+                                               refresh_members_last_queued=self.queued_at,
+                                               refresh_districts_last_queued=self.queued_at)
+        models.LegislativeTerm.objects.create(id='Q1-stale')
+        models.LegislativeHouseTerm.objects.create(legislative_house_id='Q11005', legislative_term_id='Q1-stale')
+
+    @unittest.mock.patch.object(legislature.refresh_members, 'delay')
+    @unittest.mock.patch.object(legislature.refresh_districts, 'delay')
+    @unittest.mock.patch.object(legislature, 'sharded_wikidata_query_bindings')
+    @unittest.mock.patch.object(legislature, 'templated_wikidata_query_bindings')
+    def testRefreshLegislatures(self, templated_wikidata_query_bindings, sharded_wikidata_query_bindings,
+                                refresh_districts_delay, refresh_members_delay):
+        templated_wikidata_query_bindings.return_value = [
+            self.binding(adminArea='Q145', adminAreaLabel='United Kingdom', legislature='Q11005',
+                         legislatureLabel='House of Commons', legislaturePost='Q16707842',
+                         legislaturePostLabel='Member of Parliament', numberOfSeats='650'),
+            self.binding(adminArea='Q22', adminAreaLabel='Scotland', legislature='Q234993',
+                         legislatureLabel='Scottish Parliament', legislaturePost='Q1711695',
+                         legislaturePostLabel='Member of the Scottish Parliament'),
+            self.binding(adminArea='Q22', adminAreaLabel='Scotland', legislature='Q234993',
+                         legislatureLabel='Scottish Parliament', legislaturePost='Q1711695',
+                         legislaturePostLabel='Member of the Scottish Parliament'),
+        ]
+        sharded_wikidata_query_bindings.return_value = [
+            self.binding(house='Q11005', term='Q21084472', termLabel='56th Parliament', termStart='2015-05-18',
+                         termSpecificPosition='Q30524710', termSpecificPositionLabel='MP in the 56th Parliament'),
+            self.binding(house='Q11005', term='Q29974940', termLabel='57th Parliament', termStart='2017-06-13'),
+            self.binding(house='Q234993', term='Q21084472', termLabel='56th Parliament', termStart='2015-05-18'),
+        ]
+
+        summary = legislature.refresh_legislatures(self.country.id, self.queued_at)
+
+        self.assertEqual({'houses': 2, 'created': ['Q234993'], 'terms': 2, 'house_terms_removed': 1}, summary)
+        house = models.LegislativeHouse.objects.get(id='Q11005')
+        self.assertEqual(650, house.number_of_seats)
+        self.assertEqual(['Q16707842'], list(house.positions.values_list('id', flat=True)))
+        self.assertEqual('Q22', models.LegislativeHouse.objects.get(id='Q234993').administrative_area_id)
+        self.assertEqual(datetime.date(2017, 6, 13), models.LegislativeTerm.objects.get(id='Q29974940').start)
+        self.assertEqual({('Q11005/Q21084472', 'Q30524710'), ('Q11005/Q29974940', None), ('Q234993/Q21084472', None)},
+                         set(models.LegislativeHouseTerm.objects.values_list('id', 'term_specific_position')))
+        self.assertEqual({'en': 'MP in the 56th Parliament'}, models.Position.objects.get(id='Q30524710').labels)
+        # Only the new house has its members and districts refreshed
+        refresh_members_delay.assert_called_once_with(id='Q234993', queued_at=unittest.mock.ANY)
+        refresh_districts_delay.assert_called_once_with(id='Q234993', queued_at=unittest.mock.ANY)
+
+
+class MembersTestCase(TestCase):
+    header = '\t'.join(['?statement', '?person', '?personLabel', '?group', '?groupLabel', '?party', '?partyLabel',
+                        '?district', '?districtLabel', '?role', '?roleLabel', '?term', '?termLabel', '?termStart',
+                        '?termEnd', '?start', '?end', '?endCause', '?endCauseLabel', '?subjectHasRole',
+                        '?subjectHasRoleLabel'])
+
+    def row(self, statement, person, term='', group='', district='', start=''):
+        def item(id):
+            return '<{}>'.format(namespaces.WD[id]) if id else ''
+
+        def label(id):
+            return '"{} label"@en'.format(id) if id else ''
+
+        return '\t'.join([
+            '<{}>'.format(namespaces.WDS[statement]), item(person), label(person), item(group), label(group), '', '',
+            item(district), label(district), item('Q16707842'), label('Q16707842'), item(term), label(term), '', '',
+            '"{}T00:00:00Z"^^<http://www.w3.org/2001/XMLSchema#dateTime>'.format(start) if start else '', '',
+            '', '', '', '',
+        ])
+
+    @unittest.mock.patch.object(legislature.refresh_members, 'delay')
+    @unittest.mock.patch.object(legislature.refresh_districts, 'delay')
+    @unittest.mock.patch.object(legislature.refresh_legislatures, 'delay')
+    def setUp(self, *delays):
+        self.queued_at = timezone.now()
+        country = models.Country.objects.create(id='Q145')
+        administrative_area = models.AdministrativeArea.objects.create(id='Q145')
+        self.house = models.LegislativeHouse.objects.create(id='Q11005', country=country,
+                                                            administrative_area=administrative_area,
+                                                            refresh_members_last_queued=self.queued_at)
+        self.house.positions.add(models.Position.objects.create(id='Q16707842'))
+        models.LegislativeTerm.objects.create(id='Q21084472', start=datetime.date(2015, 5, 7))
+        models.Person.objects.create(id='Q1', labels={'en': 'Existing label'})
+        models.LegislativeMembership.objects.create(id='Q1-stale', person_id='Q1', legislative_house=self.house)
+
+    def refresh_members(self, rows):
+        results = utils.iter_sparql_tsv_rows([self.header] + rows)
+        with unittest.mock.patch.object(legislature, 'sharded_wikidata_query_bindings', return_value=results):
+            return legislature.refresh_members(self.house.id, self.queued_at)
+
+    def testRefreshMembers(self):
+        self.refresh_members([
+            self.row('Q1-A', 'Q1', term='Q21084472', group='Q9630', district='Q1146817'),
+            self.row('Q1-A', 'Q1', term='Q29974940', group='Q9630', district='Q1146817'),
+            self.row('Q2-B', 'Q2', group='Q327591', start='2017-06-08'),
+        ])
+
+        self.assertEqual({'en': 'Existing label'}, models.Person.objects.get(id='Q1').labels)
+        self.assertEqual({'en': 'Q2 label'}, models.Person.objects.get(id='Q2').labels)
+        self.assertEqual({'Q21084472', 'Q29974940'}, set(models.LegislativeTerm.objects.values_list('id', flat=True)))
+        self.assertEqual({'Q1146817'}, set(models.ElectoralDistrict.objects.values_list('id', flat=True)))
+        self.assertEqual({'Q9630'}, set(models.Organization.objects.values_list('id', flat=True)))
+
+        first, second = models.LegislativeMembership.objects.order_by('id')
+        self.assertEqual(('Q1-A', 'Q1', 'Q1146817', 'Q9630', 'Q9630', 'Q16707842'),
+                         (first.id, first.person_id, first.district_id, first.parliamentary_group_id,
+                          first.party_id, first.position_id))
+        self.assertEqual(datetime.date(2015, 5, 7), first.start)
+        self.assertEqual({'Q21084472', 'Q29974940'}, set(first.legislative_terms.values_list('id', flat=True)))
+        self.assertEqual(('Q2-B', True, None, datetime.date(2017, 6, 8)),
+                         (second.id, second.independent, second.parliamentary_group_id, second.start))
+
+    def testRowsGroupedByStatementWhateverTheirOrder(self):
+        # As when the statement is returned by more than one shard
+        self.refresh_members([
+            self.row('Q1-A', 'Q1', term='Q21084472'),
+            self.row('Q2-B', 'Q2'),
+            self.row('Q1-A', 'Q1', term='Q29974940'),
+        ])
+        self.assertEqual(['Q1-A', 'Q2-B'], list(models.LegislativeMembership.objects.order_by('id')
+                                                                                  .values_list('id', flat=True)))
+        self.assertEqual({'Q21084472', 'Q29974940'},
+                         set(models.LegislativeMembership.objects.get(id='Q1-A').legislative_terms
+                                                                   .values_list('id', flat=True)))
+
+    def testMembershipsUpdated(self):
+        self.refresh_members([self.row('Q1-A', 'Q1', term='Q21084472', group='Q9630')])
+        self.refresh_members([self.row('Q1-A', 'Q1', group='Q9630', start='2016-01-01')])
+        membership = models.LegislativeMembership.objects.get()
+        self.assertEqual(datetime.date(2016, 1, 1), membership.start)
+        self.assertFalse(membership.legislative_terms.exists())
+
+    def testUnchangedMembershipsSkipped(self):
+        rows = [self.row('Q1-A', 'Q1', term='Q21084472', group='Q9630')]
+        self.refresh_members(rows)
+        # Nothing has changed in Wikidata, so this change to the database shouldn't be overwritten
+        models.LegislativeMembership.objects.update(independent=True)
+        self.refresh_members(rows)
+        self.assertTrue(models.LegislativeMembership.objects.get().independent)
+        self.refresh_members([self.row('Q1-A', 'Q1', term='Q21084472', group='Q9631')])
+        membership = models.LegislativeMembership.objects.get()
+        self.assertEqual((False, 'Q9631'), (membership.independent, membership.parliamentary_group_id))
+
+
+class DistrictsTestCase(TestCase):
+    @unittest.mock.patch.object(legislature.refresh_members, 'delay')
+    @unittest.mock.patch.object(legislature.refresh_districts, 'delay')
+    @unittest.mock.patch.object(legislature.refresh_legislatures, 'delay')
+    def setUp(self, *delays):
+        self.queued_at = timezone.now()
+        country = models.Country.objects.create(id='Q145')
+        administrative_area = models.AdministrativeArea.objects.create(id='Q145')
+        self.house = models.LegislativeHouse.objects.create(id='Q11005', country=country,
+                                                            administrative_area=administrative_area,
+                                                            refresh_districts_last_queued=self.queued_at)
+        models.ElectoralDistrict.objects.create(id='Q1-stale', legislative_house=self.house, fingerprint='stale')
+        models.ElectoralDistrict.objects.create(id='Q1146817', labels={'en': 'Oxford East'},
+                                                legislative_house=self.house)
+
+    def refresh_districts(self, *rows):
+        results = utils.iter_sparql_tsv_rows(['?constituency\t?constituencyLabel\t?start\t?end'] + [
+            '<{}>\t"{}"@en\t\t'.format(namespaces.WD[id], label) for id, label in rows])
+        with unittest.mock.patch.object(legislature, 'templated_wikidata_query_bindings', return_value=results):
+            return legislature.refresh_districts(self.house.id, self.queued_at)
+
+    def testRefreshDistricts(self):
+        receiver = unittest.mock.Mock()
+        signals.districts_changed.connect(receiver)
+        self.addCleanup(signals.districts_changed.disconnect, receiver)
+
+        summary = self.refresh_districts(('Q1146817', 'Oxford East'), ('Q2000000', 'Oxford West and Abingdon'))
+
+        self.assertEqual({'districts': 2, 'created': ['Q2000000'], 'updated': ['Q1146817'], 'removed': ['Q1-stale']},
+                         summary)
+        self.assertEqual({'Q1146817', 'Q2000000'}, set(self.house.electoraldistrict_set.values_list('id', flat=True)))
+        stale = models.ElectoralDistrict.objects.get(id='Q1-stale')
+        self.assertEqual((None, ''), (stale.legislative_house, stale.fingerprint))
+        receiver.assert_called_once_with(signal=signals.districts_changed, sender=models.LegislativeHouse,
+                                         house=self.house, created=['Q2000000'], updated=['Q1146817'],
+                                         removed=['Q1-stale'])
+
+    def testUnchangedDistrictsSkipped(self):
+        self.refresh_districts(('Q1146817', 'Oxford East'))
+        receiver = unittest.mock.Mock()
+        signals.districts_changed.connect(receiver)
+        self.addCleanup(signals.districts_changed.disconnect, receiver)
+
+        summary = self.refresh_districts(('Q1146817', 'Oxford East'))
+
+        self.assertEqual({'districts': 1, 'created': [], 'updated': [], 'removed': []}, summary)
+        receiver.assert_not_called()
+
+    def testRenamedDistrictLeftToRefreshLabels(self):
+        self.refresh_districts(('Q1146817', 'Oxford East'))
+        labels = {'en': 'Oxford East', 'cy': 'Dwyrain Rhydychen'}
+        models.ElectoralDistrict.objects.filter(id='Q1146817').update(labels=labels)
+
+        summary = self.refresh_districts(('Q1146817', 'Oxford City'))
+
+        # Writing the English label from the results would lose the others
+        self.assertEqual({'districts': 1, 'created': [], 'updated': [], 'removed': []}, summary)
+        self.assertEqual(labels, models.ElectoralDistrict.objects.get(id='Q1146817').labels)
+
+
+class BatchedQueuingTestCase(TestCase):
+    @unittest.mock.patch.object(legislature.refresh_members, 'delay')
+    @unittest.mock.patch.object(legislature.refresh_districts, 'delay')
+    @unittest.mock.patch.object(legislature.refresh_legislatures, 'delay')
+    def setUp(self, *delays):
+        self.queued_at = timezone.now()
+        country = models.Country.objects.create(id='Q145')
+        administrative_area = models.AdministrativeArea.objects.create(id='Q145')
+        for id in ('Q11005', 'Q11007', 'Q234993'):
+            models.LegislativeHouse.objects.create(id=id, country=country, administrative_area=administrative_area,
+                                                   refresh_members_last_queued=self.queued_at,
+                                                   refresh_districts_last_queued=self.queued_at)
+        models.LegislativeHouse.objects.update(refresh_districts_last_queued=None)
+
+    @override_settings(WIKIDATA_QUEUING_BATCH_SIZE=2)
+    def testQueuesInBatches(self):
+        with unittest.mock.patch.object(legislature.refresh_districts.batch_task, 'delay') as batch_delay:
+            legislature.refresh_districts.periodic_queuing_task()
+        self.assertEqual([unittest.mock.call(ids=['Q11005', 'Q11007'], queued_at=unittest.mock.ANY),
+                          unittest.mock.call(ids=['Q234993'], queued_at=unittest.mock.ANY)],
+                         batch_delay.call_args_list)
+
+    @override_settings(WIKIDATA_QUEUING_BATCH_SIZE=1)
+    def testQueuesIndividually(self):
+        with unittest.mock.patch.object(legislature.refresh_districts, 'delay') as refresh_districts_delay:
+            legislature.refresh_districts.periodic_queuing_task()
+        self.assertEqual(3, refresh_districts_delay.call_count)
+
+    @override_settings(WIKIDATA_QUEUING_BATCH_SIZE=2, WIKIDATA_HEAVY_TASK_DURATION=60, WIKIDATA_HEAVY_QUEUE='heavy')
+    def testQueuesCheapestFirstAndHeavyApart(self):
+        task_name = legislature.refresh_districts.name
+        for id, duration in (('Q11005', 600), ('Q11007', 30)):
+            models.RefreshCost.objects.create(id=models.RefreshCost.make_id(task_name, id), task=task_name,
+                                              object_id=id, runs=1, duration=duration)
+        with unittest.mock.patch.object(legislature.refresh_districts.batch_task, 'delay') as batch_delay, \
+                unittest.mock.patch.object(legislature.refresh_districts, 'apply_async') as apply_async:
+            legislature.refresh_districts.periodic_queuing_task()
+        batch_delay.assert_called_once_with(ids=['Q234993', 'Q11007'], queued_at=unittest.mock.ANY)
+        apply_async.assert_called_once_with(kwargs={'id': 'Q11005', 'queued_at': unittest.mock.ANY}, queue='heavy')
+
+    @override_settings(WIKIDATA_QUEUING_BATCH_SIZE=2)
+    @unittest.mock.patch('commons_api.wikidata.changes.modified_times')
+    def testUnchangedHousesSkipped(self, modified_times):
+        models.LegislativeHouse.objects.update(refresh_districts_last_refreshed=self.queued_at)
+        modified_times.return_value = {'Q11007': self.queued_at + datetime.timedelta(1)}
+        with unittest.mock.patch.object(legislature.refresh_districts.batch_task, 'delay') as batch_delay:
+            legislature.refresh_districts.periodic_queuing_task()
+        batch_delay.assert_called_once_with(ids=['Q11007'], queued_at=unittest.mock.ANY)
+        self.assertEqual(['Q11007'], list(models.RefreshLock.objects.values_list('object_id', flat=True)))
+        self.assertFalse(models.LegislativeHouse.objects.filter(refresh_districts_last_queued=None).exists())
+
+    @unittest.mock.patch.object(legislature.refresh_districts.batch_task, 'apply_async')
+    @unittest.mock.patch.object(legislature.refresh_districts, 'run')
+    def testThrottledBatchRequeued(self, refresh_districts_run, batch_apply_async):
+        refresh_districts_run.side_effect = [None, WDQSThrottled(10), None]
+        summary = legislature.refresh_districts.batch_task(ids=['Q11005', 'Q11007', 'Q234993'],
+                                                           queued_at=self.queued_at)
+        self.assertEqual({'refreshed': 1, 'failed': [], 'requeued': ['Q11007', 'Q234993']}, summary)
+        self.assertEqual({'ids': ['Q11007', 'Q234993'], 'queued_at': self.queued_at},
+                         batch_apply_async.call_args[1]['kwargs'])
+        self.assertGreaterEqual(batch_apply_async.call_args[1]['countdown'], 10)
+
+    @unittest.mock.patch.object(legislature.refresh_districts, 'run')
+    def testBatchPublishesProgress(self, refresh_districts_run):
+        refresh_districts_run.side_effect = lambda id, queued_at: Progress('refresh_districts ' + id).phase('fetch')
+        with unittest.mock.patch.object(legislature.refresh_districts.batch_task, 'update_state') as update_state:
+            legislature.refresh_districts.batch_task.apply(kwargs={'ids': ['Q11005', 'Q11007'],
+                                                                   'queued_at': self.queued_at})
+        self.assertEqual(['refresh_districts Q11005', 'refresh_districts Q11007'],
+                         [call[1]['meta']['description'] for call in update_state.call_args_list])
+
+    @unittest.mock.patch.object(legislature.refresh_districts, 'run')
+    def testFinishedTaskReleasesLock(self, refresh_districts_run):
+        with unittest.mock.patch.object(legislature.refresh_districts, 'delay') as refresh_districts_delay:
+            self.assertTrue(coalescing.enqueue(legislature.refresh_districts, 'Q11005'))
+            self.assertFalse(coalescing.enqueue(legislature.refresh_districts, 'Q11005'))
+        legislature.refresh_districts(**refresh_districts_delay.call_args[1])
+        refresh_districts_run.assert_called_once_with(**refresh_districts_delay.call_args[1])
+        self.assertFalse(models.RefreshLock.objects.filter(task=legislature.refresh_districts.name).exists())
+        self.assertEqual(1, models.RefreshCost.objects.get(object_id='Q11005').runs)
+
+
+class CountryListTestCase(TestCase):
+    @unittest.mock.patch.object(legislature.refresh_legislatures, 'delay')
+    def setUp(self, refresh_legislatures_delay):
+        models.Country.objects.create(id='Q142', labels={'en': 'France'})
+        models.Country.objects.create(id='Q145', labels={'en': 'United Kingdom'})
+
+    def binding(self, id, label, code):
+        return {'item': {'type': 'uri', 'value': namespaces.WD[id]},
+                'itemLabel': {'type': 'literal', 'value': label},
+                'itemCode': {'type': 'literal', 'value': code}}
+
+    @unittest.mock.patch.object(legislature.refresh_legislatures, 'delay')
+    @unittest.mock.patch.object(country, 'templated_wikidata_query')
+    def testRefreshCountryList(self, templated_wikidata_query, refresh_legislatures_delay):
+        templated_wikidata_query.return_value = {'results': {'bindings': [
+            self.binding('Q142', 'La France', 'fr'),
+            self.binding('Q183', 'Germany', 'de'),
+        ]}}
+        summary = country.refresh_country_list()
+
+        self.assertEqual({'countries': 2, 'created': ['Q183'], 'deleted': {'wikidata.Country': 1}}, summary)
+        france = models.Country.objects.get(id='Q142')
+        self.assertEqual(({'en': 'France'}, 'FR'), (france.labels, france.iso_3166_1_code))
+        self.assertEqual({'en': 'Germany'}, models.Country.objects.get(id='Q183').labels)
+        self.assertFalse(models.Country.objects.filter(id='Q145').exists())
+        # Only the new country has its legislatures refreshed
+        refresh_legislatures_delay.assert_called_once_with(id='Q183', queued_at=unittest.mock.ANY)
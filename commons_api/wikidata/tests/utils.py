@@ -1,32 +1,296 @@
+import datetime
+import json
+import pickle
+import threading
 import unittest.mock
 
-from SPARQLWrapper import JSON, POST
-from django.test import TestCase
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase, override_settings
 
 from commons_api.wikidata import utils
 
 
 class SparqlTestCase(TestCase):
-    @unittest.mock.patch('SPARQLWrapper.SPARQLWrapper')
-    def test_templated_wikidata_query(self, SPARQLWrapper):
-        sparql_wrapper = unittest.mock.Mock()
-        sparql_results = unittest.mock.Mock()
-        sparql_data = unittest.mock.Mock()
-        SPARQLWrapper.return_value = sparql_wrapper
-        sparql_wrapper.query.return_value = sparql_results
-        sparql_results.convert.return_value = sparql_data
+    @unittest.mock.patch('commons_api.wikidata.utils.get_wdqs_session')
+    def test_templated_wikidata_query(self, get_wdqs_session):
+        session = unittest.mock.Mock()
+        response = unittest.mock.MagicMock()
+        sparql_data = {'results': {'bindings': []}}
+        get_wdqs_session.return_value = session
+        session.post.return_value = response
+        response.status_code = 200
+        response.json.return_value = sparql_data
 
         result = utils.templated_wikidata_query('wikidata/query/country_list.rq', {})
 
-        sparql_wrapper.setMethod.assert_called_once_with(POST)
-        sparql_wrapper.setReturnFormat.assert_called_once_with(JSON)
+        session.post.assert_called_once_with(settings.WDQS_URL,
+                                             data={'query': unittest.mock.ANY},
+                                             headers={'Accept': 'application/sparql-results+json'},
+                                             timeout=unittest.mock.ANY,
+                                             stream=False)
+        response.raise_for_status.assert_called_once_with()
 
         self.assertEqual(sparql_data, result)
 
+    def test_session_is_reused(self):
+        self.assertIs(utils.get_wdqs_session(), utils.get_wdqs_session())
+
+    def test_session_is_recreated_after_fork(self):
+        session = utils.get_wdqs_session()
+        with unittest.mock.patch('os.getpid', return_value=-1):
+            self.assertIsNot(session, utils.get_wdqs_session())
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                           'wdqs': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   WDQS_CACHE_TIMEOUTS={'wikidata/query/labels.rq': 60})
+class QueryCacheTestCase(TestCase):
+    results = {'results': {'bindings': [{'id': {'type': 'uri', 'value': 'http://www.wikidata.org/entity/Q142'}}]}}
+
+    def setUp(self):
+        caches['wdqs'].clear()
+
+    @unittest.mock.patch('commons_api.wikidata.utils.wikidata_query')
+    def testCachesResults(self, wikidata_query):
+        wikidata_query.return_value = self.results
+        for i in range(2):
+            result = utils.templated_wikidata_query('wikidata/query/labels.rq', {'ids': ['Q142']})
+            self.assertEqual(self.results, result)
+        wikidata_query.assert_called_once_with(unittest.mock.ANY, metrics=unittest.mock.ANY)
+
+    @unittest.mock.patch('commons_api.wikidata.utils.wikidata_query')
+    def testCacheKeyedOnRenderedQuery(self, wikidata_query):
+        wikidata_query.return_value = self.results
+        utils.templated_wikidata_query('wikidata/query/labels.rq', {'ids': ['Q142']})
+        utils.templated_wikidata_query('wikidata/query/labels.rq', {'ids': ['Q183']})
+        self.assertEqual(2, wikidata_query.call_count)
+
+    @unittest.mock.patch('commons_api.wikidata.utils.wikidata_query')
+    def testBypassCache(self, wikidata_query):
+        wikidata_query.return_value = self.results
+        utils.templated_wikidata_query('wikidata/query/labels.rq', {'ids': ['Q142']})
+        utils.templated_wikidata_query('wikidata/query/labels.rq', {'ids': ['Q142']}, use_cache=False)
+        self.assertEqual(2, wikidata_query.call_count)
+
+    @unittest.mock.patch('commons_api.wikidata.utils.wikidata_query')
+    def testUncachedTemplate(self, wikidata_query):
+        wikidata_query.return_value = self.results
+        for i in range(2):
+            utils.templated_wikidata_query('wikidata/query/country_list.rq', {})
+        self.assertEqual(2, wikidata_query.call_count)
+
+    @unittest.mock.patch('commons_api.wikidata.utils.wikidata_query_bindings')
+    def testStreamedResultsCachedOnceConsumed(self, wikidata_query_bindings):
+        wikidata_query_bindings.side_effect = lambda query, result_format, metrics: iter(self.results['results']['bindings'])
+        bindings = utils.templated_wikidata_query_bindings('wikidata/query/labels.rq', {'ids': ['Q142']})
+        next(bindings)
+        bindings.close()
+        for i in range(2):
+            self.assertEqual(self.results['results']['bindings'],
+                             list(utils.templated_wikidata_query_bindings('wikidata/query/labels.rq',
+                                                                          {'ids': ['Q142']})))
+        self.assertEqual(2, wikidata_query_bindings.call_count)
+
+    @unittest.mock.patch('commons_api.wikidata.utils.wikidata_query_bindings')
+    def testTSVRowsCached(self, wikidata_query_bindings):
+        rows = list(utils.iter_sparql_tsv_rows(['?id', '<http://www.wikidata.org/entity/Q142>']))
+        wikidata_query_bindings.side_effect = lambda query, result_format, metrics: iter(rows)
+        for i in range(2):
+            cached_rows = list(utils.templated_wikidata_query_bindings('wikidata/query/labels.rq', {'ids': ['Q142']},
+                                                                       result_format='tsv'))
+            self.assertEqual(rows, cached_rows)
+            self.assertEqual('uri', cached_rows[0].id.type)
+        wikidata_query_bindings.assert_called_once_with(unittest.mock.ANY, 'tsv', metrics=unittest.mock.ANY)
+
+
+class StreamingBindingsTestCase(TestCase):
+    results = {
+        'head': {'vars': ['id', 'label']},
+        'results': {'bindings': [
+            {'id': {'type': 'uri', 'value': 'http://www.wikidata.org/entity/Q142'},
+             'label': {'type': 'literal', 'value': 'France, [{"tricky"}]', 'xml:lang': 'en'}},
+            {'id': {'type': 'uri', 'value': 'http://www.wikidata.org/entity/Q183'},
+             'label': {'type': 'literal', 'value': 'Deutschland', 'xml:lang': 'de'}},
+        ]},
+    }
+
+    def testParsesWholeDocument(self):
+        data = json.dumps(self.results, indent=2)
+        self.assertEqual(self.results['results']['bindings'],
+                         list(utils.iter_sparql_json_bindings([data])))
+
+    def testParsesAcrossChunkBoundaries(self):
+        data = json.dumps(self.results)
+        for chunk_size in (1, 2, 7, 50):
+            chunks = [data[i:i+chunk_size] for i in range(0, len(data), chunk_size)]
+            self.assertEqual(self.results['results']['bindings'],
+                             list(utils.iter_sparql_json_bindings(chunks)))
+
+    def testEmptyResults(self):
+        data = json.dumps({'head': {'vars': []}, 'results': {'bindings': []}})
+        self.assertEqual([], list(utils.iter_sparql_json_bindings([data])))
+
+    def testTruncatedResultsRaiseValueError(self):
+        data = json.dumps(self.results)[:-20]
+        with self.assertRaises(ValueError):
+            list(utils.iter_sparql_json_bindings([data]))
+
+
+class TSVResultsTestCase(TestCase):
+    lines = [
+        '?item\t?itemLabel\t?start\t?count\t?node',
+        '<http://www.wikidata.org/entity/Q142>\t"France"@en\t'
+        '"1958-10-04T00:00:00Z"^^<http://www.w3.org/2001/XMLSchema#dateTime>\t42\t_:b0',
+        '<http://www.wikidata.org/entity/Q183>\t"Tab\\there \\"quoted\\""\t\t\t',
+    ]
+
+    def testParsesRows(self):
+        first, second = utils.iter_sparql_tsv_rows(self.lines)
+
+        self.assertEqual('Q142', utils.item_uri_to_id(first.item))
+        self.assertEqual('uri', first.item.type)
+        self.assertEqual('France', first.itemLabel)
+        self.assertEqual('en', first.itemLabel.lang)
+        self.assertEqual('1958-10-04', utils.get_date(first.start))
+        self.assertEqual('http://www.w3.org/2001/XMLSchema#dateTime', first.start.datatype)
+        self.assertEqual('42', first.count)
+        self.assertEqual('bnode', first.node.type)
+
+        self.assertEqual('Tab\there "quoted"', second.itemLabel)
+        self.assertIsNone(second.start)
+        self.assertIsNone(utils.get_date(second.start))
+        self.assertIsNone(second.node)
+
+    def testTermsCanBePickled(self):
+        term = utils.parse_sparql_tsv_term('"France"@en')
+        unpickled = pickle.loads(pickle.dumps(term))
+        self.assertEqual((term, term.type, term.lang), (unpickled, unpickled.type, unpickled.lang))
+
+
+class ShardedQueryTestCase(TestCase):
+    def fake_query(self, query_name, context, use_cache, result_format):
+        self.shards.append(context['ids'])
+        if len(context['ids']) > self.timeout_above:
+            raise utils.WDQSTimeout
+        return iter([{'id': id} for id in context['ids']])
+
+    def setUp(self):
+        self.shards = []
+        self.timeout_above = float('inf')
+        patcher = unittest.mock.patch('commons_api.wikidata.utils.templated_wikidata_query_bindings',
+                                      side_effect=self.fake_query)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testShardsValues(self):
+        ids = list(range(10))
+        bindings = utils.sharded_wikidata_query_bindings('wikidata/query/labels.rq', {'ids': ids}, 'ids',
+                                                         shard_size=3, max_workers=1)
+        self.assertEqual([{'id': id} for id in ids], list(bindings))
+        self.assertEqual([[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]], self.shards)
+
+    def testConcurrentShardsKeepOrder(self):
+        ids = list(range(100))
+        bindings = utils.sharded_wikidata_query_bindings('wikidata/query/labels.rq', {'ids': ids}, 'ids',
+                                                         shard_size=7, max_workers=4)
+        self.assertEqual([{'id': id} for id in ids], list(bindings))
+        self.assertEqual(15, len(self.shards))
+
+    def testTimedOutShardsAreSplit(self):
+        self.timeout_above = 2
+        ids = list(range(10))
+        bindings = utils.sharded_wikidata_query_bindings('wikidata/query/labels.rq', {'ids': ids}, 'ids',
+                                                         shard_size=4, max_workers=1)
+        self.assertEqual([{'id': id} for id in ids], list(bindings))
+        # The first shard times out and is split, after which the shard size is reduced
+        self.assertEqual([[0, 1, 2, 3], [0, 1], [2, 3], [4, 5], [6, 7], [8, 9]], self.shards)
+
+    def testTimeoutRaisedAtMinimumShardSize(self):
+        self.timeout_above = 0
+        bindings = utils.sharded_wikidata_query_bindings('wikidata/query/labels.rq', {'ids': [1, 2]}, 'ids',
+                                                         shard_size=2, max_workers=1)
+        with self.assertRaises(utils.WDQSTimeout):
+            list(bindings)
+
+
+class ConcurrentQueriesTestCase(TestCase):
+    def fake_query(self, query_name, context, use_cache):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self.started.release()
+        try:
+            if self.barrier:
+                self.barrier.wait()
+            if context['ids'] == ['fail']:
+                raise utils.WDQSTimeout
+            return iter([{'id': id} for id in context['ids']])
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self.finished.release()
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.in_flight = self.max_in_flight = 0
+        self.started, self.finished = threading.Semaphore(0), threading.Semaphore(0)
+        self.barrier = None
+        patcher = unittest.mock.patch('commons_api.wikidata.utils.templated_wikidata_query_bindings',
+                                      side_effect=self.fake_query)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def queries(self, n):
+        return [(i, 'wikidata/query/labels.rq', {'ids': [i]}) for i in range(n)]
+
+    def wait_for(self, semaphore, count):
+        for i in range(count):
+            self.assertTrue(semaphore.acquire(timeout=10))
+
+    def testAllQueriesRun(self):
+        results = dict(utils.iter_concurrent_wikidata_queries(self.queries(20), max_concurrency=4))
+        self.assertEqual({i: [{'id': i}] for i in range(20)}, results)
+        self.assertLessEqual(self.max_in_flight, 4)
+
+    def testQueriesRunConcurrently(self):
+        # Each query waits for all the others to have started, which only happens if they're all in flight at once
+        self.barrier = threading.Barrier(4, timeout=10)
+        results = dict(utils.iter_concurrent_wikidata_queries(self.queries(4), max_concurrency=4))
+        self.assertEqual({i: [{'id': i}] for i in range(4)}, results)
+
+    def testUnconsumedResultsLimitQueries(self):
+        results = utils.iter_concurrent_wikidata_queries(self.queries(20), max_concurrency=3)
+        next(results)
+        # The first result is still being handled until the next is asked for, so once the two other queries that could
+        # be in flight have finished, none should have been started after them
+        self.wait_for(self.finished, 3)
+        self.assertEqual(3, utils.templated_wikidata_query_bindings.call_count)
+        next(results)
+        self.wait_for(self.started, 4)
+        self.assertEqual(4, utils.templated_wikidata_query_bindings.call_count)
+        results.close()
+
+    def testErrorsAreRaised(self):
+        queries = self.queries(5) + [('fail', 'wikidata/query/labels.rq', {'ids': ['fail']})]
+        with self.assertRaises(utils.WDQSTimeout):
+            list(utils.iter_concurrent_wikidata_queries(queries, max_concurrency=2))
+
+    def testRunsInlineWithoutConcurrency(self):
+        results = list(utils.iter_concurrent_wikidata_queries(self.queries(3), max_concurrency=1))
+        self.assertEqual([(i, [{'id': i}]) for i in range(3)], results)
+
 
 class SplitEveryTestCase(TestCase):
     def testSplitsList(self):
         data = list(range(10))
         result = utils.split_every(data, 3)
         result = [list(group) for group in result]
-        self.assertEqual([[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]], result)
\ No newline at end of file
+        self.assertEqual([[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]], result)
+
+
+class FingerprintTestCase(TestCase):
+    def testFingerprint(self):
+        self.assertEqual(utils.fingerprint('a', datetime.date(2000, 1, 1)), utils.fingerprint('a', '2000-01-01'))
+        self.assertNotEqual(utils.fingerprint('a', None), utils.fingerprint('a', ''))
+        self.assertEqual(40, len(utils.fingerprint({'b': 1, 'a': 2})))
@@ -34,6 +34,10 @@ urlpatterns = (
          views.LegislativeHouseMembershipView.as_view(),
          name='legislativehouse-membership-term'),
 
+    path('query-stats',
+         views.QueryTemplateStatsListView.as_view(),
+         name='querytemplatestats-list'),
+
     path('moderate/<pk>',
          views.ModerationItemDetailView.as_view(),
          name='moderationitem-detail'),
@@ -1,13 +1,26 @@
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import http.client
 import itertools
+import json
+import os
+import threading
+import time
 from typing import Mapping
 
 import re
-import SPARQLWrapper
+import requests
+import requests.adapters
 from django.conf import settings
-from django.template.loader import get_template
+from django.core.cache import caches
+from django.db import connection
 from django.utils import translation
 
-from . import models
+from . import governor, instrumentation, models, recording, sparql
 from .namespaces import WD, WDS
 
 
@@ -64,6 +77,13 @@ def select_multilingual(data: Mapping[str,object],
     return default
 
 
+def fingerprint(*values):
+    """Returns a hash of the given values, for detecting whether ingested data has changed since it was last stored
+
+    Values are serialized as JSON, with anything JSON can't represent (e.g. dates) converted to strings."""
+    return hashlib.sha1(json.dumps(values, default=str, sort_keys=True).encode()).hexdigest()
+
+
 def split_every(it, n):
     """Splits an iterable into sub-iterators each of maximum length n
 
@@ -83,9 +103,414 @@ def split_every(it, n):
         yield group(first)
 
 
-def templated_wikidata_query(query_name, context):
-    sparql = SPARQLWrapper.SPARQLWrapper(settings.WDQS_URL)
-    sparql.setMethod(SPARQLWrapper.POST)
-    sparql.setQuery(get_template(query_name).render(context))
-    sparql.setReturnFormat(SPARQLWrapper.JSON)
-    return sparql.query().convert()
+_wdqs_session = None
+_wdqs_session_pid = None
+_wdqs_session_lock = threading.Lock()
+
+
+def get_wdqs_session() -> requests.Session:
+    """Returns a process-wide HTTP session for querying WDQS
+
+    The session keeps a pool of keep-alive connections (of size `settings.WDQS_POOL_SIZE`), so that consecutive
+    queries don't each pay for a new TCP and TLS handshake. A new session is created after a fork, as connections
+    can't be shared safely between celery worker processes."""
+    global _wdqs_session, _wdqs_session_pid
+    with _wdqs_session_lock:
+        if _wdqs_session is None or _wdqs_session_pid != os.getpid():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=settings.WDQS_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers['User-Agent'] = settings.WDQS_USER_AGENT
+            _wdqs_session, _wdqs_session_pid = session, os.getpid()
+        return _wdqs_session
+
+
+class WDQSTimeout(Exception):
+    """Raised when a query took too long for WDQS (or for us) to wait for it"""
+
+
+@contextlib.contextmanager
+def wikidata_query_response(query, stream=False, accept='application/sparql-results+json', metrics=None):
+    """A context manager that sends a SPARQL query to WDQS, and provides the successful response
+
+    The query is made through :py:mod:`commons_api.wikidata.governor`, and the query slot is held until the context
+    manager exits (i.e. until a streamed response has been consumed), with its lease renewed as a streamed response is
+    read. If given, `metrics` (a :py:class:`commons_api.wikidata.instrumentation.QueryMetrics`) has the response
+    latency recorded on it.
+
+    :raises governor.WDQSThrottled: if WDQS responds asking us to slow down
+    :raises WDQSTimeout: if the query timed out
+    :raises requests.HTTPError: for any other unsuccessful response
+    """
+    with governor.query_slot() as lease_id:
+        start = time.monotonic()
+        try:
+            response = get_wdqs_session().post(settings.WDQS_URL,
+                                               data={'query': query},
+                                               headers={'Accept': accept},
+                                               timeout=(settings.WDQS_CONNECT_TIMEOUT, settings.WDQS_READ_TIMEOUT),
+                                               stream=stream)
+        except requests.Timeout as e:
+            raise WDQSTimeout(str(e)) from e
+        if metrics is not None:
+            metrics.latency = time.monotonic() - start
+        with response:
+            if response.status_code == http.client.TOO_MANY_REQUESTS or \
+                    (response.status_code == http.client.SERVICE_UNAVAILABLE and 'Retry-After' in response.headers):
+                retry_after = governor.parse_retry_after(response.headers.get('Retry-After'))
+                governor.record_throttled(retry_after)
+                raise governor.WDQSThrottled(retry_after)
+            # WDQS reports its own query timeouts as server errors, with the Java exception in the body
+            if response.status_code == http.client.INTERNAL_SERVER_ERROR and 'TimeoutException' in response.text:
+                raise WDQSTimeout("WDQS timed out running the query")
+            response.raise_for_status()
+            if settings.WDQS_RECORD_DIR:
+                recording.record_response(settings.WDQS_RECORD_DIR, query, accept, response)
+            if stream:
+                # iter_lines() reads through iter_content() too
+                response.iter_content = _renewing_lease(response.iter_content, lease_id)
+            try:
+                yield response
+            except GeneratorExit:
+                # The caller stopped reading early, but WDQS still answered the query
+                governor.record_success()
+                raise
+        governor.record_success()
+
+
+def _renewing_lease(iter_content, lease_id):
+    """Wraps a streamed response's iter_content, renewing the lease on its query slot as the response is read
+
+    The response may be read more slowly than it could be received (e.g. as each result is written to the database),
+    and so take longer than the lease lasts."""
+    renew_interval = governor.get_lease_duration().total_seconds() / 2
+
+    @functools.wraps(iter_content)
+    def wrapper(*args, **kwargs):
+        renewed = time.monotonic()
+        for chunk in iter_content(*args, **kwargs):
+            if time.monotonic() - renewed > renew_interval:
+                governor.renew(lease_id)
+                renewed = time.monotonic()
+            yield chunk
+    return wrapper
+
+
+def wikidata_query(query, metrics=None):
+    """Sends a SPARQL query to WDQS, returning the parsed SPARQL JSON results"""
+    with wikidata_query_response(query, metrics=metrics) as response:
+        if metrics is not None:
+            metrics.bytes = len(response.content)
+        return response.json()
+
+
+BINDINGS_START_RE = re.compile(r'"results"\s*:\s*\{\s*"bindings"\s*:\s*\[')
+BINDINGS_SEPARATOR_RE = re.compile(r'[\s,]*')
+
+
+def iter_sparql_json_bindings(chunks):
+    """Incrementally parses SPARQL JSON results, yielding each binding as soon as it has been received
+
+    `chunks` is an iterable of `str` fragments of a SPARQL JSON results document. Only the current binding and any
+    unparsed remainder of the most recent chunk are held in memory, so arbitrarily large result sets can be processed
+    in bounded memory. Everything other than the bindings (e.g. the `head`) is discarded."""
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer, pos = '', 0
+
+    def read_more():
+        nonlocal buffer, pos
+        try:
+            buffer = buffer[pos:] + next(chunks)
+        except StopIteration:
+            raise ValueError("SPARQL results ended unexpectedly")
+        pos = 0
+
+    while True:
+        match = BINDINGS_START_RE.search(buffer)
+        if match:
+            pos = match.end()
+            break
+        read_more()
+
+    while True:
+        pos = BINDINGS_SEPARATOR_RE.match(buffer, pos).end()
+        if pos == len(buffer):
+            read_more()
+        elif buffer[pos] == ']':
+            return
+        else:
+            try:
+                binding, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The binding hasn't been completely received yet
+                read_more()
+            else:
+                yield binding
+
+
+class SparqlTerm(str):
+    """A value from SPARQL TSV results
+
+    This is a `str` of the term's value (e.g. an IRI without its angle brackets, or a literal without its quotes), and
+    so can be passed to e.g. :py:func:`item_uri_to_id` and :py:func:`get_date` as-is. The term's `type` ('uri',
+    'literal' or 'bnode', as in SPARQL JSON results), `lang` and `datatype` are kept as attributes."""
+    def __new__(cls, value, type='literal', lang=None, datatype=None):
+        term = super().__new__(cls, value)
+        term.type, term.lang, term.datatype = type, lang, datatype
+        return term
+
+
+TSV_LITERAL_RE = re.compile(r'^"((?:[^"\\]|\\.)*)"(?:@([a-zA-Z0-9-]+)|\^\^<([^>]*)>)?$')
+TSV_ESCAPE_RE = re.compile(r'\\(.)')
+TSV_ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', 'b': '\b', 'f': '\f'}
+
+
+def parse_sparql_tsv_term(term):
+    """Parses a single RDF term from SPARQL TSV results into a :py:class:`SparqlTerm`, or None if it is unbound"""
+    if not term:
+        return None
+    if term[0] == '<' and term[-1] == '>':
+        return SparqlTerm(term[1:-1], 'uri')
+    if term.startswith('_:'):
+        return SparqlTerm(term[2:], 'bnode')
+    match = TSV_LITERAL_RE.match(term)
+    if match:
+        value, lang, datatype = match.groups()
+        if '\\' in value:
+            value = TSV_ESCAPE_RE.sub(lambda m: TSV_ESCAPES.get(m.group(1), m.group(1)), value)
+        return SparqlTerm(value, 'literal', lang, datatype)
+    # Numbers and booleans may appear unquoted
+    return SparqlTerm(term, 'literal')
+
+
+def sparql_row_class(variables):
+    return collections.namedtuple('SparqlRow', variables, rename=True)
+
+
+def iter_sparql_tsv_rows(lines):
+    """Parses SPARQL TSV results line by line, yielding a namedtuple for each row
+
+    Each row has an attribute per query variable, whose value is a :py:class:`SparqlTerm`, or None where the variable
+    is unbound."""
+    lines = iter(lines)
+    try:
+        header = next(lines)
+    except StopIteration:
+        raise ValueError("SPARQL results are empty")
+    row_class = sparql_row_class([variable.lstrip('?') for variable in header.split('\t')])
+    for line in lines:
+        if line:
+            yield row_class(*map(parse_sparql_tsv_term, line.split('\t')))
+
+
+SPARQL_RESULT_FORMATS = {
+    'json': 'application/sparql-results+json',
+    'tsv': 'text/tab-separated-values',
+}
+
+
+def wikidata_query_bindings(query, result_format='json', metrics=None):
+    """Sends a SPARQL query to WDQS, yielding results as they are received
+
+    Unlike :py:func:`wikidata_query`, this never holds the whole result set in memory, and so allows callers to start
+    processing results before the response has been completely downloaded.
+
+    With the default `result_format` of 'json', this yields bindings as they appear in SPARQL JSON results. With 'tsv',
+    results are requested as TSV, which is several times more compact, and this yields rows as returned by
+    :py:func:`iter_sparql_tsv_rows`.
+
+    If given, `metrics` has the response latency and size recorded on it."""
+    def count_bytes(chunks, extra=0):
+        for chunk in chunks:
+            if metrics is not None:
+                metrics.bytes += len(chunk) + extra
+            yield chunk
+
+    with wikidata_query_response(query, stream=True, accept=SPARQL_RESULT_FORMATS[result_format],
+                                 metrics=metrics) as response:
+        if result_format == 'tsv':
+            # Lines are counted with their line breaks
+            lines = count_bytes(response.iter_lines(settings.WDQS_STREAM_CHUNK_SIZE), extra=1)
+            yield from iter_sparql_tsv_rows(line.decode('utf-8') for line in lines)
+        else:
+            chunks = count_bytes(response.iter_content(settings.WDQS_STREAM_CHUNK_SIZE))
+            yield from iter_sparql_json_bindings(codecs.iterdecode(chunks, 'utf-8'))
+
+
+def wikidata_query_cache_key(query, result_format='json'):
+    key = 'wdqs:' + hashlib.sha256(query.encode()).hexdigest()
+    if result_format != 'json':
+        key += ':' + result_format
+    return key
+
+
+def templated_wikidata_query(query_name, context, use_cache=True):
+    """Renders the SPARQL query template `query_name` with `context`, and returns the results from WDQS
+
+    If `query_name` has an entry in `settings.WDQS_CACHE_TIMEOUTS`, results are cached (in the 'wdqs' cache) against
+    the rendered query. Passing `use_cache=False` forces a live query, whose results then replace any cached ones.
+
+    Each query is measured with :py:mod:`commons_api.wikidata.instrumentation`."""
+    with instrumentation.instrument(query_name, context) as metrics:
+        start = time.monotonic()
+        query = sparql.render_query(query_name, context)
+        metrics.render_time = time.monotonic() - start
+        cache_timeout = settings.WDQS_CACHE_TIMEOUTS.get(query_name)
+        cache, cache_key = caches['wdqs'], wikidata_query_cache_key(query)
+        results = cache.get(cache_key) if cache_timeout and use_cache else None
+        if results is not None:
+            metrics.cache_hit = True
+            return results
+        results = wikidata_query(query, metrics=metrics)
+        metrics.bindings = len(results['results']['bindings'])
+        if cache_timeout:
+            cache.set(cache_key, results, cache_timeout)
+        return results
+
+
+def templated_wikidata_query_bindings(query_name, context, use_cache=True, result_format='json'):
+    """Renders the SPARQL query template `query_name` with `context`, and yields each result from WDQS
+
+    This is the streaming equivalent of :py:func:`templated_wikidata_query`, and shares its cache. Cacheable results
+    are accumulated as they are streamed, and are only cached once they have been consumed completely. See
+    :py:func:`wikidata_query_bindings` for `result_format`."""
+    with instrumentation.instrument(query_name, context) as metrics:
+        start = time.monotonic()
+        query = sparql.render_query(query_name, context)
+        metrics.render_time = time.monotonic() - start
+        cache_timeout = settings.WDQS_CACHE_TIMEOUTS.get(query_name)
+        if not cache_timeout:
+            for binding in wikidata_query_bindings(query, result_format, metrics=metrics):
+                metrics.bindings += 1
+                yield binding
+            return
+
+        cache, cache_key = caches['wdqs'], wikidata_query_cache_key(query, result_format)
+        results = cache.get(cache_key) if use_cache else None
+        if results is not None:
+            metrics.cache_hit = True
+            if result_format == 'tsv':
+                row_class = sparql_row_class(results['vars'])
+                yield from (row_class(*row) for row in results['rows'])
+            else:
+                yield from results['results']['bindings']
+            return
+
+        bindings = []
+        for binding in wikidata_query_bindings(query, result_format, metrics=metrics):
+            metrics.bindings += 1
+            bindings.append(binding)
+            yield binding
+    if result_format == 'tsv':
+        # The namedtuple classes can't be pickled, so we store their fields separately
+        results = {'vars': type(bindings[0])._fields if bindings else (),
+                   'rows': [tuple(row) for row in bindings]}
+    else:
+        results = {'results': {'bindings': bindings}}
+    cache.set(cache_key, results, cache_timeout)
+
+
+def _in_worker_thread(func, *args):
+    """Calls `func` on a thread pool's thread, closing the thread's database connection afterwards
+
+    Each thread gets its own database connection (used by the governor), which would otherwise be left open."""
+    try:
+        return func(*args)
+    finally:
+        connection.close()
+
+
+def sharded_wikidata_query_bindings(query_name, context, values_key, shard_size=None, min_shard_size=1,
+                                    max_workers=None, use_cache=True, result_format='json'):
+    """Runs a query with a long list of VALUES as several smaller queries, yielding the combined bindings in order
+
+    `context[values_key]` is split into shards of at most `shard_size` (defaulting to `settings.WDQS_SHARD_SIZE`)
+    values, and `query_name` is rendered and queried for each shard, with the shard in place of the full list. Up to
+    `max_workers` (defaulting to `settings.WDQS_QUERY_CONCURRENCY`) shards are queried concurrently.
+
+    If a shard times out, it is split in half and each half is queried in turn, down to `min_shard_size` values.
+    Subsequent shards are no larger than the shard that timed out.
+
+    Bindings are yielded shard by shard, in the order of the values. Any ORDER BY in the query is therefore only
+    honoured within each shard.
+    """
+    values = list(context[values_key])
+    shard_size = shard_size or settings.WDQS_SHARD_SIZE
+    max_workers = max_workers or settings.WDQS_QUERY_CONCURRENCY
+    shard_size_lock = threading.Lock()
+
+    def get_shards():
+        start = 0
+        while start < len(values):
+            with shard_size_lock:
+                end = start + shard_size
+            yield values[start:end]
+            start = end
+
+    def query_shard(shard):
+        nonlocal shard_size
+        try:
+            return list(templated_wikidata_query_bindings(query_name, {**context, values_key: shard},
+                                                          use_cache=use_cache, result_format=result_format))
+        except WDQSTimeout:
+            if len(shard) <= min_shard_size:
+                raise
+            half = (len(shard) + 1) // 2
+            with shard_size_lock:
+                shard_size = max(min_shard_size, min(shard_size, half))
+            return query_shard(shard[:half]) + query_shard(shard[half:])
+
+    if max_workers == 1:
+        for shard in get_shards():
+            yield from query_shard(shard)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        pending = collections.deque()
+        for shard in get_shards():
+            pending.append(executor.submit(_in_worker_thread, query_shard, shard))
+            if len(pending) >= max_workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def iter_concurrent_wikidata_queries(queries, max_concurrency=None, use_cache=True):
+    """Runs many templated queries with up to `max_concurrency` in flight, yielding each one's results as it completes
+
+    `queries` is a sequence of `(key, query_name, context)` tuples, and this yields a `(key, bindings)` tuple for each,
+    in order of completion, where `bindings` is a list. `max_concurrency` defaults to `settings.WDQS_BATCH_CONCURRENCY`.
+
+    Queries are made on a thread pool, and their results are handed back to the calling thread, which should do any
+    writing to the database, so that it is the single writer of the results. A query is only started once there are
+    fewer than `max_concurrency` queries either in flight or waiting to be consumed, so memory stays bounded if the
+    writer falls behind.
+    """
+    max_concurrency = max_concurrency or settings.WDQS_BATCH_CONCURRENCY
+
+    def fetch(query_name, context):
+        return list(templated_wikidata_query_bindings(query_name, context, use_cache=use_cache))
+
+    if max_concurrency == 1:
+        for key, query_name, context in queries:
+            yield key, fetch(query_name, context)
+        return
+
+    queries, pending = iter(queries), {}
+    with concurrent.futures.ThreadPoolExecutor(max_concurrency) as executor:
+        def submit_next():
+            for key, query_name, context in queries:
+                pending[executor.submit(_in_worker_thread, fetch, query_name, context)] = key
+                return
+
+        for i in range(max_concurrency):
+            submit_next()
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+                # The result has been consumed, so another query can start
+                submit_next()
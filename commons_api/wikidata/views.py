@@ -1,12 +1,12 @@
 import datetime
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.contenttypes.models import ContentType
 from django.db.models import Q
 from django.db.models.fields.related import RelatedField
 from django.shortcuts import redirect
 from django.urls import reverse, get_resolver, resolve
-from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 from django.views.generic.base import ContextMixin
@@ -17,7 +17,7 @@ from django.views.generic import ListView, DetailView, FormView
 from rest_framework.utils.urls import replace_query_param
 
 from commons_api.wikidata import tasks
-from . import forms, models
+from . import coalescing, forms, models
 
 
 class APILinksMixin(ContextMixin):
@@ -68,7 +68,7 @@ class CountryListView(APILinksMixin, ListView):
 
     def post(self, request, *args, **kwargs):
         if 'refresh-country-list' in request.POST:
-            tasks.refresh_country_list.delay()
+            tasks.refresh_country_list.delay(use_cache=False)
             messages.info(request, "Country list will be refreshed")
         if 'update-all-boundaries' in request.POST:
             from commons_api.proto_commons.tasks import update_all_boundaries
@@ -94,11 +94,12 @@ class CountryDetailView(APILinksMixin, DetailView):
     def post(self, request, *args, **kwargs):
         self.object = self.get_object()
         if 'refresh-legislature-list' in request.POST:
-            self.object.refresh_legislatures_last_queued = timezone.now()
-            self.object.save()
-            tasks.refresh_legislatures.delay(self.object.id, queued_at=self.object.refresh_legislatures_last_queued)
-            messages.info(request, "Legislature list for {} will "
-                                   "be refreshed".format(self.object))
+            if coalescing.enqueue(tasks.refresh_legislatures, self.object.id, use_cache=False):
+                messages.info(request, "Legislature list for {} will "
+                                       "be refreshed".format(self.object))
+            else:
+                messages.info(request, "Legislature list for {} is already "
+                                       "being refreshed".format(self.object))
         if 'update-boundaries' in request.POST:
             from commons_api.proto_commons.tasks import update_boundaries_for_country
             update_boundaries_for_country.delay(self.object.id)
@@ -114,17 +115,19 @@ class LegislativeHouseDetailView(APILinksMixin, DetailView):
     def post(self, request, *args, **kwargs):
         self.object = self.get_object()
         if 'refresh-legislature-members' in request.POST:
-            self.object.refresh_members_last_queued = timezone.now()
-            self.object.save()
-            tasks.refresh_members.delay(self.object.id, queued_at=self.object.refresh_members_last_queued)
-            messages.info(request, "Legislature membership for {} "
-                                   "will be refreshed".format(self.object))
+            if coalescing.enqueue(tasks.refresh_members, self.object.id):
+                messages.info(request, "Legislature membership for {} "
+                                       "will be refreshed".format(self.object))
+            else:
+                messages.info(request, "Legislature membership for {} is already "
+                                       "being refreshed".format(self.object))
         if 'refresh-legislature-districts' in request.POST:
-            self.object.refresh_districts_last_queued = timezone.now()
-            self.object.save()
-            tasks.refresh_districts.delay(self.object.id, queued_at=self.object.refresh_districts_last_queued)
-            messages.info(request, "Legislature districts for {} "
-                                   "will be refreshed".format(self.object))
+            if coalescing.enqueue(tasks.refresh_districts, self.object.id):
+                messages.info(request, "Legislature districts for {} "
+                                       "will be refreshed".format(self.object))
+            else:
+                messages.info(request, "Legislature districts for {} are already "
+                                       "being refreshed".format(self.object))
         return redirect(self.object.get_absolute_url())
 
 
@@ -201,6 +204,16 @@ class LegislativeHouseMembershipView(APILinksMixin, DetailView):
         return context
 
 
+class QueryTemplateStatsListView(ListView):
+    model = models.QueryTemplateStats
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['refresh_costs'] = models.RefreshCost.objects.all()[:20]
+        context['heavy_task_duration'] = settings.WIKIDATA_HEAVY_TASK_DURATION
+        return context
+
+
 class ModerationItemDetailView(ModelFormMixin, ProcessFormView, DetailView):
     model = models.ModerationItem
     form_class = forms.ModerateForm